@@ -1,21 +1,31 @@
-from flask import Flask, jsonify, request, Blueprint
-import vertexai
-from vertexai.generative_models import GenerativeModel, Part
-from google.auth import default
+from flask import Flask, Response, jsonify, request, stream_with_context, Blueprint
+from typing import NamedTuple
 import json
+import logging
 import os
+from contextlib import nullcontext
+from providers import lazy_provider
+from upstream import call_upstream
+from uploads import UploadError, read_audio_request
 
-# Set up Google credentials and Flask app
-credentials, project_id = default()
 ai_speech_to_text_gemini_bp = Blueprint('ai_speech_to_text_gemini_bp', __name__)
+logger = logging.getLogger(__name__)
 
-# Replace with your project ID and location
-project_id = "stately-arc-434002-q1"
-location = "us-central1"
+project_id = os.getenv("vertex_project", "stately-arc-434002-q1")
+location = os.getenv("vertex_location", "us-central1")
+gemini_model_name = os.getenv("gemini_model", "gemini-1.5-flash-001")
 
-vertexai.init(project=project_id, location=location)
+def init_model():
+    # Google credentials and vertexai.init take seconds and fail without credentials,
+    # so they wait for the first Gemini request
+    import vertexai
+    from google.auth import default
+    from vertexai.generative_models import GenerativeModel
+    credentials, _ = default()
+    vertexai.init(project=project_id, location=location, credentials=credentials)
+    return GenerativeModel(gemini_model_name)
 
-model = GenerativeModel("gemini-1.5-flash-001")
+model = lazy_provider("gemini", "gemini", init_model)
 
 def serialize_response(response):
     try:
@@ -47,62 +57,174 @@ def serialize_response(response):
         }
         return response_dict
     except AttributeError as e:
-        print(f"Error processing response: {e}")
+        logger.warning("Error processing response: %s", e)
         return None
 
-def transcribe_with_keyword(audio_file_path, keyword):
-    with open(audio_file_path, "rb") as f:
-        audio_data = f.read()
-
-    audio_file = Part.from_data(audio_data, mime_type="audio/mpeg")
+def gemini_contents(audio_data, keyword, mime_type="audio/mpeg"):
+    from vertexai.generative_models import Part
+    audio_file = Part.from_data(audio_data, mime_type=mime_type)
 
     prompt = f"""
     Can you return start and end timestamps for each word?
+    Answer with one JSON object per line with the keys word, start_time and end_time, times in seconds.
 
     # **Keyword:** {keyword}
     """
 
-    contents = [audio_file, prompt]
-    response = model.generate_content(contents)
+    return [audio_file, prompt]
+
+class WordTimestamp(NamedTuple):
+    word: str
+    start: float
+    end: float
+
+def _seconds(value):
+    # Plain seconds, or "mm:ss.f" / "hh:mm:ss.f" clock times
+    if isinstance(value, str) and ":" in value:
+        seconds = 0.0
+        for part in value.split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    return float(value)
+
+class WordTimestampParser:
+    # Pulls word objects out of Gemini's text as it arrives. The model answers with JSON lines or
+    # a JSON array, sometimes inside a ```json fence, so innermost {...} objects are found by brace
+    # matching and everything between them is ignored; a bad object is skipped, not fatal
+    def __init__(self):
+        self.buffer = ""
+        self.malformed = 0
+        self._scanned = 0
+        self._open = []  # [start offset, contains a nested object] per unclosed brace
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        self.buffer += text
+        words = []
+        for index in range(self._scanned, len(self.buffer)):
+            char = self.buffer[index]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"' and self._open:
+                self._in_string = True
+            elif char == "{":
+                if self._open:
+                    self._open[-1][1] = True
+                self._open.append([index, False])
+            elif char == "}" and self._open:
+                start, nested = self._open.pop()
+                if not nested:
+                    word = self._word(self.buffer[start:index + 1])
+                    if word is not None:
+                        words.append(word)
+        # Keep only the unfinished object, if any
+        keep = self._open[0][0] if self._open else len(self.buffer)
+        self.buffer = self.buffer[keep:]
+        self._scanned = len(self.buffer)
+        for entry in self._open:
+            entry[0] -= keep
+        return words
+
+    def _word(self, text):
+        try:
+            obj = json.loads(text)
+            start = obj["start_time"] if "start_time" in obj else obj["start"]
+            end = obj["end_time"] if "end_time" in obj else obj["end"]
+            return WordTimestamp(str(obj["word"]), round(_seconds(start), 3), round(_seconds(end), 3))
+        except (ValueError, KeyError, TypeError):
+            self.malformed += 1
+            return None
+
+    def finish(self):
+        if self._open:
+            self.malformed += 1
+        if self.malformed:
+            logger.warning("Skipped %d malformed word timestamps", self.malformed)
+
+def response_text(response):
+    # A chunk blocked by safety filters has no parts
+    candidates = getattr(response, "candidates", None) or []
+    if not candidates:
+        return ""
+    return "".join(part.text for part in candidates[0].content.parts if getattr(part, "text", None))
+
+def parse_word_timestamps(response):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Gemini response: %s", json.dumps(serialize_response(response)))
+    parser = WordTimestampParser()
+    words = parser.feed(response_text(response))
+    parser.finish()
+    return words
+
+def words_payload(words):
+    return [word._asdict() for word in words]
+
+def sse_word_event(index, word):
+    return f"id: {index}\ndata: {json.dumps(word._asdict())}\n\n"
+
+def read_gemini_audio(upload, audio_file_path):
+    # Vertex takes inline audio as bytes, so uploads are read once from their spool here
+    with upload or nullcontext():
+        if upload:
+            return upload.read(), upload.mime_type
+    with open(audio_file_path, "rb") as f:
+        return f.read(), "audio/mpeg"
 
-    print("****************")
-    response_dict = serialize_response(response)
-    if response_dict:
-        print(json.dumps(response_dict, indent=2))
+def transcribe_with_keyword(audio_file_path, keyword):
+    audio_data, mime_type = read_gemini_audio(None, audio_file_path)
+    return transcribe_audio_data(audio_data, keyword, mime_type)
+
+def transcribe_audio_data(audio_data, keyword, mime_type="audio/mpeg"):
+    response = call_upstream("vertex", model.generate_content, gemini_contents(audio_data, keyword, mime_type))
+    return parse_word_timestamps(response)
+
+def stream_word_timestamps(audio_data, keyword, mime_type="audio/mpeg"):
+    parser = WordTimestampParser()
+    chunks = call_upstream(
+        "vertex", model.generate_content, gemini_contents(audio_data, keyword, mime_type), stream=True
+    )
+    for chunk in chunks:
+        yield from parser.feed(response_text(chunk))
+    parser.finish()
+
+def gemini_request(request):
+    data, upload = read_audio_request(request)
+    audio_file_path = data.get('audio_file_path')
+    keyword = data.get('keyword', "test")  # Default keyword if not provided
 
-    try:
-        # Get JSON response from the generated text
-        json_str = response.candidates[0].content.parts[0].text
-        # Split JSON by newline to get individual timestamps for each word
-        json_lines = json_str.strip().split('\n')
-        json_response = []
-        for line in json_lines:
-            # Load each line as a separate JSON object
-            obj = json.loads(line)
-            # Extract start and end timestamps
-            start_time = obj['start_time']
-            end_time = obj['end_time']
-            # Add the word and timestamps as a tuple to the response list
-            json_response.append((obj['word'], start_time, end_time))
-        return json_response
-
-    except json.JSONDecodeError as e:
-        print("Error decoding JSON:", e)
-        return None
+    if not (upload or audio_file_path):
+        raise UploadError("Audio file path not provided.")
+    return (*read_gemini_audio(upload, audio_file_path), keyword)
 
 @ai_speech_to_text_gemini_bp.route('/transcribe', methods=['POST'])
 def transcribe():
-    # Get the audio file path from the request
-    data = request.get_json()
-    audio_file_path = data.get('audio_file_path')
-    keyword = data.get('keyword', "test")  # Default keyword if not provided
-
-    if not audio_file_path:
-        return jsonify({"error": "Audio file path not provided."}), 400
+    try:
+        audio_data, mime_type, keyword = gemini_request(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    transcription = transcribe_audio_data(audio_data, keyword, mime_type)
 
-    transcription = transcribe_with_keyword(audio_file_path, keyword)
+    logger.debug("Gemini transcription: %s", transcription)
+    return jsonify(words_payload(transcription))
 
-    print("############")
-    print(transcription)
-    print("############")
-    return jsonify(transcription)
+@ai_speech_to_text_gemini_bp.route('/stream-transcribe', methods=['POST'])
+def stream_transcribe():
+    try:
+        audio_data, mime_type, keyword = gemini_request(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    def generate():
+        try:
+            for index, word in enumerate(stream_word_timestamps(audio_data, keyword, mime_type)):
+                yield sse_word_event(index, word)
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            yield f"data: [ERROR] {str(e)}\n\n"
+    return Response(stream_with_context(generate()), mimetype="text/event-stream")
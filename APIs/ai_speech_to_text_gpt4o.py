@@ -1,21 +1,37 @@
 
 from flask import Blueprint, request, jsonify
-from flask import Response, stream_with_context, request
-from openai import OpenAI
+from flask import Response, stream_with_context, request, send_file
+from contextlib import nullcontext
 from dotenv import load_dotenv
 import os
 import uuid
 import base64
+import json
+import logging
+from urllib.parse import quote
+from audio_store import reply_audio_store
+from tts_pipeline import SentenceSplitter, TTSPipeline
+from conversation_store import coalesced_turns, conversations
+from conversation_log import conversation_log
+from upstream import call_upstream, openai_client, upstream_errors, upstream_timeout
+from structured_output import OutputSchema, StructuredOutputError, structured_call
+from uploads import UploadError, read_audio_request
+from tracing import span, traced
+from context_window import ContextWindow, reset_context
+from response_cache import (
+    cacheable_tts_text, intent_cache, intent_cache_key, response_cache_stats, tts_cache, tts_cache_key
+)
 
 load_dotenv()
-client = OpenAI(api_key=os.getenv("openai_api_key"))
+client = openai_client
 
 ai_speech_to_text_gpt4o_bp = Blueprint('ai_speech_to_text_gpt4o_bp', __name__)
-conversation_store = {}
-conversation_state = {}
+logger = logging.getLogger(__name__)
 voice_mapping = {"en": "nova", "es": "onyx"}
-
-os.makedirs("conversations", exist_ok=True)
+# "single_pass" asks for intent, pending questions and the reply in one call;
+# "multi_call" keeps the original detect/filter/respond sequence for A/B runs
+default_turn_engine = os.getenv("turn_engine", "single_pass")
+context_summary_model = os.getenv("context_summary_model", "gpt-3.5-turbo")
 
 system_prompt = (
     "You are a friendly, natural-sounding assistant that helps users complete tasks like creating emails, invoices, or reminders. "
@@ -23,155 +39,460 @@ system_prompt = (
     "Extract multiple answers if the user provides more than one. If all info is available, generate the final response."
 )
 
-def initialize_conversation(conversation_id):
-    if conversation_id not in conversation_store:
-        conversation_store[conversation_id] = [{"role": "system", "content": system_prompt}]
-        conversation_state[conversation_id] = {
-            "last_intent": None,
-            "pending_questions": [],
-            "last_prompted": None,
-            "task_finalized": False
-        }
-
-def save_conversation_to_file(conversation_id):
-    path = f"conversations/{conversation_id}.txt"
-    with open(path, "a", encoding="utf-8") as f:
-        for msg in conversation_store[conversation_id]:
-            f.write(f"{msg['role'].upper()}: {msg['content']}\n")
-        f.write("\n--- END OF TURN ---\n\n")
+turn_prompt = (
+    "Before replying, decide the state of this turn and answer with a JSON object with these keys:\n"
+    "- intent: the task the user is doing: 'invoice', 'email', 'reminder', or 'unknown' when unclear.\n"
+    "- pending_questions: the follow-up questions you still need answered after this reply, "
+    "dropping any the user has just answered. Start from the pending list below.\n"
+    "- reply: what to say to the user now. Either the single next follow-up question, "
+    "or a one-line summary when the task is complete.\n"
+    "- detailed_response: the full response. Same as reply when asking a question, "
+    "otherwise the complete generated email, invoice or reminder.\n"
+    "- task_finalized: true only when detailed_response completes the task.\n"
+)
+
+TASK_TYPES = ("invoice", "email", "reminder", "unknown")
+INTENT = {"type": "string", "enum": list(TASK_TYPES), "description": "The task, or 'unknown' when it is none of these."}
+
+# Every structured reply is a forced function call (or, for the turn, a JSON object) checked against its schema
+TASK_TYPE = OutputSchema({
+    "name": "set_task_type",
+    "description": "Record the task the user is trying to do.",
+    "parameters": {
+        "type": "object",
+        "properties": {"intent": INTENT},
+        "required": ["intent"],
+    },
+})
+UNANSWERED_QUESTIONS = OutputSchema({
+    "name": "set_unanswered_questions",
+    "description": "Record which pending questions the user's message leaves unanswered.",
+    "parameters": {
+        "type": "object",
+        "properties": {"unanswered": {"type": "array", "items": {"type": "integer"},
+                                      "description": "Indices of the pending questions that are still unanswered."}},
+        "required": ["unanswered"],
+    },
+})
+ASSISTANT_RESPONSE = OutputSchema({
+    "name": "respond",
+    "description": "Reply to the user.",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "reply": {"type": "string", "description": "What to say now: the next follow-up question, or a one-line summary when the task is complete."},
+            "detailed_response": {"type": "string", "description": "The full response. Same as reply when asking a question, otherwise the complete email, invoice or reminder."},
+            "follow_up_questions": {"type": "array", "items": {"type": "string"},
+                                    "description": "Every question still needed to finish the task, most important first. Empty when the task is complete."},
+        },
+        "required": ["reply", "detailed_response", "follow_up_questions"],
+    },
+})
+TURN_RESULT = OutputSchema({
+    "name": "turn_result",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "intent": INTENT,
+            "pending_questions": {"type": "array", "items": {"type": "string"}},
+            "reply": {"type": "string"},
+            "detailed_response": {"type": "string"},
+            "task_finalized": {"type": "boolean"},
+        },
+        "required": ["intent", "reply"],
+    },
+}, mode="json_object")
+
+def new_conversation_state(last_intent=None):
+    return {
+        "last_intent": last_intent,
+        "pending_questions": [],
+        "last_prompted": None,
+        "task_finalized": False
+    }
+
+def new_conversation(conversation_id):
+    return {
+        "conversation_id": conversation_id,
+        "messages": [{"role": "system", "content": system_prompt}],
+        "state": new_conversation_state(),
+        "logged_messages": 0,
+        "token_counts": [],
+        "summary": None,
+        "context_epoch": 0
+    }
+
+def conversation_session(conversation_id):
+    return conversations.session(conversation_id, lambda: new_conversation(conversation_id))
+
+def conversation_session_async(conversation_id):
+    return conversations.session_async(conversation_id, lambda: new_conversation(conversation_id))
+
+def reset_conversation(conversation, new_intent):
+    conversation["messages"] = [{"role": "system", "content": system_prompt}]
+    conversation["state"] = new_conversation_state(new_intent)
+    conversation["logged_messages"] = 0
+    reset_context(conversation)
+    conversation_log.reset(conversation["conversation_id"], new_intent)
+
+def summarize_conversation(previous_summary, messages):
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    prompt = (
+        "Update the running summary of this conversation with the new messages. Keep every detail the user "
+        "has given for their task (names, amounts, dates, addresses) and the questions still open. "
+        "Reply with the summary only.\n\n"
+        f"Summary so far: {previous_summary or 'none'}\n\nNew messages:\n{transcript}"
+    )
+    result = call_upstream(
+        "openai", client.chat.completions.create,
+        model=context_summary_model, messages=[{"role": "system", "content": prompt}],
+        timeout=upstream_timeout("chat")
+    )
+    return result.choices[0].message.content.strip()
+
+context_window = ContextWindow(summarize_conversation, conversation_session)
+
+def log_conversation_turn(conversation):
+    # Only messages added since the last logged turn are appended
+    logged = conversation.get("logged_messages", 0)
+    conversation_log.append(conversation["conversation_id"], conversation["messages"][logged:], conversation["state"])
+    conversation["logged_messages"] = len(conversation["messages"])
+
+def task_type_messages(user_input_text):
+    prompt = f"What task is the user trying to do in this message? Answer with one of {', '.join(TASK_TYPES)}.\n\n{user_input_text}"
+    return [{"role": "system", "content": prompt}]
 
+@traced("detect_task_type")
 def detect_task_type(user_input_text):
-    prompt = f"What task is the user trying to do in this message? Just return one word like 'invoice', 'email', 'reminder'.\n\n{user_input_text}"
+    cache_key = intent_cache_key(user_input_text, "gpt-4o")
+    cached = intent_cache.get(cache_key)
+    if cached is not None:
+        return cached
     try:
-        res = client.chat.completions.create(model="gpt-4o", messages=[{"role": "system", "content": prompt}])
-        return res.choices[0].message.content.strip().lower()
-    except:
+        result = structured_call(
+            TASK_TYPE, "openai", client.chat.completions.create,
+            model="gpt-4o", messages=task_type_messages(user_input_text), timeout=upstream_timeout("classify")
+        )
+        intent = result["intent"]
+    except upstream_errors() + (StructuredOutputError,) as e:
+        logger.warning("Task type detection failed: %s", e)
         return "unknown"
+    intent_cache.put(cache_key, intent)
+    return intent
 
-def get_next_question(conversation_id):
-    state = conversation_state[conversation_id]
+def get_next_question(conversation):
+    state = conversation["state"]
     if state["pending_questions"]:
         next_q = state["pending_questions"].pop(0)
         state["last_prompted"] = next_q
         return next_q
     return None
 
-def get_gpt_response(conversation_id):
-    gpt_response = client.chat.completions.create(
+@traced("get_gpt_response")
+def get_gpt_response(conversation):
+    response = structured_call(
+        ASSISTANT_RESPONSE, "openai", client.chat.completions.create,
         model="gpt-4o",
-        messages=conversation_store[conversation_id]
+        messages=context_window.messages(conversation, "respond"),
+        timeout=upstream_timeout("chat")
+    )
+    detailed_response = response["detailed_response"].strip()
+    questions = [question.strip() for question in response["follow_up_questions"] if question.strip()]
+    return response["reply"].strip() or detailed_response, detailed_response, questions
+
+def unanswered_questions_messages(user_input_text, pending):
+    numbered = "\n".join(f"{index}: {question}" for index, question in enumerate(pending))
+    prompt = (
+        "You're a task assistant. Given the user message and the pending questions, each prefixed with its index, "
+        "return the indices of the questions the message does not answer.\n"
+        f"User: {user_input_text}\nPending:\n{numbered}"
     )
-    content = gpt_response.choices[0].message.content.strip()
-    return content.split("\n")[0], content
+    return [{"role": "system", "content": prompt}]
 
-def filter_answered_questions(conversation_id, user_input_text):
-    state = conversation_state[conversation_id]
+@traced("filter_answered_questions")
+def filter_answered_questions(conversation, user_input_text):
+    state = conversation["state"]
     pending = state["pending_questions"]
     if not pending:
         return
-    prompt = (
-        "You're a task assistant. Given the user message and pending questions, return only unanswered questions.\n"
-        f"User: {user_input_text}\nPending: {pending}\n\nReturn a Python list:"
-    )
     try:
-        result = client.chat.completions.create(
-            model="gpt-4o", messages=[{"role": "system", "content": prompt}]
+        result = structured_call(
+            UNANSWERED_QUESTIONS, "openai", client.chat.completions.create,
+            model="gpt-4o", messages=unanswered_questions_messages(user_input_text, pending),
+            timeout=upstream_timeout("classify")
         )
-        cleaned = result.choices[0].message.content.strip()
-        state["pending_questions"] = eval(cleaned) if cleaned.startswith("[") else pending
-    except:
-        pass
+    except upstream_errors() + (StructuredOutputError,) as e:
+        # Keep the pending list as it was; the next turn asks the same question again
+        logger.warning("Filtering answered questions failed: %s", e)
+        return
+    state["pending_questions"] = [pending[index] for index in sorted(set(result["unanswered"])) if 0 <= index < len(pending)]
 
-def reset_if_new_task(conversation_id, user_input_text):
-    state = conversation_state[conversation_id]
-    new_intent = detect_task_type(user_input_text)
-    if new_intent and new_intent != state["last_intent"] and state["last_intent"] is not None:
-        conversation_store[conversation_id] = [{"role": "system", "content": system_prompt}]
-        conversation_state[conversation_id] = {
-            "last_intent": new_intent,
-            "pending_questions": [],
-            "last_prompted": None,
-            "task_finalized": False
-        }
-    else:
+def starts_new_task(state, new_intent):
+    # An unclear or missing intent keeps the current task; only a different known task resets it
+    return new_intent not in (None, "unknown") and state["last_intent"] is not None and new_intent != state["last_intent"]
+
+@traced("reset_if_new_task")
+def reset_if_new_task(conversation, user_input_text, new_intent=None):
+    state = conversation["state"]
+    if new_intent is None:
+        new_intent = detect_task_type(user_input_text)
+    if starts_new_task(state, new_intent):
+        reset_conversation(conversation, new_intent)
+    elif new_intent not in (None, "unknown"):
         state["last_intent"] = new_intent
 
-def process_user_input(conversation_id, user_input_text, language_code):
-    initialize_conversation(conversation_id)
-    reset_if_new_task(conversation_id, user_input_text)
-    state = conversation_state[conversation_id]
-    conversation_store[conversation_id].append({"role": "user", "content": user_input_text})
-    filter_answered_questions(conversation_id, user_input_text)
+def turn_messages(conversation):
+    state = conversation["state"]
+    instructions = (
+        f"{turn_prompt}\nCurrent task: {state['last_intent'] or 'none yet'}\n"
+        f"Pending questions: {json.dumps(state['pending_questions'])}"
+    )
+    return context_window.messages(conversation, "turn") + [{"role": "system", "content": instructions}]
+
+@traced("turn")
+def get_turn_result(conversation):
+    return structured_call(
+        TURN_RESULT, "openai", client.chat.completions.create,
+        model="gpt-4o",
+        messages=turn_messages(conversation),
+        timeout=upstream_timeout("chat")
+    )
+
+def begin_turn(conversation, user_input_text):
+    conversation["messages"].append({"role": "user", "content": user_input_text})
+
+def apply_turn_result(conversation, result):
+    state = conversation["state"]
+    user_message = conversation["messages"][-1]
+    new_intent = result.get("intent")
+    if starts_new_task(state, new_intent):
+        # Same reset as reset_if_new_task, keeping the message that started the new task
+        reset_conversation(conversation, new_intent)
+        conversation["messages"].append(user_message)
+        state = conversation["state"]
+    elif new_intent not in (None, "unknown"):
+        state["last_intent"] = new_intent
+
+    detailed_response = str(result.get("detailed_response") or result.get("reply") or "").strip()
+    reply = str(result.get("reply") or "").strip() or detailed_response.split("\n")[0]
+    state["pending_questions"] = [q for q in result.get("pending_questions") or [] if isinstance(q, str)]
+    state["task_finalized"] = bool(result.get("task_finalized"))
+    state["last_prompted"] = None if state["task_finalized"] else reply
+    conversation["messages"].append({"role": "assistant", "content": detailed_response})
+    log_conversation_turn(conversation)
+    return reply, detailed_response
+
+def process_user_input_single_pass(conversation, user_input_text, language_code):
+    begin_turn(conversation, user_input_text)
+    return apply_turn_result(conversation, get_turn_result(conversation))
+
+def turn_key(conversation_id, user_input_text, language_code, turn_engine):
+    return (conversation_id, user_input_text, language_code, turn_engine)
+
+def process_user_input(conversation_id, user_input_text, language_code, turn_engine=None):
+    # Turns on one conversation run one at a time under its lock; a duplicate of a running turn shares its reply
+    turn_engine = turn_engine or default_turn_engine
+    return coalesced_turns.run(
+        turn_key(conversation_id, user_input_text, language_code, turn_engine),
+        lambda: run_turn(conversation_id, user_input_text, language_code, turn_engine)
+    )
+
+def run_turn(conversation_id, user_input_text, language_code, turn_engine):
+    with span("conversation", engine=turn_engine), conversation_session(conversation_id) as conversation:
+        if turn_engine == "single_pass":
+            return process_user_input_single_pass(conversation, user_input_text, language_code)
+        return process_user_input_multi_call(conversation, user_input_text, language_code)
+
+def process_user_input_multi_call(conversation, user_input_text, language_code):
+    reset_if_new_task(conversation, user_input_text)
+    state = conversation["state"]
+    conversation["messages"].append({"role": "user", "content": user_input_text})
+    filter_answered_questions(conversation, user_input_text)
 
     if not state["pending_questions"] and not state["task_finalized"]:
-        _, assistant_response = get_gpt_response(conversation_id)
-        conversation_store[conversation_id].append({"role": "assistant", "content": assistant_response})
-        questions = [line.strip() for line in assistant_response.split("\n") if line.strip().endswith("?")]
+        reply, detailed_response, questions = get_gpt_response(conversation)
+        conversation["messages"].append({"role": "assistant", "content": detailed_response})
         if questions:
             state["pending_questions"] = questions[1:]
-            save_conversation_to_file(conversation_id)
+            log_conversation_turn(conversation)
             return questions[0], questions[0]
         else:
             state["task_finalized"] = True
-            save_conversation_to_file(conversation_id)
-            return assistant_response.split("\n")[0], assistant_response
+            log_conversation_turn(conversation)
+            return reply, detailed_response
     elif state["pending_questions"]:
-        next_question = get_next_question(conversation_id)
-        save_conversation_to_file(conversation_id)
+        next_question = get_next_question(conversation)
+        log_conversation_turn(conversation)
         return next_question, next_question
     else:
-        high_level_reply, detailed_response = get_gpt_response(conversation_id)
-        conversation_store[conversation_id].append({"role": "assistant", "content": detailed_response})
+        high_level_reply, detailed_response, _ = get_gpt_response(conversation)
+        conversation["messages"].append({"role": "assistant", "content": detailed_response})
         state["task_finalized"] = True
-        save_conversation_to_file(conversation_id)
+        log_conversation_turn(conversation)
         return high_level_reply, detailed_response
 
-def generate_tts_response(text, language_code):
+def speech_cache_key(text, language_code):
+    # None for texts too long to be worth memoizing
+    if not cacheable_tts_text(text):
+        return None
+    return tts_cache_key(text, voice_mapping.get(language_code, "nova"), "tts-1")
+
+def iter_cached_audio(audio, chunk_size):
+    for offset in range(0, len(audio), chunk_size):
+        yield audio[offset:offset + chunk_size]
+
+@traced("tts")
+def synthesize_speech(text, language_code):
+    cache_key = speech_cache_key(text, language_code)
+    cached = tts_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        return cached
     voice = voice_mapping.get(language_code, "nova")
-    tts_result = client.audio.speech.create(
-        model="tts-1", voice=voice, input=text
+    tts_result = call_upstream(
+        "openai", client.audio.speech.create,
+        model="tts-1", voice=voice, input=text, timeout=upstream_timeout("speech")
     )
-    output_path = f"voice_reply_{uuid.uuid4().hex}.mp3"
-    with open(output_path, "wb") as f:
-        f.write(tts_result.content)
-    return output_path
+    if cache_key:
+        tts_cache.put(cache_key, tts_result.content)
+    return tts_result.content
+
+def open_speech_stream(text, language_code, chunk_size=16384):
+    # Returns (chunks, close). close() releases the streaming response and is safe to call again,
+    # so callers also register it on the Flask response for bodies that are never iterated
+    cache_key = speech_cache_key(text, language_code)
+    cached = tts_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        return iter_cached_audio(cached, chunk_size), lambda: None
+    voice = voice_mapping.get(language_code, "nova")
+    # Enter the streaming response eagerly so upstream errors surface before we start replying
+    def speech_stream():
+        manager = client.audio.speech.with_streaming_response.create(
+            model="tts-1", voice=voice, input=text, timeout=upstream_timeout("speech")
+        )
+        return manager, manager.__enter__()
+    manager, tts_result = call_upstream("openai", speech_stream)
+    closed = []
+    def close():
+        if not closed:
+            closed.append(True)
+            manager.__exit__(None, None, None)
+    def chunks():
+        buffered = []
+        try:
+            for chunk in tts_result.iter_bytes(chunk_size):
+                if cache_key:
+                    buffered.append(chunk)
+                yield chunk
+        finally:
+            close()
+        if cache_key:
+            tts_cache.put(cache_key, b"".join(buffered))
+    return chunks(), close
+
+def persist_reply_audio(chunks, audio_id):
+    # Pass audio through untouched; only buffer it when a reply audio store is configured
+    if reply_audio_store is None:
+        yield from chunks
+        return
+    buffered = []
+    for chunk in chunks:
+        buffered.append(chunk)
+        yield chunk
+    reply_audio_store.put(b"".join(buffered), audio_id)
+
+def binary_reply_headers(payload, reply, language_code, audio_id):
+    # Raw MP3 body streamed from tts-1; the text fields travel as headers
+    headers = {
+        "X-Reply-Text": quote(reply),
+        "X-User-Input-Text": quote(payload["user_input_text"]),
+        "X-Conversation-Id": quote(payload["conversation_id"]),
+        "X-Language-Code": language_code,
+    }
+    if audio_id:
+        headers["X-Reply-Audio-Id"] = audio_id
+    return headers
+
+def multipart_reply_parts(boundary, payload):
+    head = (f"--{boundary}\r\nContent-Type: application/json\r\n\r\n"
+            f"{json.dumps(payload)}\r\n--{boundary}\r\nContent-Type: audio/mpeg\r\n\r\n").encode("utf-8")
+    return head, f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+def json_reply_payload(payload, audio, audio_id):
+    if audio_id:
+        with span("audio_store.put", bytes=len(audio)):
+            reply_audio_store.put(audio, audio_id)
+    payload["reply_audio_id"] = audio_id
+    payload["reply_audio_path"] = reply_audio_store.path(audio_id) if audio_id else None
+    with span("base64", bytes=len(audio)):
+        payload["reply_audio_base64"] = base64.b64encode(audio).decode("utf-8")
+    return payload
+
+def reply_response(payload, reply, language_code, response_format):
+    audio_id = uuid.uuid4().hex if reply_audio_store is not None else None
+    if response_format == "binary":
+        speech, close = open_speech_stream(reply, language_code)
+        headers = binary_reply_headers(payload, reply, language_code, audio_id)
+        response = Response(stream_with_context(persist_reply_audio(speech, audio_id)), mimetype="audio/mpeg", headers=headers)
+        response.call_on_close(close)
+        return response
+    if response_format == "multipart":
+        payload["reply_audio_id"] = audio_id
+        boundary = uuid.uuid4().hex
+        head, tail = multipart_reply_parts(boundary, payload)
+        speech, close = open_speech_stream(reply, language_code)
+        chunks = persist_reply_audio(speech, audio_id)
+        def parts():
+            yield head
+            yield from chunks
+            yield tail
+        response = Response(stream_with_context(parts()), mimetype=f"multipart/mixed; boundary={boundary}")
+        response.call_on_close(close)
+        return response
+    audio = synthesize_speech(reply, language_code)
+    return jsonify(json_reply_payload(payload, audio, audio_id))
+
+def voice_input_file(upload, audio_file_path):
+    if upload is not None:
+        return (upload.upload_name, upload.file)
+    # Read into memory so a retried call can resend the same bytes
+    with open(audio_file_path, 'rb') as audio_file:
+        return (os.path.basename(audio_file_path), audio_file.read())
 
 @ai_speech_to_text_gpt4o_bp.route('/voice-assist', methods=['POST'])
 def voice_assist():
-    data = request.get_json()
-    audio_file_path = data.get("audio_file_path")
-    conversation_id = data.get("conversation_id")
-    language_code = data.get("language_code", "en")
-    if not audio_file_path or not conversation_id:
-        return jsonify({"error": "Missing audio_file_path or conversation_id"}), 400
-    initialize_conversation(conversation_id)
     try:
-        with open(audio_file_path, 'rb') as audio_file:
-            transcription = client.audio.transcriptions.create(
-                file=audio_file,
+        data, upload = read_audio_request(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    with upload or nullcontext():
+        audio_file_path = data.get("audio_file_path")
+        conversation_id = data.get("conversation_id")
+        language_code = data.get("language_code", "en")
+        if not (upload or audio_file_path) or not conversation_id:
+            return jsonify({"error": "Missing audio_file_path or conversation_id"}), 400
+        try:
+            transcription = call_upstream(
+                "openai", client.audio.transcriptions.create,
+                file=voice_input_file(upload, audio_file_path),
                 model="whisper-1",
                 response_format="text",
-                language=language_code
+                language=language_code,
+                timeout=upstream_timeout("transcription")
             )
-        user_input_text = transcription
-    except Exception as e:
-        return jsonify({"error": f"Transcription failed: {e}"}), 500
+            user_input_text = transcription
+        except Exception as e:
+            return jsonify({"error": f"Transcription failed: {e}"}), 500
     try:
-        reply, detail = process_user_input(conversation_id, user_input_text, language_code)
-        audio_path = generate_tts_response(reply, language_code)
-        with open(audio_path, "rb") as f:
-            base64_audio = base64.b64encode(f.read()).decode("utf-8")
+        reply, detail = process_user_input(conversation_id, user_input_text, language_code, data.get("turn_engine"))
+        return reply_response({
+            "user_input_text": user_input_text,
+            "reply_text": reply,
+            "detailed_response": detail,
+            "language_code": language_code,
+            "conversation_id": conversation_id
+        }, reply, language_code, data.get("response_format", "json"))
     except Exception as e:
         return jsonify({"error": f"Processing failed: {e}"}), 500
-    return jsonify({
-        "user_input_text": user_input_text,
-        "reply_text": reply,
-        "detailed_response": detail,
-        "reply_audio_path": audio_path,
-        "reply_audio_base64": base64_audio,
-        "language_code": language_code,
-        "conversation_id": conversation_id
-    })
 
 @ai_speech_to_text_gpt4o_bp.route('/text-assist', methods=['POST'])
 def text_assist():
@@ -182,25 +503,33 @@ def text_assist():
     if not user_input_text or not conversation_id:
         return jsonify({"error": "Missing user_input_text or conversation_id"}), 400
 
-    initialize_conversation(conversation_id)
-
     try:
-        reply, detail = process_user_input(conversation_id, user_input_text, language_code)
-        audio_path = generate_tts_response(reply, language_code)
-        with open(audio_path, "rb") as f:
-            base64_audio = base64.b64encode(f.read()).decode("utf-8")
+        reply, detail = process_user_input(conversation_id, user_input_text, language_code, data.get("turn_engine"))
+        return reply_response({
+            "user_input_text": user_input_text,
+            "reply_text": reply,
+            "detailed_response": detail,
+            "language_code": language_code,
+            "conversation_id": conversation_id
+        }, reply, language_code, data.get("response_format", "json"))
     except Exception as e:
         return jsonify({"error": f"Processing failed: {e}"}), 500
 
-    return jsonify({
-        "user_input_text": user_input_text,
-        "reply_text": reply,
-        "detailed_response": detail,
-        "reply_audio_path": audio_path,
-        "reply_audio_base64": base64_audio,
-        "language_code": language_code,
-        "conversation_id": conversation_id
-    })
+def sse_audio_event(segment_index, audio):
+    # Each event carries one complete MP3 segment; the id keeps segments ordered on the client
+    base64_audio = base64.b64encode(audio).decode("utf-8")
+    return f"id: {segment_index}\ndata: [AUDIO_BASE64] {base64_audio}\n\n"
+
+@ai_speech_to_text_gpt4o_bp.route('/response-cache/stats', methods=['GET'])
+def response_cache_stats_route():
+    return jsonify(response_cache_stats())
+
+@ai_speech_to_text_gpt4o_bp.route('/audio/<audio_id>', methods=['GET'])
+def reply_audio(audio_id):
+    path = reply_audio_store.path(audio_id) if reply_audio_store is not None else None
+    if path is None:
+        return jsonify({"error": "Audio not found."}), 404
+    return send_file(path, mimetype="audio/mpeg")
 
 @ai_speech_to_text_gpt4o_bp.route('/stream-text', methods=['POST'])
 def stream_text_assist():
@@ -210,17 +539,28 @@ def stream_text_assist():
     language_code = data.get("language_code", "en")
     if not user_input_text or not conversation_id:
         return jsonify({"error": "Missing user_input_text or conversation_id"}), 400
-    initialize_conversation(conversation_id)
-    reset_if_new_task(conversation_id, user_input_text)
-    conversation_store[conversation_id].append({"role": "user", "content": user_input_text})
+    new_intent = detect_task_type(user_input_text)
     def generate():
         collected = ""
+        splitter = SentenceSplitter()
+        pipeline = TTSPipeline(lambda sentence: synthesize_speech(sentence, language_code))
+        segment_index = 0
+        hold = None
         try:
-            # Step 1: stream GPT text output
-            response = client.chat.completions.create(
+            # The conversation stays locked until the reply is saved, so a second message waits for this
+            # reply instead of being answered from a history that lacks it
+            hold = conversations.hold(conversation_id, lambda: new_conversation(conversation_id))
+            conversation = hold.record
+            reset_if_new_task(conversation, user_input_text, new_intent)
+            conversation["messages"].append({"role": "user", "content": user_input_text})
+            hold.save()
+            # Step 1: stream GPT text output, handing each finished sentence to TTS
+            response = call_upstream(
+                "openai", client.chat.completions.create,
                 model="gpt-4o",
-                messages=conversation_store[conversation_id],
-                stream=True
+                messages=context_window.messages(conversation, "stream"),
+                stream=True,
+                timeout=upstream_timeout("chat")
             )
             for chunk in response:
                 delta = chunk.choices[0].delta
@@ -228,19 +568,28 @@ def stream_text_assist():
                     text = delta.content
                     collected += text
                     yield f"data: {text}\n\n"
-            # Step 2: save full response to history
-            conversation_store[conversation_id].append({"role": "assistant", "content": collected})
-            # Step 3: generate TTS
-            audio_path = generate_tts_response(collected, language_code)
-            # Step 4: stream audio as base64
-            with open(audio_path, "rb") as f:
-                while True:
-                    chunk = f.read(4096)
-                    if not chunk:
-                        break
-                    base64_chunk = base64.b64encode(chunk).decode("utf-8")
-                    yield f"data: [AUDIO_BASE64] {base64_chunk}\n\n"
+                    for sentence in splitter.feed(text):
+                        pipeline.submit(sentence)
+                # Step 2: emit any audio segments that are already synthesized, in order
+                for audio in pipeline.ready():
+                    yield sse_audio_event(segment_index, audio)
+                    segment_index += 1
+            for sentence in splitter.flush():
+                pipeline.submit(sentence)
+            # Step 3: save full response to history and let the next turn in
+            conversation["messages"].append({"role": "assistant", "content": collected})
+            log_conversation_turn(conversation)
+            hold.save()
+            hold.release()
+            # Step 4: wait for the remaining segments
+            for audio in pipeline.drain():
+                yield sse_audio_event(segment_index, audio)
+                segment_index += 1
         except Exception as e:
+            pipeline.cancel()
             yield f"data: [ERROR] {str(e)}\n\n"
+        finally:
+            # Also runs when the client disconnects mid-stream
+            if hold is not None:
+                hold.release()
     return Response(stream_with_context(generate()), mimetype="text/event-stream")
-
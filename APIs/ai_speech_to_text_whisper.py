@@ -1,72 +1,337 @@
-from flask import Flask, jsonify, request, Blueprint
-from openai import OpenAI
+from flask import Flask, Response, jsonify, request, Blueprint
+from contextlib import nullcontext
 from dotenv import load_dotenv
 import os
 import json
+import logging
+from transcription_cache import audio_cache_key, audio_file_cache_key, is_cache_key, transcription_cache
+from audio_segments import SegmentError, add_segment_urls, recordings, segment_times
+from transcript import Transcript
+from field_extraction import FIELD_LOOKUP_FUNCTION, extract_personal_info, extraction_stats
+from long_audio import LongAudioUnavailable, long_audio_min_bytes, missing_tools, transcribe_long_audio
+from upstream import call_upstream, openai_client, upstream_errors, upstream_timeout
+from structured_output import OutputSchema, StructuredOutputError, structured_call
+from uploads import AudioUpload, UploadError, flag, read_audio_request
+from tracing import traced
 
 ai_speech_to_text_whisper_bp = Blueprint('ai_speech_to_text_whisper_bp', __name__)
+logger = logging.getLogger(__name__)
 load_dotenv()
-client = OpenAI(api_key=os.getenv('openai_api_key'))
+client = openai_client
 
-@ai_speech_to_text_whisper_bp.route('/transcribe', methods=['POST'])
-def transcribe():
-    # Get the audio file path from the request
-    data = request.get_json()
-    audio_file_path = data.get('audio_file_path')
+WHISPER_MODEL = "whisper-1"
+WHISPER_GRANULARITIES = ("word",)
+# "local" resolves fields from sentence rules and sends only candidate sentences to the model;
+# "model" sends the whole transcription JSON to gpt-3.5-turbo as before
+field_extraction_mode = os.getenv("field_extraction", "local")
 
-    if not audio_file_path:
-        return jsonify({"error": "Audio file path not provided."}), 400
-    
-    print("Full Audio File Path:", audio_file_path)
+def _word_dict(word):
+    # Newer SDKs return pydantic word objects; keep the cached payload plain JSON
+    if isinstance(word, dict):
+        return word
+    return {"word": word.word, "start": word.start, "end": word.end}
 
-    # Open the audio file
-    try:
-        with open(audio_file_path, 'rb') as audio_file:
-            # Call OpenAI API to create the transcription
-            transcript = client.audio.transcriptions.create(
-                file=audio_file,
-                model="whisper-1",
-                response_format="verbose_json",
-                timestamp_granularities=["word"]
-            )
-    except FileNotFoundError:
-        return jsonify({"error": "Audio file not found."}), 404
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-    # Store transcription data directly
-    transcription_data = {
+def build_transcription_data(transcript):
+    return {
         'text': transcript.text,
         'task': transcript.task,
         'language': transcript.language,
         'duration': transcript.duration,
-        'words': transcript.words,
+        'words': [_word_dict(word) for word in transcript.words or []],
     }
 
+def build_transcript(transcript, cache_key):
+    return Transcript.from_transcription_data(build_transcription_data(transcript), cache_key)
+
+def transcript_payload(transcript):
+    # The /transcribe JSON, plus the id the player uses to query the stored transcript
+    return {**transcript.to_transcription_data(), "transcript_id": transcript.transcript_id}
+
+def whisper_request(audio_file_path, audio):
+    # audio is the recording's bytes or a seekable file object such as a spooled upload
+    return dict(
+        file=(os.path.basename(audio_file_path), audio),
+        model=WHISPER_MODEL,
+        response_format="verbose_json",
+        timestamp_granularities=list(WHISPER_GRANULARITIES)
+    )
+
+def read_audio_cached(audio_file_path):
+    with open(audio_file_path, 'rb') as audio_file:
+        audio_bytes = audio_file.read()
+    cache_key = audio_cache_key(audio_bytes, WHISPER_MODEL, WHISPER_GRANULARITIES)
+    return audio_bytes, cache_key, transcription_cache.get(cache_key)
+
+def transcribe_chunk(chunk_name, audio_bytes):
+    transcript = call_upstream(
+        "openai", client.audio.transcriptions.create,
+        **whisper_request(chunk_name, audio_bytes), timeout=upstream_timeout("transcription")
+    )
+    return build_transcription_data(transcript)
+
+def use_long_audio(audio_file_path, long_audio=None, size=None):
+    # Explicit request flag wins; otherwise switch over for files near the upload limit
+    if long_audio is not None and not long_audio:
+        return False
+    if long_audio is None and (os.path.getsize(audio_file_path) if size is None else size) < long_audio_min_bytes:
+        return False
+    missing = missing_tools()
+    if not missing:
+        return True
+    if long_audio:
+        raise LongAudioUnavailable(f"long_audio needs {' and '.join(missing)} on PATH.")
+    # Chunking was only chosen for the size; a single request still works up to Whisper's own limit
+    logger.warning("Transcribing in one request: %s not on PATH", " and ".join(missing))
+    return False
+
+def transcribe_long_file(audio_file_path):
+    cache_key = audio_file_cache_key(audio_file_path, WHISPER_MODEL + ":chunked-v2", WHISPER_GRANULARITIES)
+    cached = transcription_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    transcription_data = transcribe_long_audio(audio_file_path, transcribe_chunk)
+    transcript = Transcript.from_transcription_data(transcription_data, cache_key)
+    transcription_cache.put(cache_key, transcript)
+    return transcript
+
+def transcribe_file(audio_file_path, long_audio=None):
+    if use_long_audio(audio_file_path, long_audio):
+        return transcribe_long_file(audio_file_path)
+    audio_bytes, cache_key, cached = read_audio_cached(audio_file_path)
+    if cached is not None:
+        return cached
+
+    # Call OpenAI API to create the transcription
+    transcript = call_upstream(
+        "openai", client.audio.transcriptions.create,
+        **whisper_request(audio_file_path, audio_bytes), timeout=upstream_timeout("transcription")
+    )
+
+    transcript = build_transcript(transcript, cache_key)
+    transcription_cache.put(cache_key, transcript)
+    return transcript
+
+def transcribe_upload(upload, long_audio=None):
+    if use_long_audio(None, long_audio, size=upload.size):
+        with upload.local_path() as audio_file_path:
+            return transcribe_long_file(audio_file_path)
+    cache_key = upload.cache_key(WHISPER_MODEL, WHISPER_GRANULARITIES)
+    cached = transcription_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    # The spooled upload is streamed to Whisper as is, without reading it into memory
+    transcript = call_upstream(
+        "openai", client.audio.transcriptions.create,
+        **whisper_request(upload.upload_name, upload.file), timeout=upstream_timeout("transcription")
+    )
+    transcript = build_transcript(transcript, cache_key)
+    transcription_cache.put(cache_key, transcript)
+    return transcript
+
+@traced("transcribe")
+def transcribe_source(audio_source, long_audio=None):
+    # audio_source is either a server-side path or an uploaded recording
+    if isinstance(audio_source, AudioUpload):
+        transcript = transcribe_upload(audio_source, long_audio)
+    else:
+        transcript = transcribe_file(audio_source, long_audio)
+    remember_recording(transcript, audio_source)
+    return transcript
+
+def remember_recording(transcript, audio_source):
+    # Kept under the transcript id so /segment can serve the spans fields are spoken in.
+    # Best effort: the transcription has already succeeded, so a storage problem only loses the segments
+    if recordings is None:
+        return
+    try:
+        recordings.add(transcript.transcript_id, audio_source)
+    except OSError as e:
+        logger.warning("Could not store recording %s: %s", transcript.transcript_id, e)
+
+def playback_payload(fields, transcript):
+    fields = {**fields, "transcript_id": transcript.transcript_id}
+    if recordings is not None and recordings.path(transcript.transcript_id) is not None:
+        add_segment_urls(fields, transcript.transcript_id)
+    return fields
+
+@ai_speech_to_text_whisper_bp.route('/transcribe', methods=['POST'])
+def transcribe():
+    # Accept {"audio_file_path": ...} JSON, a multipart "file" upload or a raw audio body
+    try:
+        data, upload = read_audio_request(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    with upload or nullcontext():
+        audio_source = upload or data.get('audio_file_path')
+        if not audio_source:
+            return jsonify({"error": "Audio file path not provided."}), 400
+
+        logger.info("Transcribing %s", upload.filename if upload else audio_source)
+
+        try:
+            transcript = transcribe_source(audio_source, flag(data.get('long_audio')))
+        except FileNotFoundError:
+            return jsonify({"error": "Audio file not found."}), 404
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+
     # Return the transcription as JSON
-    return jsonify(transcription_data)
+    return jsonify(transcript_payload(transcript))
 
-@ai_speech_to_text_whisper_bp.route('/playback', methods=['POST'])
-def playback():
-    # Get the audio file path from the request
-    data = request.get_json()
-    audio_file_path = data.get('audio_file_path')
+@ai_speech_to_text_whisper_bp.route('/transcription-cache/stats', methods=['GET'])
+def transcription_cache_stats():
+    return jsonify(transcription_cache.stats())
+
+def stored_transcript(transcript_id):
+    if not is_cache_key(transcript_id):
+        return None
+    return transcription_cache.get(transcript_id)
 
-    if not audio_file_path:
-        return jsonify({"error": "Audio file path not provided."}), 400
-    
-    # Call the transcribe API internally
-    transcribe_response = transcribe_internal(audio_file_path)
+def time_arg(args, name):
+    try:
+        return float(args[name])
+    except (KeyError, ValueError):
+        raise ValueError(f"'{name}' must be a number of seconds.")
 
-    if 'error' in transcribe_response:
-        return transcribe_response  # Pass through error from /transcribe
+def word_at_payload(transcript, args):
+    index = transcript.index_at(time_arg(args, "t"))
+    return {"index": index, "word": None if index is None else transcript.word(index)}
 
-    transcription_data = transcribe_response
+def words_between_payload(transcript, args):
+    indices = transcript.indices_between(time_arg(args, "start"), time_arg(args, "end"))
+    return {"indices": indices, "words": [transcript.word(index) for index in indices]}
 
-    print("**********")
-    print(transcription_data)
-    print("**********")
+def wants_binary(request):
+    return request.accept_mimetypes.best_match(["application/json", "application/octet-stream"]) == "application/octet-stream"
 
+@ai_speech_to_text_whisper_bp.route('/transcript/<transcript_id>', methods=['GET'])
+def get_transcript(transcript_id):
+    transcript = stored_transcript(transcript_id)
+    if transcript is None:
+        return jsonify({"error": "Transcript not found."}), 404
+    if wants_binary(request):
+        return Response(transcript.to_bytes(), mimetype="application/octet-stream")
+    return jsonify(transcript_payload(transcript))
+
+@ai_speech_to_text_whisper_bp.route('/transcript/<transcript_id>/at', methods=['GET'])
+def transcript_word_at(transcript_id):
+    # The word playing at ?t=<seconds>, for highlighting during playback
+    transcript = stored_transcript(transcript_id)
+    if transcript is None:
+        return jsonify({"error": "Transcript not found."}), 404
+    try:
+        return jsonify(word_at_payload(transcript, request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@ai_speech_to_text_whisper_bp.route('/transcript/<transcript_id>/words', methods=['GET'])
+def transcript_words_between(transcript_id):
+    # The words spoken between ?start= and ?end= seconds, e.g. a field's sentence
+    transcript = stored_transcript(transcript_id)
+    if transcript is None:
+        return jsonify({"error": "Transcript not found."}), 404
+    try:
+        return jsonify(words_between_payload(transcript, request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@ai_speech_to_text_whisper_bp.route('/segment/<audio_id>', methods=['GET'])
+def audio_segment(audio_id):
+    # ?start_time=&end_time= from a field's sentence_info; Range requests address bytes within the segment
+    if recordings is None:
+        return jsonify({"error": "Recording store is disabled."}), 404
+    try:
+        start_time, end_time = segment_times(request.args)
+        audio, mime_type = recordings.segment(audio_id, start_time, end_time)
+    except SegmentError as e:
+        return jsonify({"error": str(e)}), e.status
+    response = Response(audio, mimetype=mime_type)
+    response.set_etag(f"{audio_id}-{start_time:g}-{end_time:g}")
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(audio))
+
+@ai_speech_to_text_whisper_bp.route('/playback/extraction-stats', methods=['GET'])
+def playback_extraction_stats():
+    return jsonify(extraction_stats)
+
+PERSONAL_INFO_FUNCTION = {
+    "name": "fn_set_personal_info", 
+    "parameters": {
+        "type": "object",
+        "properties": {
+            "data": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "first_name": {
+                            "type": "object",
+                            "properties": {
+                                "value": {"type": "string"},
+                                "sentence_info": {
+                                    "type": "object",
+                                    "properties": {
+                                        "sentence_spoken": {
+                                            "type": "object",
+                                            "properties": {
+                                                "value": {"type": "string"},
+                                                "start_time": {"type": "number"},
+                                                "end_time": {"type": "number"}
+                                            }
+                                        }
+                                    }
+                                }
+                            }
+                        },
+                        "last_name": {
+                            "type": "object",
+                            "properties": {
+                                "value": {"type": "string"},
+                                "sentence_info": {
+                                    "type": "object",
+                                    "properties": {
+                                        "sentence_spoken": {
+                                            "type": "object",
+                                            "properties": {
+                                                "value": {"type": "string"},
+                                                "start_time": {"type": "number"},
+                                                "end_time": {"type": "number"}
+                                            }
+                                        }
+                                    }
+                                }
+                            }
+                        },
+                        "no_of_dependents": {
+                            "type": "object",
+                            "properties": {
+                                "value": {"type": "integer"},
+                                "sentence_info": {
+                                    "type": "object",
+                                    "properties": {
+                                        "sentence_spoken": {
+                                            "type": "object",
+                                            "properties": {
+                                                "value": {"type": "string"},
+                                                "start_time": {"type": "number"},
+                                                "end_time": {"type": "number"}
+                                            }
+                                        }
+                                    }
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+}
+
+PERSONAL_INFO = OutputSchema(PERSONAL_INFO_FUNCTION)
+FIELD_LOOKUP = OutputSchema(FIELD_LOOKUP_FUNCTION)
+
+def playback_messages(transcription_data):
     prompt = f"""
     Analyze the transcription data JSON: {json.dumps(transcription_data)} 
     and return a JSON array with the following schema:
@@ -105,104 +370,77 @@ def playback():
     }}
     ]
     """
+    return [
+        {"role": "system", "content": "You are a helpful assistant that infers personal data from transcriptions."},
+        {"role": "user", "content": prompt},
+    ]
+
+def ask_model_for_fields(messages):
+    try:
+        return structured_call(
+            FIELD_LOOKUP, "openai", client.chat.completions.create,
+            model="gpt-3.5-turbo",
+            messages=messages,
+            timeout=upstream_timeout("classify")
+        )
+    except upstream_errors() + (StructuredOutputError,) as e:
+        # The fields the rules did not find are reported missing
+        logger.warning("Field lookup failed: %s", e)
+        return {}
+
+@traced("extract_fields")
+def extract_fields(transcript):
+    if field_extraction_mode == "local":
+        # Rules first; only the few candidate sentences are sent to the model when needed
+        return extract_personal_info(transcript, ask_model_for_fields)
 
     # Make the API call to the OpenAI model to generate a response
-    completion = client.chat.completions.create(
+    fields = structured_call(
+        PERSONAL_INFO, "openai", client.chat.completions.create,
         model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant that infers personal data from transcriptions."},
-            {"role": "user", "content": prompt},
-        ],
-        functions=[{
-            "name": "fn_set_personal_info", 
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "data": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "first_name": {
-                                    "type": "object",
-                                    "properties": {
-                                        "value": {"type": "string"},
-                                        "sentence_info": {
-                                            "type": "object",
-                                            "properties": {
-                                                "sentence_spoken": {
-                                                    "type": "object",
-                                                    "properties": {
-                                                        "value": {"type": "string"},
-                                                        "start_time": {"type": "number"},
-                                                        "end_time": {"type": "number"}
-                                                    }
-                                                }
-                                            }
-                                        }
-                                    }
-                                },
-                                "last_name": {
-                                    "type": "object",
-                                    "properties": {
-                                        "value": {"type": "string"},
-                                        "sentence_info": {
-                                            "type": "object",
-                                            "properties": {
-                                                "sentence_spoken": {
-                                                    "type": "object",
-                                                    "properties": {
-                                                        "value": {"type": "string"},
-                                                        "start_time": {"type": "number"},
-                                                        "end_time": {"type": "number"}
-                                                    }
-                                                }
-                                            }
-                                        }
-                                    }
-                                },
-                                "no_of_dependents": {
-                                    "type": "object",
-                                    "properties": {
-                                        "value": {"type": "integer"},
-                                        "sentence_info": {
-                                            "type": "object",
-                                            "properties": {
-                                                "sentence_spoken": {
-                                                    "type": "object",
-                                                    "properties": {
-                                                        "value": {"type": "string"},
-                                                        "start_time": {"type": "number"},
-                                                        "end_time": {"type": "number"}
-                                                    }
-                                                }
-                                            }
-                                        }
-                                    }
-                                }
-                            }
-                        }
-                    }
-                }
-            }
-        }]
+        messages=playback_messages(transcript.to_transcription_data()),
+        timeout=upstream_timeout("chat")
     )
 
-    print("==============")
-    print(completion)
-    print("==============")
+    logger.debug("Playback fields: %s", fields)
+
+    return fields
+
+@ai_speech_to_text_whisper_bp.route('/playback', methods=['POST'])
+def playback():
+    # Get the audio file path, or the uploaded audio, from the request
+    try:
+        data, upload = read_audio_request(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    with upload or nullcontext():
+        audio_source = upload or data.get('audio_file_path')
+        if not audio_source:
+            return jsonify({"error": "Audio file path not provided."}), 400
 
-    # Handle the response
+        # Call the transcribe API internally
+        transcribe_response = transcribe_internal(audio_source, flag(data.get('long_audio')))
+
+    if isinstance(transcribe_response, dict):
+        return jsonify(transcribe_response), 500  # Pass through error from /transcribe
+
+    transcript = transcribe_response
+
+    logger.debug("Playback transcription: %s", transcript.text)
+
+    # Handle the response; the transcript id lets the player seek and highlight the fields' sentences
     try:
-        generated_text = completion.choices[0].message.function_call.arguments
-        return json.loads(generated_text)
+        return playback_payload(extract_fields(transcript), transcript)
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.exception("Field extraction failed: %s", e)
         return jsonify({"error": "Failed to process the request."}), 500
 
-def transcribe_internal(audio_file_path):
+def transcribe_internal(audio_source, long_audio=None):
     # Function to handle internal calls to the transcribe API
-    data = {'audio_file_path': audio_file_path}
-    response = transcribe()  # Call the transcribe function directly
-    return response.get_json()  # Extract JSON data from the response
-
+    try:
+        return transcribe_source(audio_source, long_audio)
+    except FileNotFoundError:
+        return {"error": "Audio file not found."}
+    except Exception as e:
+        return {"error": str(e)}
@@ -0,0 +1,559 @@
+from quart import Quart, Blueprint, Response, g, jsonify, request, send_file
+from contextlib import nullcontext
+from dotenv import load_dotenv
+import asyncio
+import logging
+import os
+import uuid
+
+import ai_speech_to_text_whisper as whisper
+import ai_speech_to_text_gpt4o as gpt4o
+import ai_speech_to_text_gemini as gemini
+from audio_segments import SegmentError, recordings, segment_times
+from field_extraction import FieldExtraction, extraction_stats
+from structured_output import StructuredOutputError, structured_call_async
+from tts_pipeline import AsyncTTSPipeline, SentenceSplitter
+from transcription_cache import transcription_cache
+from response_cache import intent_cache, intent_cache_key, response_cache_stats, tts_cache
+from conversation_store import coalesced_turns
+from providers import provider_enabled, warm_up, warmup_providers
+from tracing import configure_logging, finish_trace, render_metrics, start_trace, traced
+from uploads import UploadError, flag, read_audio_request_async, upload_max_bytes
+from upstream import (
+    async_openai_client, call_upstream_async, upstream_errors, upstream_limit, upstream_metrics, upstream_timeout
+)
+
+load_dotenv()
+
+async_whisper_bp = Blueprint('async_whisper_bp', __name__)
+async_gpt4o_bp = Blueprint('async_gpt4o_bp', __name__)
+async_gemini_bp = Blueprint('async_gemini_bp', __name__)
+logger = logging.getLogger(__name__)
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+async def transcribe_file_async(audio_file_path, long_audio=None):
+    if await asyncio.to_thread(whisper.use_long_audio, audio_file_path, long_audio):
+        # Chunking runs ffmpeg and its own bounded pool of Whisper calls
+        return await asyncio.to_thread(whisper.transcribe_long_file, audio_file_path)
+    audio_bytes, cache_key, cached = await asyncio.to_thread(whisper.read_audio_cached, audio_file_path)
+    if cached is not None:
+        return cached
+    async with upstream_limit("openai"):
+        transcript = await call_upstream_async(
+            "openai", async_openai_client.audio.transcriptions.create,
+            **whisper.whisper_request(audio_file_path, audio_bytes), timeout=upstream_timeout("transcription")
+        )
+    transcript = whisper.build_transcript(transcript, cache_key)
+    await asyncio.to_thread(transcription_cache.put, cache_key, transcript)
+    return transcript
+
+
+@traced("transcribe")
+async def transcribe_source_async(audio_source, long_audio=None):
+    transcript = await transcribe_new_source_async(audio_source, long_audio)
+    await asyncio.to_thread(whisper.remember_recording, transcript, audio_source)
+    return transcript
+
+
+async def transcribe_new_source_async(audio_source, long_audio=None):
+    if isinstance(audio_source, str):
+        return await transcribe_file_async(audio_source, long_audio)
+    if whisper.use_long_audio(None, long_audio, size=audio_source.size):
+        return await asyncio.to_thread(whisper.transcribe_upload, audio_source, long_audio)
+    cache_key = audio_source.cache_key(whisper.WHISPER_MODEL, whisper.WHISPER_GRANULARITIES)
+    cached = await asyncio.to_thread(transcription_cache.get, cache_key)
+    if cached is not None:
+        return cached
+    async with upstream_limit("openai"):
+        transcript = await call_upstream_async(
+            "openai", async_openai_client.audio.transcriptions.create,
+            **whisper.whisper_request(audio_source.upload_name, audio_source.file),
+            timeout=upstream_timeout("transcription")
+        )
+    transcript = whisper.build_transcript(transcript, cache_key)
+    await asyncio.to_thread(transcription_cache.put, cache_key, transcript)
+    return transcript
+
+
+async def read_audio_source(request):
+    # Returns (data, upload, audio_source); upload is None for {"audio_file_path": ...} requests
+    data, upload = await read_audio_request_async(request)
+    return data, upload, upload or data.get('audio_file_path')
+
+
+@async_whisper_bp.route('/transcribe', methods=['POST'])
+async def transcribe():
+    try:
+        data, upload, audio_source = await read_audio_source(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    if not audio_source:
+        return jsonify({"error": "Audio file path not provided."}), 400
+    try:
+        with upload or nullcontext():
+            transcript = await transcribe_source_async(audio_source, flag(data.get('long_audio')))
+    except FileNotFoundError:
+        return jsonify({"error": "Audio file not found."}), 404
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    return jsonify(whisper.transcript_payload(transcript))
+
+
+@async_whisper_bp.route('/transcription-cache/stats', methods=['GET'])
+async def transcription_cache_stats():
+    return jsonify(transcription_cache.stats())
+
+
+@async_whisper_bp.route('/transcript/<transcript_id>', methods=['GET'])
+async def get_transcript(transcript_id):
+    transcript = await asyncio.to_thread(whisper.stored_transcript, transcript_id)
+    if transcript is None:
+        return jsonify({"error": "Transcript not found."}), 404
+    if whisper.wants_binary(request):
+        return Response(transcript.to_bytes(), mimetype="application/octet-stream")
+    return jsonify(whisper.transcript_payload(transcript))
+
+
+@async_whisper_bp.route('/transcript/<transcript_id>/at', methods=['GET'])
+async def transcript_word_at(transcript_id):
+    transcript = await asyncio.to_thread(whisper.stored_transcript, transcript_id)
+    if transcript is None:
+        return jsonify({"error": "Transcript not found."}), 404
+    try:
+        return jsonify(whisper.word_at_payload(transcript, request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@async_whisper_bp.route('/transcript/<transcript_id>/words', methods=['GET'])
+async def transcript_words_between(transcript_id):
+    transcript = await asyncio.to_thread(whisper.stored_transcript, transcript_id)
+    if transcript is None:
+        return jsonify({"error": "Transcript not found."}), 404
+    try:
+        return jsonify(whisper.words_between_payload(transcript, request.args))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+
+@async_whisper_bp.route('/segment/<audio_id>', methods=['GET'])
+async def audio_segment(audio_id):
+    if recordings is None:
+        return jsonify({"error": "Recording store is disabled."}), 404
+    try:
+        start_time, end_time = segment_times(request.args)
+        audio, mime_type = await asyncio.to_thread(recordings.segment, audio_id, start_time, end_time)
+    except SegmentError as e:
+        return jsonify({"error": str(e)}), e.status
+    response = Response(audio, mimetype=mime_type)
+    response.set_etag(f"{audio_id}-{start_time:g}-{end_time:g}")
+    return await response.make_conditional(request, accept_ranges=True, complete_length=len(audio))
+
+
+@async_whisper_bp.route('/playback/extraction-stats', methods=['GET'])
+async def playback_extraction_stats():
+    return jsonify(extraction_stats)
+
+
+@traced("extract_fields")
+async def extract_fields_async(transcript):
+    if whisper.field_extraction_mode == "local":
+        extraction = FieldExtraction(transcript)
+        if extraction.needs_model():
+            try:
+                answer = await structured_call_async(
+                    whisper.FIELD_LOOKUP, "openai", async_openai_client.chat.completions.create,
+                    model="gpt-3.5-turbo",
+                    messages=extraction.model_messages(),
+                    timeout=upstream_timeout("classify")
+                )
+            except upstream_errors() + (StructuredOutputError,) as e:
+                # The fields the rules did not find are reported missing
+                logger.warning("Field lookup failed: %s", e)
+                answer = {}
+            extraction.apply_model_answer(answer)
+        return extraction.result()
+    return await structured_call_async(
+        whisper.PERSONAL_INFO, "openai", async_openai_client.chat.completions.create,
+        model="gpt-3.5-turbo",
+        messages=whisper.playback_messages(transcript.to_transcription_data()),
+        timeout=upstream_timeout("chat")
+    )
+
+
+@async_whisper_bp.route('/playback', methods=['POST'])
+async def playback():
+    try:
+        data, upload, audio_source = await read_audio_source(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    if not audio_source:
+        return jsonify({"error": "Audio file path not provided."}), 400
+    try:
+        with upload or nullcontext():
+            transcript = await transcribe_source_async(audio_source, flag(data.get('long_audio')))
+    except FileNotFoundError:
+        return jsonify({"error": "Audio file not found."}), 500
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+    try:
+        return whisper.playback_payload(await extract_fields_async(transcript), transcript)
+    except Exception as e:
+        logger.exception("Field extraction failed: %s", e)
+        return jsonify({"error": "Failed to process the request."}), 500
+
+
+@traced("detect_task_type")
+async def detect_task_type_async(user_input_text):
+    cache_key = intent_cache_key(user_input_text, "gpt-4o")
+    cached = await asyncio.to_thread(intent_cache.get, cache_key)
+    if cached is not None:
+        return cached
+    try:
+        result = await structured_call_async(
+            gpt4o.TASK_TYPE, "openai", async_openai_client.chat.completions.create,
+            model="gpt-4o", messages=gpt4o.task_type_messages(user_input_text), timeout=upstream_timeout("classify")
+        )
+        intent = result["intent"]
+    except upstream_errors() + (StructuredOutputError,) as e:
+        logger.warning("Task type detection failed: %s", e)
+        return "unknown"
+    await asyncio.to_thread(intent_cache.put, cache_key, intent)
+    return intent
+
+
+async def process_user_input_async(conversation_id, user_input_text, language_code, turn_engine=None):
+    turn_engine = turn_engine or gpt4o.default_turn_engine
+    if turn_engine != "single_pass":
+        # The legacy multi-call engine is only kept for A/B runs, so it stays on a thread
+        return await asyncio.to_thread(
+            gpt4o.process_user_input, conversation_id, user_input_text, language_code, turn_engine
+        )
+    return await coalesced_turns.run_async(
+        gpt4o.turn_key(conversation_id, user_input_text, language_code, turn_engine),
+        lambda: run_turn_async(conversation_id, user_input_text)
+    )
+
+
+async def run_turn_async(conversation_id, user_input_text):
+    async with gpt4o.conversation_session_async(conversation_id) as conversation:
+        gpt4o.begin_turn(conversation, user_input_text)
+        result = await traced("turn")(structured_call_async)(
+            gpt4o.TURN_RESULT, "openai", async_openai_client.chat.completions.create,
+            model="gpt-4o",
+            messages=gpt4o.turn_messages(conversation),
+            timeout=upstream_timeout("chat")
+        )
+        return await asyncio.to_thread(gpt4o.apply_turn_result, conversation, result)
+
+
+@traced("tts")
+async def synthesize_speech_async(text, language_code):
+    cache_key = gpt4o.speech_cache_key(text, language_code)
+    cached = await asyncio.to_thread(tts_cache.get, cache_key) if cache_key else None
+    if cached is not None:
+        return cached
+    voice = gpt4o.voice_mapping.get(language_code, "nova")
+    async with upstream_limit("openai"):
+        tts_result = await call_upstream_async(
+            "openai", async_openai_client.audio.speech.create,
+            model="tts-1", voice=voice, input=text, timeout=upstream_timeout("speech")
+        )
+    if cache_key:
+        await asyncio.to_thread(tts_cache.put, cache_key, tts_result.content)
+    return tts_result.content
+
+
+async def cached_speech_stream(audio, audio_id, chunk_size):
+    for chunk in gpt4o.iter_cached_audio(audio, chunk_size):
+        yield chunk
+    if audio_id:
+        await asyncio.to_thread(gpt4o.reply_audio_store.put, audio, audio_id)
+
+
+async def open_speech_stream_async(text, language_code, audio_id, chunk_size=16384):
+    cache_key = gpt4o.speech_cache_key(text, language_code)
+    cached = await asyncio.to_thread(tts_cache.get, cache_key) if cache_key else None
+    if cached is not None:
+        return cached_speech_stream(cached, audio_id, chunk_size)
+    voice = gpt4o.voice_mapping.get(language_code, "nova")
+
+    async def speech_stream():
+        manager = async_openai_client.audio.speech.with_streaming_response.create(
+            model="tts-1", voice=voice, input=text, timeout=upstream_timeout("speech")
+        )
+        return manager, await manager.__aenter__()
+
+    async def chunks():
+        # The upstream slot and the streaming response are only taken once the body is read, so a body
+        # that is never iterated (the client left first) holds neither
+        buffered = []
+        async with upstream_limit("openai"):
+            manager, tts_result = await call_upstream_async("openai", speech_stream)
+            try:
+                async for chunk in tts_result.iter_bytes(chunk_size):
+                    if audio_id or cache_key:
+                        buffered.append(chunk)
+                    yield chunk
+            finally:
+                await manager.__aexit__(None, None, None)
+        if cache_key:
+            await asyncio.to_thread(tts_cache.put, cache_key, b"".join(buffered))
+        if audio_id:
+            await asyncio.to_thread(gpt4o.reply_audio_store.put, b"".join(buffered), audio_id)
+    return chunks()
+
+
+async def reply_response_async(payload, reply, language_code, response_format):
+    audio_id = uuid.uuid4().hex if gpt4o.reply_audio_store is not None else None
+    if response_format == "binary":
+        chunks = await open_speech_stream_async(reply, language_code, audio_id)
+        headers = gpt4o.binary_reply_headers(payload, reply, language_code, audio_id)
+        return Response(chunks, mimetype="audio/mpeg", headers=headers)
+    if response_format == "multipart":
+        payload["reply_audio_id"] = audio_id
+        boundary = uuid.uuid4().hex
+        head, tail = gpt4o.multipart_reply_parts(boundary, payload)
+        chunks = await open_speech_stream_async(reply, language_code, audio_id)
+        async def parts():
+            yield head
+            async for chunk in chunks:
+                yield chunk
+            yield tail
+        return Response(parts(), mimetype=f"multipart/mixed; boundary={boundary}")
+    audio = await synthesize_speech_async(reply, language_code)
+    payload = await asyncio.to_thread(gpt4o.json_reply_payload, payload, audio, audio_id)
+    return jsonify(payload)
+
+
+async def assist_reply(data, user_input_text, conversation_id, language_code):
+    try:
+        reply, detail = await process_user_input_async(
+            conversation_id, user_input_text, language_code, data.get("turn_engine")
+        )
+        return await reply_response_async({
+            "user_input_text": user_input_text,
+            "reply_text": reply,
+            "detailed_response": detail,
+            "language_code": language_code,
+            "conversation_id": conversation_id
+        }, reply, language_code, data.get("response_format", "json"))
+    except Exception as e:
+        return jsonify({"error": f"Processing failed: {e}"}), 500
+
+
+@async_gpt4o_bp.route('/voice-assist', methods=['POST'])
+async def voice_assist():
+    try:
+        data, upload, audio_source = await read_audio_source(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    conversation_id = data.get("conversation_id")
+    language_code = data.get("language_code", "en")
+    if not audio_source or not conversation_id:
+        if upload:
+            upload.close()
+        return jsonify({"error": "Missing audio_file_path or conversation_id"}), 400
+    try:
+        with upload or nullcontext():
+            if upload:
+                audio_file = (upload.upload_name, upload.file)
+            else:
+                audio_file = (os.path.basename(audio_source), await asyncio.to_thread(read_file, audio_source))
+            async with upstream_limit("openai"):
+                user_input_text = await call_upstream_async(
+                    "openai", async_openai_client.audio.transcriptions.create,
+                    file=audio_file,
+                    model="whisper-1",
+                    response_format="text",
+                    language=language_code,
+                    timeout=upstream_timeout("transcription")
+                )
+    except Exception as e:
+        return jsonify({"error": f"Transcription failed: {e}"}), 500
+    return await assist_reply(data, user_input_text, conversation_id, language_code)
+
+
+@async_gpt4o_bp.route('/text-assist', methods=['POST'])
+async def text_assist():
+    data = await request.get_json()
+    user_input_text = data.get("user_input_text")
+    conversation_id = data.get("conversation_id")
+    language_code = data.get("language_code", "en")
+    if not user_input_text or not conversation_id:
+        return jsonify({"error": "Missing user_input_text or conversation_id"}), 400
+    return await assist_reply(data, user_input_text, conversation_id, language_code)
+
+
+@async_gpt4o_bp.route('/response-cache/stats', methods=['GET'])
+async def response_cache_stats_route():
+    return jsonify(response_cache_stats())
+
+
+@async_gpt4o_bp.route('/audio/<audio_id>', methods=['GET'])
+async def reply_audio(audio_id):
+    store = gpt4o.reply_audio_store
+    path = store.path(audio_id) if store is not None else None
+    if path is None:
+        return jsonify({"error": "Audio not found."}), 404
+    return await send_file(path, mimetype="audio/mpeg")
+
+
+@async_gpt4o_bp.route('/stream-text', methods=['POST'])
+async def stream_text_assist():
+    data = await request.get_json()
+    user_input_text = data.get("user_input_text")
+    conversation_id = data.get("conversation_id")
+    language_code = data.get("language_code", "en")
+    if not user_input_text or not conversation_id:
+        return jsonify({"error": "Missing user_input_text or conversation_id"}), 400
+    new_intent = await detect_task_type_async(user_input_text)
+
+    async def generate():
+        collected = ""
+        pipeline = AsyncTTSPipeline(lambda sentence: synthesize_speech_async(sentence, language_code))
+        splitter = SentenceSplitter()
+        segment_index = 0
+        hold = None
+        try:
+            # Held until the reply is saved, as in the Flask route
+            hold = await gpt4o.conversations.hold_async(conversation_id, lambda: gpt4o.new_conversation(conversation_id))
+            conversation = hold.record
+            gpt4o.reset_if_new_task(conversation, user_input_text, new_intent)
+            conversation["messages"].append({"role": "user", "content": user_input_text})
+            await hold.save_async()
+            async with upstream_limit("openai"):
+                response = await call_upstream_async(
+                    "openai", async_openai_client.chat.completions.create,
+                    model="gpt-4o",
+                    messages=gpt4o.context_window.messages(conversation, "stream"),
+                    stream=True,
+                    timeout=upstream_timeout("chat")
+                )
+                async for chunk in response:
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        text = delta.content
+                        collected += text
+                        yield f"data: {text}\n\n"
+                        for sentence in splitter.feed(text):
+                            pipeline.submit(sentence)
+                    for audio in pipeline.ready():
+                        yield gpt4o.sse_audio_event(segment_index, audio)
+                        segment_index += 1
+            for sentence in splitter.flush():
+                pipeline.submit(sentence)
+            conversation["messages"].append({"role": "assistant", "content": collected})
+            await asyncio.to_thread(gpt4o.log_conversation_turn, conversation)
+            await hold.save_async()
+            await hold.release_async()
+            async for audio in pipeline.drain():
+                yield gpt4o.sse_audio_event(segment_index, audio)
+                segment_index += 1
+        except Exception as e:
+            pipeline.cancel()
+            yield f"data: [ERROR] {str(e)}\n\n"
+        finally:
+            if hold is not None:
+                await hold.release_async()
+    return Response(generate(), mimetype="text/event-stream")
+
+
+async def gemini_request_async(request):
+    data, upload, audio_source = await read_audio_source(request)
+    if not audio_source:
+        raise UploadError("Audio file path not provided.")
+    audio_data, mime_type = await asyncio.to_thread(gemini.read_gemini_audio, upload, data.get('audio_file_path'))
+    return audio_data, mime_type, data.get('keyword', "test")
+
+
+@async_gemini_bp.route('/transcribe', methods=['POST'])
+async def gemini_transcribe():
+    try:
+        audio_data, mime_type, keyword = await gemini_request_async(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+    async with upstream_limit("vertex"):
+        response = await call_upstream_async(
+            "vertex", gemini.model.generate_content_async, gemini.gemini_contents(audio_data, keyword, mime_type)
+        )
+    return jsonify(gemini.words_payload(gemini.parse_word_timestamps(response)))
+
+
+@async_gemini_bp.route('/stream-transcribe', methods=['POST'])
+async def gemini_stream_transcribe():
+    try:
+        audio_data, mime_type, keyword = await gemini_request_async(request)
+    except UploadError as e:
+        return jsonify({"error": str(e)}), e.status
+
+    async def generate():
+        parser = gemini.WordTimestampParser()
+        index = 0
+        try:
+            async with upstream_limit("vertex"):
+                chunks = await call_upstream_async(
+                    "vertex", gemini.model.generate_content_async,
+                    gemini.gemini_contents(audio_data, keyword, mime_type), stream=True
+                )
+                async for chunk in chunks:
+                    for word in parser.feed(gemini.response_text(chunk)):
+                        yield gemini.sse_word_event(index, word)
+                        index += 1
+            parser.finish()
+            yield "data: [DONE]\n\n"
+        except Exception as e:
+            yield f"data: [ERROR] {str(e)}\n\n"
+    return Response(generate(), mimetype="text/event-stream")
+
+
+configure_logging()
+app = Quart(__name__)
+# Uploads are size-checked while they stream in; this only stops Quart's own default 16 MB cap
+app.config["MAX_CONTENT_LENGTH"] = upload_max_bytes
+
+
+@app.route('/upstream/stats', methods=['GET'])
+async def upstream_stats():
+    return jsonify(upstream_metrics())
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.before_request
+async def begin_trace():
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace = start_trace(route, request.headers.get("X-Request-Id"))
+
+
+@app.after_request
+async def end_trace(response):
+    trace = g.pop("trace", None)
+    if trace is not None:
+        response.headers["X-Request-Id"] = trace.request_id
+        # Streamed bodies are still being sent here, so their duration is time to first byte
+        finish_trace(trace, response.status_code)
+    return response
+
+
+# register blueprints for each API
+if provider_enabled("openai"):
+    app.register_blueprint(async_whisper_bp)
+    app.register_blueprint(async_gpt4o_bp)
+if provider_enabled("gemini"):
+    # Mounted under /gemini so it does not collide with the Whisper /transcribe route
+    app.register_blueprint(async_gemini_bp, url_prefix="/gemini")
+if warmup_providers:
+    warm_up()
+
+if __name__ == '__main__':
+    app.run()
@@ -0,0 +1,287 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from dotenv import load_dotenv
+from urllib.parse import urlencode
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import threading
+
+from transcription_cache import MemoryTier, is_cache_key
+from uploads import SNIFF_BYTES, sniff_audio_format
+
+load_dotenv()
+
+# Longest span one segment request may ask for
+segment_max_seconds = float(os.getenv("segment_max_seconds", "300"))
+
+# MPEG audio frame header tables, indexed by the header's version bits
+MPEG_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+MPEG_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MPEG_BITRATES[(2, 3)] = MPEG_BITRATES[(2, 2)]
+
+
+class SegmentError(Exception):
+    status = 400
+
+
+class RecordingNotFound(SegmentError):
+    status = 404
+
+
+class UnsupportedRecording(SegmentError):
+    status = 415
+
+
+class WavIndex:
+    # PCM data is evenly spaced, so the index is just the data chunk's position and the block size
+    mime_type = "audio/wav"
+
+    def __init__(self, mm):
+        offset = 12
+        fmt = None
+        while offset + 8 <= len(mm):
+            chunk_id, size = struct.unpack_from("<4sI", mm, offset)
+            if chunk_id == b"fmt ":
+                fmt = bytes(mm[offset:offset + 8 + size])
+            elif chunk_id == b"data":
+                self.data_offset = offset + 8
+                self.data_size = min(size, len(mm) - self.data_offset)
+                break
+            offset += 8 + size + (size & 1)
+        else:
+            raise UnsupportedRecording("WAV recording has no data chunk.")
+        if fmt is None or len(fmt) < 22:
+            raise UnsupportedRecording("WAV recording has no valid fmt chunk.")
+        self.fmt_chunk = fmt
+        self.byte_rate, self.block_align = struct.unpack_from("<IH", fmt, 16)
+        if not self.byte_rate or not self.block_align:
+            raise UnsupportedRecording("WAV recording has a zero byte rate or block size.")
+        self.duration = self.data_size / self.byte_rate
+
+    def _offset(self, seconds):
+        blocks = int(seconds * self.byte_rate) // self.block_align
+        return min(self.data_size, blocks * self.block_align)
+
+    def segment(self, mm, start, end):
+        first = self.data_offset + self._offset(start)
+        last = self.data_offset + self._offset(end)
+        size = last - first
+        header = (b"RIFF" + struct.pack("<I", 4 + len(self.fmt_chunk) + 8 + size) + b"WAVE"
+                  + self.fmt_chunk + b"data" + struct.pack("<I", size))
+        return header + mm[first:last]
+
+
+class Mp3Index:
+    # Start time and byte offset of every frame; a segment is the run of whole frames covering it,
+    # which any MP3 decoder plays on its own
+    mime_type = "audio/mpeg"
+
+    def __init__(self, mm):
+        self.times = array("d")
+        self.offsets = array("Q")
+        offset = self._skip_id3(mm)
+        elapsed = 0.0
+        while offset + 4 <= len(mm):
+            frame = self._frame(mm, offset)
+            if frame is None:
+                # Lost sync (junk or a trailing tag): look for the next frame header
+                offset = mm.find(b"\xff", offset + 1)
+                if offset < 0:
+                    break
+                continue
+            length, seconds = frame
+            self.times.append(elapsed)
+            self.offsets.append(offset)
+            elapsed += seconds
+            offset += length
+        if not self.offsets:
+            raise UnsupportedRecording("No MP3 frames found.")
+        self.end_offset = min(offset, len(mm))
+        self.duration = elapsed
+
+    @staticmethod
+    def _skip_id3(mm):
+        if mm[:3] != b"ID3":
+            return 0
+        size = mm[6] << 21 | mm[7] << 14 | mm[8] << 7 | mm[9]
+        return 10 + size
+
+    @staticmethod
+    def _frame(mm, offset):
+        # (frame length in bytes, duration in seconds), or None if no valid header starts here
+        b1, b2 = mm[offset + 1], mm[offset + 2]
+        if mm[offset] != 0xFF or b1 & 0xE0 != 0xE0:
+            return None
+        version_bits, layer_bits = (b1 >> 3) & 3, (b1 >> 1) & 3
+        bitrate_index, rate_index, padding = b2 >> 4, (b2 >> 2) & 3, (b2 >> 1) & 1
+        if version_bits == 1 or layer_bits == 0 or bitrate_index in (0, 15) or rate_index == 3:
+            return None
+        version = 1 if version_bits == 3 else 2
+        layer = 4 - layer_bits
+        bitrate = MPEG_BITRATES[(version, layer)][bitrate_index] * 1000
+        sample_rate = MPEG_SAMPLE_RATES[version_bits][rate_index]
+        if layer == 1:
+            return (12 * bitrate // sample_rate + padding) * 4, 384 / sample_rate
+        samples = 1152 if layer == 2 or version == 1 else 576
+        return samples // 8 * bitrate // sample_rate + padding, samples / sample_rate
+
+    def segment(self, mm, start, end):
+        first = max(0, bisect_right(self.times, start) - 1)
+        last = bisect_left(self.times, end)
+        stop = self.offsets[last] if last < len(self.offsets) else self.end_offset
+        return mm[self.offsets[first]:stop]
+
+
+def transcode_to_mp3(source_path, target_path):
+    # Containers such as m4a need their sample tables to seek, so they are converted once
+    # to MP3, whose frames can be indexed directly
+    tmp_path = f"{target_path}.{threading.get_ident()}.tmp"
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", "-i", source_path,
+         "-vn", "-c:a", "libmp3lame", "-q:a", "4", "-f", "mp3", tmp_path],
+        check=True,
+    )
+    os.replace(tmp_path, target_path)
+
+
+class RecordingStore:
+    # The audio behind each transcript id: server-side recordings are symlinked, uploads copied.
+    # Files are evicted least recently used first once the directory exceeds max_bytes
+    def __init__(self, directory, max_bytes=2 * 1024 * 1024 * 1024, index_entries=64):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.indexes = MemoryTier(index_entries)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, audio_id, suffix=""):
+        return os.path.join(self.directory, audio_id + suffix)
+
+    def _tmp_path(self, audio_id):
+        return f"{self._path(audio_id)}.{threading.get_ident()}.tmp"
+
+    def add(self, audio_id, audio_source):
+        # audio_source is a server-side path or an AudioUpload, as in transcribe_source
+        path = self._path(audio_id)
+        if os.path.exists(path):
+            os.utime(path, follow_symlinks=False)
+            return
+        tmp_path = self._tmp_path(audio_id)
+        if isinstance(audio_source, str):
+            os.symlink(os.path.abspath(audio_source), tmp_path)
+        else:
+            audio_source.file.seek(0)
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(audio_source.file, f, 1024 * 1024)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def path(self, audio_id):
+        if not is_cache_key(audio_id):
+            return None
+        path = self._path(audio_id)
+        return path if os.path.exists(path) else None
+
+    def playback_path(self, audio_id):
+        path = self.path(audio_id)
+        if path is None:
+            raise RecordingNotFound("Recording not found.")
+        with open(path, "rb") as f:
+            detected = sniff_audio_format(f.read(SNIFF_BYTES))
+        if detected and detected[0] in ("wav", "mp3"):
+            return path
+        playback_path = self._path(audio_id, ".mp3")
+        if not os.path.exists(playback_path):
+            try:
+                transcode_to_mp3(path, playback_path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise UnsupportedRecording(f"Recording cannot be converted for playback: {e}")
+            self.evict()
+        return playback_path
+
+    def _index(self, path, mm):
+        stat = os.stat(path)
+        key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+        index = self.indexes.get(key)
+        if index is None:
+            index = WavIndex(mm) if mm[:4] == b"RIFF" else Mp3Index(mm)
+            self.indexes.put(key, index)
+        return index
+
+    def segment(self, audio_id, start, end):
+        # Returns (audio bytes, mime type); only the pages holding the segment are read
+        if not 0 <= start < end or end - start > segment_max_seconds:
+            raise SegmentError(f"Segment must satisfy 0 <= start_time < end_time, at most {segment_max_seconds:g}s long.")
+        path = self.playback_path(audio_id)
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            index = self._index(path, mm)
+            if start >= index.duration:
+                raise SegmentError("start_time is past the end of the recording.")
+            return index.segment(mm, start, end), index.mime_type
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = os.lstat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+def segment_times(args):
+    try:
+        return float(args["start_time"]), float(args["end_time"])
+    except (KeyError, ValueError):
+        raise SegmentError("start_time and end_time must be numbers of seconds.")
+
+
+def segment_url(audio_id, start_time, end_time):
+    return f"/segment/{audio_id}?{urlencode({'start_time': start_time, 'end_time': end_time})}"
+
+
+def add_segment_urls(fields, audio_id):
+    # Points every field's sentence at the segment of the recording where it is spoken
+    for record in fields.get("data") or []:
+        for field in record.values():
+            spoken = (field.get("sentence_info") or {}).get("sentence_spoken") if isinstance(field, dict) else None
+            if isinstance(spoken, dict) and "start_time" in spoken and "end_time" in spoken:
+                spoken["segment_url"] = segment_url(audio_id, spoken["start_time"], spoken["end_time"])
+    return fields
+
+
+def build_recording_store():
+    # Set recording_store_dir= (empty) to keep no recordings and disable /segment
+    directory = os.getenv("recording_store_dir", ".cache/recordings")
+    if not directory:
+        return None
+    return RecordingStore(
+        directory,
+        max_bytes=int(os.getenv("recording_store_bytes", str(2 * 1024 * 1024 * 1024))),
+        index_entries=int(os.getenv("recording_index_entries", "64")),
+    )
+
+
+recordings = build_recording_store()
@@ -0,0 +1,84 @@
+from dotenv import load_dotenv
+import os
+import threading
+import time
+import uuid
+
+load_dotenv()
+
+
+class AudioStore:
+    def __init__(self, directory, max_files=256, ttl_seconds=3600, suffix=".mp3"):
+        self.directory = directory
+        self.max_files = max_files
+        self.ttl_seconds = ttl_seconds
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, audio_id):
+        return os.path.join(self.directory, audio_id + self.suffix)
+
+    def put(self, audio_bytes, audio_id=None):
+        audio_id = audio_id or uuid.uuid4().hex
+        path = self._path(audio_id)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(audio_bytes)
+        os.replace(tmp_path, path)
+        self.evict()
+        return audio_id
+
+    def path(self, audio_id):
+        # Ids come from URLs, so only accept the hex ids we hand out
+        if not audio_id or not all(c in "0123456789abcdef" for c in audio_id):
+            return None
+        path = self._path(audio_id)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                return None
+        except FileNotFoundError:
+            return None
+        return path
+
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.suffix):
+                    continue
+                path = os.path.join(self.directory, name)
+                try:
+                    mtime = os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                if now - mtime > self.ttl_seconds:
+                    self._remove(path)
+                else:
+                    entries.append((mtime, path))
+            entries.sort()
+            for _, path in entries[:max(0, len(entries) - self.max_files)]:
+                self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def build_reply_audio_store():
+    # Reply audio is kept in memory only unless a store directory is configured
+    directory = os.getenv("audio_store_dir")
+    if not directory:
+        return None
+    return AudioStore(
+        directory,
+        max_files=int(os.getenv("audio_store_max_files", "256")),
+        ttl_seconds=int(os.getenv("audio_store_ttl_seconds", "3600")),
+    )
+
+
+reply_audio_store = build_reply_audio_store()
@@ -0,0 +1,254 @@
+from concurrent.futures import ThreadPoolExecutor
+from flask import Blueprint, jsonify, request
+from dotenv import load_dotenv
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import ai_speech_to_text_whisper as whisper
+from tracing import configure_logging
+from upstream import error_status, upstream_errors
+from uploads import flag
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Jobs started over HTTP write their results only inside this directory
+batch_output_dir = os.getenv("batch_output_dir", "batch_results")
+# Finished jobs stay pollable for this long, and at most this many are kept
+batch_job_ttl_seconds = float(os.getenv("batch_job_ttl_seconds", "3600"))
+batch_max_jobs = int(os.getenv("batch_max_jobs", "100"))
+
+batch_bp = Blueprint('batch_bp', __name__)
+batch_jobs = {}
+
+AUDIO_EXTENSIONS = {".m4a", ".mp3", ".mp4", ".mpeg", ".mpga", ".wav", ".webm", ".ogg", ".flac"}
+
+
+class RateLimiter:
+    # Spaces upstream calls to requests_per_minute across all workers, and
+    # pauses everyone after a 429 instead of letting each worker hammer the API
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute if requests_per_minute else 0.0
+        self._next_slot = 0.0
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot, self._paused_until)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def pause(self, seconds):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+def call_with_backoff(limiter, fn, *args, max_attempts=5):
+    for attempt in range(max_attempts):
+        limiter.wait()
+        try:
+            return fn(*args)
+        except upstream_errors() as e:
+            if error_status(e) != 429 or attempt == max_attempts - 1:
+                raise
+            retry_after = e.response.headers.get("retry-after") if getattr(e, "response", None) is not None else None
+            delay = float(retry_after) if retry_after else min(60.0, 2 ** attempt) * (0.5 + random.random())
+            limiter.pause(delay)
+
+
+def collect_inputs(source):
+    # A directory of recordings, a .jsonl manifest of {"audio_file_path": ...} or a text file of paths
+    if os.path.isdir(source):
+        return sorted(
+            os.path.join(source, name) for name in os.listdir(source)
+            if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS
+        )
+    base = os.path.dirname(os.path.abspath(source))
+    paths = []
+    with open(source, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            path = json.loads(line)["audio_file_path"] if line.startswith("{") else line
+            paths.append(path if os.path.isabs(path) else os.path.join(base, path))
+    return paths
+
+
+def batch_output_path(name):
+    # Resolves an HTTP caller's output name inside batch_output_dir, or None if it points elsewhere
+    directory = os.path.realpath(batch_output_dir)
+    path = os.path.realpath(os.path.join(directory, name))
+    if os.path.dirname(path) != directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    return path
+
+
+def completed_inputs(output_path):
+    # Lines already written with status "ok" are skipped when a run is resumed
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get("status") == "ok":
+                done.add(result["audio_file_path"])
+    return done
+
+
+class BatchJob:
+    def __init__(self, inputs, output_path, workers=4, requests_per_minute=50, playback=True):
+        self.job_id = uuid.uuid4().hex
+        self.output_path = output_path
+        self.workers = workers
+        self.playback = playback
+        self.limiter = RateLimiter(requests_per_minute)
+        skipped = completed_inputs(output_path)
+        self.inputs = [path for path in inputs if path not in skipped]
+        self.counts = {"total": len(inputs), "skipped": len(inputs) - len(self.inputs), "ok": 0, "error": 0}
+        self.status = "pending"
+        self.error = None
+        self.finished_at = None
+        self._write_lock = threading.Lock()
+
+    def process(self, audio_file_path):
+        result = {"audio_file_path": audio_file_path}
+        try:
+            transcript = call_with_backoff(self.limiter, whisper.transcribe_file, audio_file_path)
+            result["transcription"] = whisper.transcript_payload(transcript)
+            if self.playback:
+                result["fields"] = call_with_backoff(self.limiter, whisper.extract_fields, transcript)
+            result["status"] = "ok"
+        except Exception as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+        with self._write_lock:
+            with open(self.output_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(result) + "\n")
+            self.counts[result["status"]] += 1
+        return result
+
+    def run(self):
+        self.status = "running"
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="batch") as pool:
+                for result in pool.map(self.process, self.inputs):
+                    logger.info("[%s] %s", result["status"], result["audio_file_path"])
+        except Exception as e:
+            logger.exception("Batch job %s failed", self.job_id)
+            self.status = "failed"
+            self.error = str(e)
+            raise
+        else:
+            self.status = "done"
+        finally:
+            self.finished_at = time.monotonic()
+        return self.counts
+
+    def to_dict(self):
+        job = {"job_id": self.job_id, "status": self.status, "output": self.output_path, **self.counts}
+        if self.error is not None:
+            job["error"] = self.error
+        return job
+
+
+def run_in_background(job):
+    try:
+        job.run()
+    except Exception:
+        # Already recorded on the job for status polls
+        pass
+
+
+def prune_batch_jobs():
+    # Running jobs are always kept; finished ones expire, oldest first once over the cap
+    now = time.monotonic()
+    finished = [job for job in batch_jobs.values() if job.finished_at is not None]
+    for job in finished:
+        if now - job.finished_at > batch_job_ttl_seconds or len(batch_jobs) >= batch_max_jobs:
+            batch_jobs.pop(job.job_id, None)
+
+
+def job_settings(data):
+    # (workers, requests_per_minute), or raises ValueError for anything but positive numbers
+    try:
+        workers = int(data.get("workers", 4))
+        requests_per_minute = float(data.get("requests_per_minute", 50))
+    except (TypeError, ValueError):
+        raise ValueError("workers and requests_per_minute must be numbers")
+    if workers < 1 or not requests_per_minute > 0:
+        raise ValueError("workers and requests_per_minute must be positive")
+    return workers, requests_per_minute
+
+
+@batch_bp.route('/batch', methods=['POST'])
+def start_batch():
+    data = request.get_json()
+    source = data.get("source")
+    output_path = data.get("output")
+    if not source or not output_path:
+        return jsonify({"error": "Missing source or output"}), 400
+    output_path = batch_output_path(output_path)
+    if output_path is None:
+        return jsonify({"error": "output must be a file name inside the batch output directory"}), 400
+    try:
+        workers, requests_per_minute = job_settings(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        inputs = collect_inputs(source)
+    except (OSError, ValueError, KeyError) as e:
+        return jsonify({"error": f"Could not read source: {e}"}), 400
+    job = BatchJob(
+        inputs, output_path,
+        workers=workers,
+        requests_per_minute=requests_per_minute,
+        playback=flag(data.get("playback", True)),
+    )
+    prune_batch_jobs()
+    batch_jobs[job.job_id] = job
+    threading.Thread(target=run_in_background, args=(job,), name=f"batch-{job.job_id}", daemon=True).start()
+    return jsonify(job.to_dict()), 202
+
+
+@batch_bp.route('/batch/<job_id>', methods=['GET'])
+def batch_status(job_id):
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Batch job not found."}), 404
+    return jsonify(job.to_dict())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe and extract fields for a folder or manifest of recordings.")
+    parser.add_argument("source", help="directory of recordings, .jsonl manifest or text file of paths")
+    parser.add_argument("-o", "--output", required=True, help="JSONL results file; rerun with the same file to resume")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests-per-minute", type=float, default=50)
+    parser.add_argument("--no-playback", action="store_true", help="only transcribe, skip field extraction")
+    args = parser.parse_args()
+    configure_logging()
+
+    job = BatchJob(
+        collect_inputs(args.source), args.output,
+        workers=args.workers, requests_per_minute=args.requests_per_minute, playback=not args.no_playback,
+    )
+    print(json.dumps(job.run()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import http.client
+import importlib.util
+import json
+import logging
+import os
+import resource
+import tempfile
+import threading
+import time
+import types
+import uuid
+
+# Benchmarks measure the request path, not cache hits
+os.environ.setdefault("transcription_cache_memory_entries", "0")
+os.environ.setdefault("transcription_cache_dir", "")
+os.environ.setdefault("tts_cache_memory_entries", "0")
+os.environ.setdefault("tts_cache_dir", "")
+os.environ.setdefault("intent_cache_memory_entries", "0")
+os.environ.setdefault("log_level", "WARNING")
+os.environ.setdefault("openai_api_key", "benchmark")
+# The fake model replaces the Vertex client, but building Gemini requests still needs the SDK
+os.environ.setdefault("providers", "openai,gemini" if importlib.util.find_spec("vertexai") else "openai")
+os.environ.setdefault("conversation_log_dir", tempfile.mkdtemp(prefix="benchmark-conversations-"))
+os.environ.setdefault("recording_store_dir", tempfile.mkdtemp(prefix="benchmark-recordings-"))
+
+from openai import OpenAI
+from werkzeug.serving import make_server
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_AUDIO = os.path.join(HERE, "..", "Sample Audios", "Test Video.m4a")
+
+
+class FakeUpstreamConfig:
+    def __init__(self, latency, words=200, tokens=60, audio_bytes=32000):
+        self.latency = latency
+        self.words = words
+        self.tokens = tokens
+        self.audio_bytes = audio_bytes
+
+    def word_timestamps(self):
+        return [{"word": f"word{i}", "start": i * 0.4, "end": i * 0.4 + 0.3} for i in range(self.words)]
+
+
+def example_arguments(schema):
+    # The smallest reply that matches a function's parameter schema
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: example_arguments(child) for name, child in schema.get("properties", {}).items()}
+    if "enum" in schema:
+        return schema["enum"][0]
+    return {"array": [], "string": "invoice", "integer": 0, "number": 0.0, "boolean": False}.get(kind)
+
+
+def fake_openai_handler(config):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.path.endswith("/audio/transcriptions"):
+                time.sleep(config.latency["transcribe"])
+                if b'name="response_format"\r\n\r\ntext' in body:
+                    text = b"I want to create an invoice for a plumbing job"
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain")
+                    self.send_header("Content-Length", str(len(text)))
+                    self.end_headers()
+                    self.wfile.write(text)
+                    return
+                words = config.word_timestamps()
+                self.send_json({
+                    "task": "transcribe", "language": "english", "duration": words[-1]["end"] if words else 0.0,
+                    "text": " ".join(w["word"] for w in words), "words": words,
+                })
+            elif self.path.endswith("/chat/completions"):
+                self.chat(json.loads(body))
+            elif self.path.endswith("/audio/speech"):
+                time.sleep(config.latency["speech"])
+                self.send_response(200)
+                self.send_header("Content-Type", "audio/mpeg")
+                self.send_header("Content-Length", str(config.audio_bytes))
+                self.end_headers()
+                self.wfile.write(b"\xff" * config.audio_bytes)
+            else:
+                self.send_response(404)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+        def chat(self, params):
+            time.sleep(config.latency["chat"])
+            content = " ".join(f"token{i}." if i % 12 == 11 else f"token{i}" for i in range(config.tokens))
+            if params.get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                for piece in content.split(" "):
+                    chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": params["model"],
+                             "choices": [{"index": 0, "delta": {"content": piece + " "}, "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    time.sleep(config.latency["token"])
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.close_connection = True
+                return
+            message = {"role": "assistant", "content": content}
+            if params.get("functions"):
+                function = params["functions"][0]
+                message = {"role": "assistant", "content": None, "function_call": {
+                    "name": function["name"], "arguments": json.dumps(example_arguments(function["parameters"]))}}
+            elif params.get("response_format", {}).get("type") == "json_object":
+                message["content"] = json.dumps({
+                    "intent": "invoice", "pending_questions": ["What's the due date?"],
+                    "reply": "Who is the invoice for?", "detailed_response": "Who is the invoice for?",
+                    "task_finalized": False,
+                })
+            self.send_json({
+                "id": "bench", "object": "chat.completion", "created": 0, "model": params["model"],
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": config.tokens, "total_tokens": config.tokens},
+            })
+
+    return Handler
+
+
+class FakeVertexModel:
+    # Stands in for vertexai's GenerativeModel with the same response attributes
+    def __init__(self, config):
+        self.config = config
+
+    def _response(self):
+        text = "\n".join(json.dumps({"word": w["word"], "start_time": w["start"], "end_time": w["end"]})
+                         for w in self.config.word_timestamps())
+        candidate = types.SimpleNamespace(
+            content=types.SimpleNamespace(role="model", parts=[types.SimpleNamespace(text=text)]),
+            finish_reason=1, safety_ratings=[], avg_logprobs=0.0,
+        )
+        usage = types.SimpleNamespace(prompt_token_count=0, candidates_token_count=0, total_token_count=0)
+        return types.SimpleNamespace(candidates=[candidate], usage_metadata=usage)
+
+    def _chunk(self, text):
+        content = types.SimpleNamespace(role="model", parts=[types.SimpleNamespace(text=text)])
+        return types.SimpleNamespace(candidates=[types.SimpleNamespace(content=content)])
+
+    def _stream(self):
+        # Chunks split mid-object, the way streamed model text arrives
+        text = self._response().candidates[0].content.parts[0].text
+        for start in range(0, len(text), 80):
+            time.sleep(self.config.latency["token"])
+            yield self._chunk(text[start:start + 80])
+
+    def generate_content(self, contents, stream=False):
+        time.sleep(self.config.latency["vertex"])
+        return self._stream() if stream else self._response()
+
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def build_app(fake_base_url, vertex_model):
+    import main
+    import ai_speech_to_text_whisper as whisper
+    import ai_speech_to_text_gpt4o as gpt4o
+    import ai_speech_to_text_gemini as gemini
+    client = OpenAI(base_url=fake_base_url, api_key="benchmark", max_retries=0)
+    whisper.client = client
+    gpt4o.client = client
+    gemini.model = vertex_model
+    return main.app
+
+
+def request_bodies(endpoint):
+    conversation_id = f"bench_{uuid.uuid4().hex}"
+    bodies = {
+        "/transcribe": {"audio_file_path": SAMPLE_AUDIO},
+        "/playback": {"audio_file_path": SAMPLE_AUDIO},
+        "/voice-assist": {"audio_file_path": SAMPLE_AUDIO, "conversation_id": conversation_id},
+        "/text-assist": {"user_input_text": "I want to create an invoice", "conversation_id": conversation_id},
+        "/stream-text": {"user_input_text": "I want to create an invoice", "conversation_id": conversation_id},
+        "/gemini/transcribe": {"audio_file_path": SAMPLE_AUDIO},
+        "/gemini/stream-transcribe": {"audio_file_path": SAMPLE_AUDIO},
+    }
+    return bodies[endpoint]
+
+
+def timed_request(port, endpoint):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    body = json.dumps(request_bodies(endpoint))
+    started = time.perf_counter()
+    conn.request("POST", endpoint, body=body, headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    first = response.read(1)
+    ttfb = time.perf_counter() - started
+    first_audio = None
+    received = first
+    while True:
+        chunk = response.read1(65536)
+        if not chunk:
+            break
+        received += chunk
+        if first_audio is None and b"[AUDIO_BASE64]" in received:
+            first_audio = time.perf_counter() - started
+    total = time.perf_counter() - started
+    conn.close()
+    return {"status": response.status, "ttfb": ttfb, "total": total, "first_audio": first_audio}
+
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return round(sorted_values[index] * 1000, 2)
+
+
+def run_endpoint(port, endpoint, requests, concurrency):
+    peak = [current_rss_bytes()]
+    sampling = threading.Event()
+
+    def sample_rss():
+        while not sampling.wait(0.05):
+            peak[0] = max(peak[0], current_rss_bytes())
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: timed_request(port, endpoint), range(requests)))
+    elapsed = time.perf_counter() - started
+    sampling.set()
+    sampler.join()
+
+    totals = sorted(r["total"] for r in results)
+    ttfbs = sorted(r["ttfb"] for r in results)
+    first_audio = sorted(r["first_audio"] for r in results if r["first_audio"] is not None)
+    summary = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": sum(1 for r in results if r["status"] >= 400),
+        "requests_per_sec": round(requests / elapsed, 2),
+        "latency_ms": {"p50": percentile(totals, 0.5), "p95": percentile(totals, 0.95), "p99": percentile(totals, 0.99)},
+        "ttfb_ms": {"p50": percentile(ttfbs, 0.5), "p95": percentile(ttfbs, 0.95), "p99": percentile(ttfbs, 0.99)},
+        "peak_rss_mb": round(peak[0] / (1024 * 1024), 1),
+    }
+    if first_audio:
+        summary["first_audio_ms"] = {"p50": percentile(first_audio, 0.5), "p95": percentile(first_audio, 0.95)}
+    return summary
+
+
+def compare(previous, current):
+    # Relative change per endpoint; positive latency or negative throughput deltas are regressions
+    changes = {}
+    for endpoint, now in current["endpoints"].items():
+        before = previous.get("endpoints", {}).get(endpoint)
+        if not before:
+            continue
+        changes[endpoint] = {
+            "p95_latency_change": round(now["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1, 3),
+            "requests_per_sec_change": round(now["requests_per_sec"] / before["requests_per_sec"] - 1, 3),
+        }
+    return changes
+
+
+def parse_latency(value):
+    latency = {"transcribe": 0.3, "chat": 0.2, "token": 0.01, "speech": 0.15, "vertex": 0.3}
+    for item in filter(None, value.split(",")):
+        name, seconds = item.split("=")
+        latency[name.strip()] = float(seconds)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every endpoint against local fake OpenAI/Vertex upstreams.")
+    parser.add_argument("--endpoints", default="/transcribe,/playback,/voice-assist,/text-assist,/stream-text,/gemini/transcribe,/gemini/stream-transcribe")
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", default="", help="e.g. transcribe=0.3,chat=0.2,token=0.01,speech=0.15,vertex=0.3")
+    parser.add_argument("--words", type=int, default=200, help="words per fake transcription")
+    parser.add_argument("--tokens", type=int, default=60, help="tokens per fake completion")
+    parser.add_argument("--audio-bytes", type=int, default=32000, help="bytes per fake TTS response")
+    parser.add_argument("--output", help="write results JSON here")
+    parser.add_argument("--compare", help="previous results JSON to diff against")
+    args = parser.parse_args()
+
+    config = FakeUpstreamConfig(parse_latency(args.latency), args.words, args.tokens, args.audio_bytes)
+    upstream = start_server(ThreadingHTTPServer(("127.0.0.1", 0), fake_openai_handler(config)))
+    app = build_app(f"http://127.0.0.1:{upstream.server_port}/v1", FakeVertexModel(config))
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = start_server(make_server("127.0.0.1", 0, app, threaded=True))
+
+    routes = {rule.rule for rule in app.url_map.iter_rules()}
+    results = {
+        "config": {"requests": args.requests, "concurrency": args.concurrency, "latency_s": config.latency,
+                   "words": args.words, "tokens": args.tokens, "audio_bytes": args.audio_bytes},
+        "endpoints": {},
+    }
+    for endpoint in args.endpoints.split(","):
+        if endpoint not in routes:
+            continue
+        timed_request(server.server_port, endpoint)  # warm-up
+        results["endpoints"][endpoint] = run_endpoint(server.server_port, endpoint, args.requests, args.concurrency)
+    if args.compare:
+        with open(args.compare) as f:
+            results["comparison"] = compare(json.load(f), results)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    server.shutdown()
+    upstream.shutdown()
+
+
+if __name__ == "__main__":
+    main()
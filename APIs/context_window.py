@@ -0,0 +1,139 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import logging
+import os
+import threading
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+_encoding = None
+
+# Fixed per-message cost of the chat format (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+default_budget = int(os.getenv("context_budget_tokens", "6000"))
+# Per-route budgets, e.g. context_budget_stream=3000 keeps the streaming route's prompt short
+route_budgets = {
+    route: int(os.getenv(f"context_budget_{route}", str(default_budget)))
+    for route in ("turn", "respond", "stream")
+}
+# After a fold, the recent turns left verbatim take at most this share of the budget,
+# so a conversation is not re-summarized on every turn
+keep_ratio = float(os.getenv("context_keep_ratio", "0.5"))
+summary_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("context_summary_workers", "2")), thread_name_prefix="context-summary"
+)
+
+
+def _get_encoding():
+    # Loading the BPE ranks is slow (and may download them), so it waits for the first count
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text):
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    # Without tiktoken, ~4 characters per token is close enough for budgeting
+    return (len(text) + 3) // 4
+
+
+def message_tokens(message):
+    return count_tokens(message.get("content") or "") + MESSAGE_OVERHEAD_TOKENS
+
+
+def reset_context(conversation):
+    conversation["token_counts"] = []
+    conversation["summary"] = None
+    conversation["context_epoch"] = conversation.get("context_epoch", 0) + 1
+
+
+class ContextWindow:
+    # messages[0] is the system prompt; older turns are folded into conversation["summary"]
+    # in the background and pruned from the record once the summary is stored
+    def __init__(self, summarize, open_session, executor=summary_executor):
+        self.summarize = summarize
+        self.open_session = open_session
+        self.executor = executor
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def token_counts(self, conversation):
+        # Only messages appended since the last call are counted
+        counts = conversation.setdefault("token_counts", [])
+        messages = conversation["messages"]
+        if len(counts) > len(messages):
+            del counts[:]
+        counts.extend(message_tokens(message) for message in messages[len(counts):])
+        return counts
+
+    def messages(self, conversation, route="turn", budget=None):
+        budget = budget or route_budgets.get(route, default_budget)
+        messages = conversation["messages"]
+        counts = self.token_counts(conversation)
+        head = messages[:1]
+        used = sum(counts[:1])
+        summary = conversation.get("summary")
+        if summary:
+            summary_message = {"role": "system", "content": SUMMARY_PREFIX + summary["text"]}
+            head = head + [summary_message]
+            used += summary["tokens"]
+
+        # Walk back from the newest message; the latest one is always sent
+        start = len(messages)
+        while start > 1 and (start == len(messages) or used + counts[start - 1] <= budget):
+            start -= 1
+            used += counts[start]
+
+        if start > 1:
+            self._schedule_fold(conversation, budget)
+        return head + messages[start:]
+
+    def _schedule_fold(self, conversation, budget):
+        counts = conversation["token_counts"]
+        # Fold up to the point where the rest fits in keep_ratio of the budget, but never
+        # past what is already logged, so the pruned messages are always in the conversation log
+        end = len(counts)
+        kept = 0
+        while end > 1 and kept + counts[end - 1] <= budget * keep_ratio:
+            end -= 1
+            kept += counts[end]
+        end = min(end, conversation.get("logged_messages", len(counts)))
+        if end <= 1:
+            return
+        key = (conversation["conversation_id"], conversation.get("context_epoch", 0))
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        previous = (conversation.get("summary") or {}).get("text")
+        self.executor.submit(self._fold, key, previous, list(conversation["messages"][1:end]))
+
+    def _fold(self, key, previous, folded):
+        conversation_id, epoch = key
+        try:
+            text = self.summarize(previous, folded)
+            with self.open_session(conversation_id) as conversation:
+                # A reset since scheduling means these messages belong to a finished task
+                if conversation.get("context_epoch", 0) != epoch:
+                    return
+                if conversation["messages"][1:len(folded) + 1] != folded:
+                    return
+                del conversation["messages"][1:len(folded) + 1]
+                del conversation.setdefault("token_counts", [])[1:len(folded) + 1]
+                conversation["logged_messages"] = max(1, conversation.get("logged_messages", 0) - len(folded))
+                conversation["summary"] = {"text": text, "tokens": message_tokens({"content": SUMMARY_PREFIX + text})}
+        except Exception as e:
+            logger.warning("Context summary failed for %s: %s", conversation_id, e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
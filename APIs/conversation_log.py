@@ -0,0 +1,126 @@
+from dotenv import load_dotenv
+import argparse
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+class ConversationLog:
+    # Append-only JSON lines per conversation, written by one background thread:
+    #   {"type": "message", "role": ..., "content": ...}  one per new message
+    #   {"type": "turn", "state": {...}}                  turn state after the messages
+    #   {"type": "reset", "intent": ...}                  a new task started
+
+    def __init__(self, directory="conversations", max_pending=10000):
+        self.directory = directory
+        self._queue = queue.Queue(maxsize=max_pending)
+        os.makedirs(directory, exist_ok=True)
+        self._writer = threading.Thread(target=self._run, name="conversation-log", daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    def path(self, conversation_id):
+        return os.path.join(self.directory, f"{conversation_id}.jsonl")
+
+    def append(self, conversation_id, messages, state):
+        now = time.time()
+        entries = [{"ts": now, "type": "message", "role": m["role"], "content": m["content"]} for m in messages]
+        entries.append({"ts": now, "type": "turn", "state": state})
+        self._queue.put((conversation_id, [json.dumps(entry) for entry in entries]))
+
+    def reset(self, conversation_id, intent):
+        self._queue.put((conversation_id, [json.dumps({"ts": time.time(), "type": "reset", "intent": intent})]))
+
+    def flush(self):
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Group whatever else is already queued so each file is opened once per batch
+            while len(batch) < 256:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines_by_conversation = {}
+            for conversation_id, lines in batch:
+                lines_by_conversation.setdefault(conversation_id, []).extend(lines)
+            for conversation_id, lines in lines_by_conversation.items():
+                try:
+                    with open(self.path(conversation_id), "a", encoding="utf-8") as f:
+                        f.write("\n".join(lines) + "\n")
+                except OSError as e:
+                    logger.error("Failed to write conversation log for %s: %s", conversation_id, e)
+            for _ in batch:
+                self._queue.task_done()
+
+
+def replay(path):
+    # Rebuild a conversation record (as kept in the conversation store) from its log
+    conversation_id = os.path.splitext(os.path.basename(path))[0]
+    record = {"conversation_id": conversation_id, "messages": [], "state": None}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final line from a crash; everything before it is still valid
+                continue
+            if entry["type"] == "message":
+                record["messages"].append({"role": entry["role"], "content": entry["content"]})
+            elif entry["type"] == "turn":
+                record["state"] = entry["state"]
+            elif entry["type"] == "reset":
+                record["messages"] = []
+                record["state"] = None
+    record["logged_messages"] = len(record["messages"])
+    return record
+
+
+def compact(path):
+    # Drop history from before the last reset and rewrite the log as one snapshot
+    record = replay(path)
+    tmp_path = path + ".tmp"
+    now = time.time()
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for m in record["messages"]:
+            f.write(json.dumps({"ts": now, "type": "message", "role": m["role"], "content": m["content"]}) + "\n")
+        if record["state"] is not None:
+            f.write(json.dumps({"ts": now, "type": "turn", "state": record["state"]}) + "\n")
+    os.replace(tmp_path, path)
+    return record
+
+
+conversation_log = ConversationLog(os.getenv("conversation_log_dir", "conversations"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay or compact conversation turn logs.")
+    parser.add_argument("command", choices=["replay", "compact"])
+    parser.add_argument("conversation_ids", nargs="+")
+    parser.add_argument("--load", action="store_true", help="write replayed conversations into the conversation store")
+    args = parser.parse_args()
+
+    for conversation_id in args.conversation_ids:
+        path = conversation_log.path(conversation_id)
+        record = compact(path) if args.command == "compact" else replay(path)
+        if args.load and record["state"] is not None:
+            from conversation_store import conversations
+            with conversations.lock(conversation_id):
+                conversations.save(conversation_id, record)
+        print(json.dumps(record, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,507 @@
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from dotenv import load_dotenv
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from tracing import Counter, collectors, gauge_lines, metrics, span
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+coalesced_turns_total = Counter("conversation_turns_coalesced_total", "Turns answered from an identical turn still running.")
+metrics.append(coalesced_turns_total)
+
+
+class LeaseLost(RuntimeError):
+    pass
+
+
+class ConversationStore:
+    # A record is {"conversation_id": ..., "messages": [...], "state": {...}}.
+    # Subclasses provide load/save/delete, and claim/unclaim for a lock shared beyond this process;
+    # requests in this process first queue on a per-conversation local lock.
+    # blocking says whether load/save/claim do I/O, in which case async callers run them in a thread
+    blocking = True
+    lock_timeout = None
+
+    def load(self, conversation_id):
+        raise NotImplementedError
+
+    def save(self, conversation_id, record):
+        raise NotImplementedError
+
+    def delete(self, conversation_id):
+        raise NotImplementedError
+
+    def claim(self, conversation_id, timeout=None):
+        return None
+
+    def unclaim(self, conversation_id, token):
+        pass
+
+    def acquire(self, conversation_id, timeout=None):
+        timeout = self.lock_timeout if timeout is None else timeout
+        self._locks.acquire(conversation_id, timeout)
+        try:
+            return self.claim(conversation_id, timeout)
+        except BaseException:
+            self._locks.release(conversation_id)
+            raise
+
+    async def acquire_async(self, conversation_id, timeout=None):
+        # A coroutine queued behind another request on the same conversation waits without a thread
+        timeout = self.lock_timeout if timeout is None else timeout
+        await self._locks.acquire_async(conversation_id, timeout)
+        try:
+            return await self.run_async(self.claim, conversation_id, timeout)
+        except BaseException:
+            self._locks.release(conversation_id)
+            raise
+
+    def release(self, conversation_id, token):
+        try:
+            self.unclaim(conversation_id, token)
+        finally:
+            self._locks.release(conversation_id)
+
+    async def run_async(self, fn, *args):
+        if self.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
+
+    @contextmanager
+    def lock(self, conversation_id):
+        token = self.acquire(conversation_id)
+        try:
+            yield
+        finally:
+            self.release(conversation_id, token)
+
+    def hold(self, conversation_id, default=None):
+        with span("conversation_lock"):
+            token = self.acquire(conversation_id)
+        try:
+            record = self.load(conversation_id)
+        except BaseException:
+            self.release(conversation_id, token)
+            raise
+        if record is None and default is not None:
+            record = default()
+        return ConversationHold(self, conversation_id, token, record)
+
+    async def hold_async(self, conversation_id, default=None):
+        with span("conversation_lock"):
+            token = await self.acquire_async(conversation_id)
+        try:
+            record = await self.run_async(self.load, conversation_id)
+        except BaseException:
+            await self.run_async(self.release, conversation_id, token)
+            raise
+        if record is None and default is not None:
+            record = default()
+        return ConversationHold(self, conversation_id, token, record)
+
+    @contextmanager
+    def session(self, conversation_id, default=None):
+        # Load, mutate and save a conversation while holding its lock; nothing is saved if the block raises
+        hold = self.hold(conversation_id, default)
+        try:
+            yield hold.record
+            hold.save()
+        finally:
+            hold.release()
+
+    @asynccontextmanager
+    async def session_async(self, conversation_id, default=None):
+        hold = await self.hold_async(conversation_id, default)
+        try:
+            yield hold.record
+            await hold.save_async()
+        finally:
+            await hold.release_async()
+
+    def lock_state(self):
+        return {"held": self._locks.held(), "waiting": self._locks.waiting()}
+
+
+class ConversationHold:
+    # A loaded conversation whose lock is kept until release(), e.g. for the length of a streamed reply.
+    # release() may be called more than once, from whichever of the stream or its cleanup gets there first
+    def __init__(self, store, conversation_id, token, record):
+        self.store = store
+        self.conversation_id = conversation_id
+        self.token = token
+        self.record = record
+        self._released = False
+        self._mutex = threading.Lock()
+
+    def save(self):
+        if self.record is not None:
+            self.store.save(self.conversation_id, self.record)
+
+    async def save_async(self):
+        await self.store.run_async(self.save)
+
+    def _first_release(self):
+        with self._mutex:
+            first, self._released = not self._released, True
+        return first
+
+    def release(self):
+        if self._first_release():
+            self.store.release(self.conversation_id, self.token)
+
+    async def release_async(self):
+        if self._first_release():
+            await self.store.run_async(self.store.release, self.conversation_id, self.token)
+
+
+class _Waiter:
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _LocalLocks:
+    # First-come first-served locks per key, waited on by threads (an Event) and coroutines (a future) alike.
+    # release() hands the lock straight to the next waiter, so there is no owner thread and an async
+    # caller may release from another thread
+    def __init__(self):
+        # key -> queue of waiters; a key is held while it has an entry
+        self._queues = {}
+        self._mutex = threading.Lock()
+
+    def _enqueue(self, key, wake):
+        # None if the key was free and is now held, else the waiter to wait on
+        with self._mutex:
+            queue = self._queues.get(key)
+            if queue is None:
+                self._queues[key] = deque()
+                return None
+            waiter = _Waiter(wake)
+            queue.append(waiter)
+            return waiter
+
+    def _abandon(self, key, waiter):
+        # Stop waiting; True if the lock was handed over in the meantime and now belongs to the caller
+        with self._mutex:
+            if waiter.granted:
+                return True
+            self._queues[key].remove(waiter)
+            return False
+
+    def acquire(self, key, timeout=None):
+        woken = threading.Event()
+        waiter = self._enqueue(key, woken.set)
+        if waiter is None or woken.wait(timeout) or self._abandon(key, waiter):
+            return
+        raise TimeoutError(f"Timed out waiting for conversation {key}")
+
+    async def acquire_async(self, key, timeout=None):
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        waiter = self._enqueue(key, lambda: loop.call_soon_threadsafe(_resolve, granted))
+        if waiter is None:
+            return
+        try:
+            await asyncio.wait_for(granted, timeout)
+        except BaseException as e:
+            if self._abandon(key, waiter):
+                # Handed over while timing out or being cancelled: pass it on instead of leaking it
+                self.release(key)
+            if isinstance(e, TimeoutError):
+                raise TimeoutError(f"Timed out waiting for conversation {key}") from None
+            raise
+
+    def release(self, key):
+        with self._mutex:
+            queue = self._queues[key]
+            if not queue:
+                del self._queues[key]
+                return
+            waiter = queue.popleft()
+            waiter.granted = True
+        waiter.wake()
+
+    def held(self):
+        with self._mutex:
+            return len(self._queues)
+
+    def waiting(self):
+        with self._mutex:
+            return sum(len(queue) for queue in self._queues.values())
+
+
+class MemoryConversationStore(ConversationStore):
+    blocking = False
+
+    def __init__(self, max_conversations=1000, ttl_seconds=3600):
+        self.max_conversations = max_conversations
+        self.ttl_seconds = ttl_seconds
+        self._records = OrderedDict()
+        self._mutex = threading.Lock()
+        self._locks = _LocalLocks()
+
+    def load(self, conversation_id):
+        with self._mutex:
+            entry = self._records.get(conversation_id)
+            if entry is None:
+                return None
+            record, touched_at = entry
+            if time.time() - touched_at > self.ttl_seconds:
+                del self._records[conversation_id]
+                return None
+            self._records.move_to_end(conversation_id)
+            # A copy, so a turn that fails part-way leaves the stored record as it was, like the SQLite backend
+            return copy.deepcopy(record)
+
+    def save(self, conversation_id, record):
+        now = time.time()
+        with self._mutex:
+            self._records[conversation_id] = (record, now)
+            self._records.move_to_end(conversation_id)
+            # Oldest entries are least recently used; drop them once idle too long or over capacity
+            while self._records:
+                oldest_id, (_, touched_at) = next(iter(self._records.items()))
+                if len(self._records) <= self.max_conversations and now - touched_at <= self.ttl_seconds:
+                    break
+                del self._records[oldest_id]
+
+    def delete(self, conversation_id):
+        with self._mutex:
+            self._records.pop(conversation_id, None)
+
+
+class SqliteConversationStore(ConversationStore):
+    def __init__(self, path, ttl_seconds=7 * 24 * 3600, lease_seconds=60, lock_timeout=30):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.lease_seconds = lease_seconds
+        self.lock_timeout = lock_timeout
+        self._local = threading.local()
+        self._locks = _LocalLocks()
+        self._saves = 0
+        # conversation_id -> owner token of the leases this process holds, renewed until unclaimed
+        self._leases = {}
+        self._leases_mutex = threading.Lock()
+        self._renewer = None
+        with self._connection() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversations ("
+                "conversation_id TEXT PRIMARY KEY, record TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS conversation_locks ("
+                "conversation_id TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.lock_timeout)
+            self._local.conn = conn
+        return conn
+
+    def load(self, conversation_id):
+        row = self._connection().execute(
+            "SELECT record, updated_at FROM conversations WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl_seconds:
+            return None
+        return json.loads(row[0])
+
+    def save(self, conversation_id, record):
+        now = time.time()
+        owner = self._leases.get(conversation_id)
+        with self._connection() as conn:
+            # Written only while our lease is still the current one, so a turn that outlived it
+            # cannot overwrite what the new owner saved
+            if owner is not None and conn.execute(
+                "SELECT 1 FROM conversation_locks WHERE conversation_id = ? AND owner = ?", (conversation_id, owner)
+            ).fetchone() is None:
+                raise LeaseLost(f"Lost the lock on conversation {conversation_id}")
+            conn.execute(
+                "INSERT INTO conversations (conversation_id, record, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(conversation_id) DO UPDATE SET record = excluded.record, updated_at = excluded.updated_at",
+                (conversation_id, json.dumps(record), now),
+            )
+            self._saves += 1
+            if self._saves % 100 == 0:
+                conn.execute("DELETE FROM conversations WHERE updated_at < ?", (now - self.ttl_seconds,))
+
+    def delete(self, conversation_id):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,))
+
+    def claim(self, conversation_id, timeout=None):
+        # Requests in this process already hold the local lock; the lease row serializes across processes
+        deadline = time.time() + timeout
+        owner = uuid.uuid4().hex
+        while True:
+            now = time.time()
+            with self._connection() as conn:
+                claimed = conn.execute(
+                    "INSERT INTO conversation_locks (conversation_id, owner, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(conversation_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                    "WHERE conversation_locks.expires_at < ?",
+                    (conversation_id, owner, now + self.lease_seconds, now),
+                ).rowcount
+            if claimed:
+                with self._leases_mutex:
+                    self._leases[conversation_id] = owner
+                    if self._renewer is None:
+                        self._renewer = threading.Thread(target=self._renew_leases, daemon=True)
+                        self._renewer.start()
+                return owner
+            if now > deadline:
+                raise TimeoutError(f"Timed out waiting for conversation {conversation_id}")
+            time.sleep(0.02)
+
+    def _renew_leases(self):
+        # A turn may run longer than one lease (upstream retries, a long stream), so held leases are
+        # extended well before they expire
+        while True:
+            time.sleep(self.lease_seconds / 3)
+            with self._leases_mutex:
+                leases = list(self._leases.items())
+            for conversation_id, owner in leases:
+                try:
+                    with self._connection() as conn:
+                        renewed = conn.execute(
+                            "UPDATE conversation_locks SET expires_at = ? WHERE conversation_id = ? AND owner = ?",
+                            (time.time() + self.lease_seconds, conversation_id, owner),
+                        ).rowcount
+                except sqlite3.Error as e:
+                    logger.warning("Could not renew lock on conversation %s: %s", conversation_id, e)
+                    continue
+                if not renewed:
+                    logger.warning("Lock on conversation %s was taken over", conversation_id)
+
+    def unclaim(self, conversation_id, token):
+        with self._leases_mutex:
+            if self._leases.get(conversation_id) == token:
+                del self._leases[conversation_id]
+        with self._connection() as conn:
+            conn.execute(
+                "DELETE FROM conversation_locks WHERE conversation_id = ? AND owner = ?", (conversation_id, token)
+            )
+
+
+class TurnCoalescer:
+    # Identical turns on one conversation (a double-tapped send, a client retry) that arrive while the
+    # first is still running share its result instead of running again. Once a turn has finished, the
+    # same message is a new turn (a second "yes" answers a different question), so nothing is kept.
+    # Threads and coroutines are tracked separately; each only ever waits on its own kind
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._running = {}
+        self._running_async = {}
+        self._mutex = threading.Lock()
+        self.coalesced = 0
+
+    def _count_coalesced(self):
+        with self._mutex:
+            self.coalesced += 1
+        coalesced_turns_total.inc()
+
+    def run(self, key, fn):
+        if not self.enabled:
+            return fn()
+        with self._mutex:
+            call = self._running.get(key)
+            leader = call is None
+            if leader:
+                call = self._running[key] = {"done": threading.Event(), "result": None, "error": None}
+        if not leader:
+            self._count_coalesced()
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+        except BaseException as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._mutex:
+                del self._running[key]
+            call["done"].set()
+        return call["result"]
+
+    async def run_async(self, key, fn):
+        # fn returns a coroutine; if the running turn is cancelled, a waiter runs the turn itself
+        if not self.enabled:
+            return await fn()
+        while True:
+            with self._mutex:
+                call = self._running_async.get(key)
+                leader = call is None
+                if leader:
+                    call = self._running_async[key] = asyncio.get_running_loop().create_future()
+            if leader:
+                break
+            await asyncio.wait([call])
+            if not call.cancelled():
+                self._count_coalesced()
+                return call.result()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            call.cancel()
+            raise
+        except BaseException as e:
+            call.set_exception(e)
+            # Marks the exception retrieved when no request was waiting for it
+            call.exception()
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._mutex:
+                del self._running_async[key]
+
+
+def build_conversation_store():
+    backend = os.getenv("conversation_store_backend", "memory")
+    ttl_seconds = int(os.getenv("conversation_ttl_seconds", "3600"))
+    if backend == "sqlite":
+        return SqliteConversationStore(
+            os.getenv("conversation_store_path", "conversations.db"),
+            ttl_seconds=ttl_seconds,
+            lease_seconds=int(os.getenv("conversation_lock_lease_seconds", "60")),
+        )
+    return MemoryConversationStore(
+        max_conversations=int(os.getenv("conversation_max_entries", "1000")),
+        ttl_seconds=ttl_seconds,
+    )
+
+
+conversations = build_conversation_store()
+coalesced_turns = TurnCoalescer(os.getenv("conversation_coalesce_turns", "true").lower() == "true")
+
+
+def conversation_metric_lines():
+    locks = conversations.lock_state()
+    return gauge_lines(
+        "conversation_locks", "Conversations locked by a running turn, and turns queued behind them.",
+        [({"state": "held"}, locks["held"]), ({"state": "waiting"}, locks["waiting"])],
+    )
+
+
+collectors.append(conversation_metric_lines)
@@ -0,0 +1,228 @@
+import re
+import threading
+
+SENTENCE_END = re.compile(r"[.!?][\"')\]]*$")
+PAUSE_SECONDS = 0.8
+
+NUMBER_WORDS = {
+    "no": 0, "zero": 0, "one": 1, "a": 1, "an": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10,
+}
+# Only phrasings that always introduce the speaker's name; "I'm" and "this is" are followed by too many other words.
+# Matched on punctuated text, so a comma after the first name ends the name
+NAME_PATTERN = re.compile(
+    r"\b(?i:my name is|my name's|call me)\s+([A-Z][\w'\-]*\w)(?:\s+([A-Z][\w'\-]*\w))?"
+)
+# Capitalized words that follow a first name without being a surname
+NOT_SURNAMES = {"i", "i'm", "i've", "i'll", "i'd", "he", "she", "we", "they", "you", "it", "my", "and", "but", "so"}
+CONTRACTION = re.compile(r"'(?:m|s|re|ve|ll|d)$|n't$", re.IGNORECASE)
+DEPENDENT_NOUNS = r"(?:kids?|child(?:ren)?|dependents?|sons?|daughters?|boys?|girls?)"
+DEPENDENTS_PATTERN = re.compile(
+    r"\b(?:i have|i've got|we have|we've got|with)\s+(\d+|" + "|".join(NUMBER_WORDS) + r")\s+"
+    r"(?:\w+\s+)?(?:kids?|child(?:ren)?|dependents?|sons?|daughters?)\b",
+    re.IGNORECASE,
+)
+# More than one count of dependents, or dependents listed with "and", need adding up: left to the model
+DEPENDENT_COUNT = re.compile(
+    r"\b(?:\d+|" + "|".join(NUMBER_WORDS) + r")\s+(?:\w+\s+)?" + DEPENDENT_NOUNS + r"\b", re.IGNORECASE
+)
+# "a couple of kids", "a few kids": "a" is not a count here
+DEPENDENTS_QUANTIFIED = re.compile(
+    r"\b(?:a|an)\s+(?:couple|few|lot|lots|bunch|number|handful|pair|dozen|several|many)\b", re.IGNORECASE
+)
+DEPENDENTS_LISTED = re.compile(DEPENDENT_NOUNS + r"\b.*\band\b.*\b" + DEPENDENT_NOUNS + r"\b", re.IGNORECASE)
+NO_DEPENDENTS_PATTERN = re.compile(r"\b(?:no|don't have any|do not have any)\s+(?:kids|children|dependents)\b", re.IGNORECASE)
+
+FIELDS = ("first_name", "last_name", "no_of_dependents")
+FIELD_KEYWORDS = {
+    "first_name": {"name", "i'm", "am", "call", "this"},
+    "last_name": {"name", "i'm", "am", "call", "this", "surname", "last"},
+    "no_of_dependents": {"kid", "kids", "child", "children", "son", "sons", "daughter", "daughters",
+                         "dependent", "dependents", "boy", "girl", "family", "baby"},
+}
+MAX_CANDIDATE_SENTENCES = 8
+
+FIELD_LOOKUP_FUNCTION = {
+    "name": "fn_locate_fields",
+    "parameters": {
+        "type": "object",
+        "properties": {
+            field: {
+                "type": "object",
+                "properties": {
+                    "value": {"type": "integer" if field == "no_of_dependents" else "string"},
+                    "sentence_index": {"type": "integer"},
+                },
+            }
+            for field in FIELDS
+        },
+    },
+}
+
+extraction_stats = {"requests": 0, "model_calls": 0, "fields": {"rule": 0, "model": 0, "missing": 0}}
+_stats_lock = threading.Lock()
+
+
+def _normalize(token):
+    return re.sub(r"[^\w']", "", token).lower()
+
+
+def segment_sentences(transcript):
+    # Split words into sentences using the punctuation in `text` and long pauses between words
+    words, starts, ends = transcript.words, transcript.starts, transcript.ends
+    tokens = (transcript.text or "").split()
+    sentences = []
+    current = []
+    token_index = 0
+    # The punctuated token each word was matched to, or the bare word
+    spoken = list(words)
+    for index, word in enumerate(words):
+        ends_sentence = False
+        normalized = _normalize(word)
+        for lookahead in range(token_index, min(token_index + 4, len(tokens))):
+            if _normalize(tokens[lookahead]) == normalized:
+                ends_sentence = bool(SENTENCE_END.search(tokens[lookahead]))
+                spoken[index] = tokens[lookahead]
+                token_index = lookahead + 1
+                break
+        if current and starts[index] - ends[current[-1]] > PAUSE_SECONDS:
+            sentences.append(current)
+            current = []
+        current.append(index)
+        if ends_sentence:
+            sentences.append(current)
+            current = []
+    if current:
+        sentences.append(current)
+    return [
+        {
+            "value": " ".join(words[i] for i in indices),
+            # With punctuation, for the rules; only value and the times are returned
+            "text": " ".join(spoken[i] for i in indices),
+            "start_time": round(starts[indices[0]], 2),
+            "end_time": round(ends[indices[-1]], 2),
+        }
+        for indices in sentences
+    ]
+
+
+def is_surname(word):
+    return bool(word) and word.lower() not in NOT_SURNAMES and not CONTRACTION.search(word)
+
+
+def index_sentences(sentences):
+    index = {}
+    for sentence_id, sentence in enumerate(sentences):
+        for token in sentence["value"].split():
+            index.setdefault(_normalize(token), set()).add(sentence_id)
+    return index
+
+
+def _field(value, sentence):
+    return {
+        "value": value,
+        "sentence_info": {"sentence_spoken": {
+            "value": sentence["value"], "start_time": sentence["start_time"], "end_time": sentence["end_time"],
+        }},
+    }
+
+
+class FieldExtraction:
+    def __init__(self, transcript):
+        self.sentences = segment_sentences(transcript)
+        self.index = index_sentences(self.sentences)
+        self.fields = {}
+        self.sources = {}
+        self.candidates = []
+        self.asked_model = False
+        self._apply_rules()
+
+    def _apply_rules(self):
+        first_name_only = None
+        full_name = None
+        dependents_ambiguous = False
+        for sentence in self.sentences:
+            text = sentence["text"]
+            match = NAME_PATTERN.search(text)
+            if match and full_name is None:
+                # A full name anywhere beats a first name alone said earlier
+                if is_surname(match.group(2)):
+                    full_name = (match, sentence)
+                elif first_name_only is None:
+                    first_name_only = (match, sentence)
+            if "no_of_dependents" in self.fields or dependents_ambiguous:
+                continue
+            match = DEPENDENTS_PATTERN.search(text)
+            if match:
+                if (len(DEPENDENT_COUNT.findall(text)) > 1 or DEPENDENTS_LISTED.search(text)
+                        or DEPENDENTS_QUANTIFIED.search(text)):
+                    dependents_ambiguous = True
+                    continue
+                count = match.group(1).lower()
+                self._resolve("no_of_dependents", int(count) if count.isdigit() else NUMBER_WORDS[count], sentence, "rule")
+            elif NO_DEPENDENTS_PATTERN.search(text):
+                self._resolve("no_of_dependents", 0, sentence, "rule")
+        if full_name is not None:
+            match, sentence = full_name
+            self._resolve("first_name", match.group(1), sentence, "rule")
+            self._resolve("last_name", match.group(2), sentence, "rule")
+        elif first_name_only is not None:
+            match, sentence = first_name_only
+            self._resolve("first_name", match.group(1), sentence, "rule")
+
+    def _resolve(self, field, value, sentence, source):
+        self.fields[field] = _field(value, sentence)
+        self.sources[field] = source
+
+    def missing(self):
+        return [field for field in FIELDS if field not in self.fields]
+
+    def needs_model(self):
+        missing = self.missing()
+        if not missing:
+            return False
+        sentence_ids = set()
+        for field in missing:
+            for keyword in FIELD_KEYWORDS[field]:
+                sentence_ids |= self.index.get(keyword, set())
+        self.candidates = sorted(sentence_ids)[:MAX_CANDIDATE_SENTENCES]
+        return bool(self.candidates)
+
+    def model_messages(self):
+        # Only the candidate sentences go to the model, never the word-level JSON
+        numbered = "\n".join(f"{i}: {self.sentences[i]['value']}" for i in self.candidates)
+        return [
+            {"role": "system", "content": "You are a helpful assistant that infers personal data from transcriptions."},
+            {"role": "user", "content": (
+                f"Sentences from a transcription, each prefixed with its index:\n{numbered}\n\n"
+                f"For each of {', '.join(self.missing())} that these sentences state or imply, return its value "
+                "and the index of the sentence it comes from. Leave out fields that are not mentioned."
+            )},
+        ]
+
+    def apply_model_answer(self, arguments):
+        self.asked_model = True
+        for field in self.missing():
+            answer = arguments.get(field) or {}
+            sentence_id = answer.get("sentence_index")
+            if answer.get("value") in (None, "") or sentence_id not in self.candidates:
+                continue
+            self._resolve(field, answer["value"], self.sentences[sentence_id], "model")
+
+    def result(self):
+        for field in self.missing():
+            self.sources[field] = "missing"
+        with _stats_lock:
+            extraction_stats["requests"] += 1
+            if self.asked_model:
+                extraction_stats["model_calls"] += 1
+            for source in self.sources.values():
+                extraction_stats["fields"][source] += 1
+        return {"data": [dict(self.fields)], "extraction": dict(self.sources)}
+
+
+def extract_personal_info(transcript, ask_model):
+    extraction = FieldExtraction(transcript)
+    if extraction.needs_model():
+        extraction.apply_model_answer(ask_model(extraction.model_messages()))
+    return extraction.result()
@@ -0,0 +1,143 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import os
+import re
+import shutil
+import subprocess
+
+load_dotenv()
+
+# Splitting and re-encoding is done with the ffmpeg/ffprobe binaries, which must be on PATH
+chunk_seconds = float(os.getenv("long_audio_chunk_seconds", "120"))
+overlap_seconds = float(os.getenv("long_audio_overlap_seconds", "2"))
+long_audio_workers = int(os.getenv("long_audio_workers", "4"))
+long_audio_min_bytes = int(os.getenv("long_audio_min_bytes", str(20 * 1024 * 1024)))
+
+class LongAudioUnavailable(RuntimeError):
+    pass
+
+
+def missing_tools():
+    return [tool for tool in ("ffmpeg", "ffprobe") if shutil.which(tool) is None]
+
+
+SILENCE_START = re.compile(r"silence_start: (-?[\d.]+)")
+SILENCE_END = re.compile(r"silence_end: (-?[\d.]+)")
+
+
+def probe_duration(audio_file_path):
+    output = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", audio_file_path],
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return float(output.strip())
+
+
+def detect_silences(audio_file_path, noise_db=-35, min_silence=0.4):
+    stderr = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", audio_file_path,
+         "-af", f"silencedetect=noise={noise_db}dB:d={min_silence}", "-f", "null", "-"],
+        capture_output=True, text=True, check=True,
+    ).stderr
+    starts = [float(m) for m in SILENCE_START.findall(stderr)]
+    ends = [float(m) for m in SILENCE_END.findall(stderr)]
+    return list(zip(starts, ends))
+
+
+def plan_chunks(duration, silences, target=chunk_seconds, overlap=overlap_seconds):
+    # Cut near every `target` seconds, preferring the middle of the closest silence,
+    # then widen each chunk by `overlap` on both sides so no word is split at a cut
+    midpoints = sorted((start + end) / 2 for start, end in silences)
+    cuts = [0.0]
+    while duration - cuts[-1] > target * 1.25:
+        ideal = cuts[-1] + target
+        window = [m for m in midpoints if abs(m - ideal) <= target / 4 and m > cuts[-1]]
+        cuts.append(min(window, key=lambda m: abs(m - ideal)) if window else ideal)
+    cuts.append(duration)
+    return [
+        {
+            "start": max(0.0, cut_start - overlap),
+            "end": min(duration, cut_end + overlap),
+            "owned_start": cut_start,
+            "owned_end": cut_end,
+        }
+        for cut_start, cut_end in zip(cuts, cuts[1:])
+    ]
+
+
+def extract_chunk(audio_file_path, start, end):
+    # Mono 16 kHz MP3 keeps each upload well under the Whisper size limit
+    return subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-ss", f"{start:.3f}", "-to", f"{end:.3f}",
+         "-i", audio_file_path, "-vn", "-ac", "1", "-ar", "16000", "-b:a", "48k", "-f", "mp3", "pipe:1"],
+        capture_output=True, check=True,
+    ).stdout
+
+
+def word_offsets(text, words):
+    # Character offset in `text` where each word starts, found in order; None where a word cannot be matched
+    offsets = []
+    cursor = 0
+    for word in words:
+        token = word["word"].strip()
+        match = re.compile(r"(?<!\w)" + re.escape(token) + r"(?!\w)", re.IGNORECASE).search(text, cursor) if token else None
+        if match is None:
+            offsets.append(None)
+            continue
+        offsets.append(match.start())
+        cursor = match.end()
+    return offsets
+
+
+def owned_text(result, first, last):
+    # The part of a chunk's punctuated text spoken by words[first:last], cut at word starts
+    text = result.get("text") or ""
+    offsets = word_offsets(text, result["words"])
+    start = 0 if first == 0 else offsets[first]
+    end = len(text) if last == len(offsets) else offsets[last]
+    if start is None or end is None:
+        return " ".join(word["word"] for word in result["words"][first:last])
+    return text[start:end].strip()
+
+
+def merge_chunk_transcriptions(chunks, results, duration):
+    # Shift chunk-local timestamps onto the global timeline and keep each word only in
+    # the chunk that owns its midpoint, which drops the duplicates from the overlaps
+    words = []
+    texts = []
+    for chunk, result in zip(chunks, results):
+        kept = []
+        for index, word in enumerate(result["words"]):
+            start = word["start"] + chunk["start"]
+            end = word["end"] + chunk["start"]
+            midpoint = (start + end) / 2
+            last_chunk = chunk is chunks[-1]
+            if chunk["owned_start"] <= midpoint and (midpoint < chunk["owned_end"] or last_chunk):
+                words.append({"word": word["word"], "start": start, "end": end})
+                kept.append(index)
+        if kept:
+            texts.append(owned_text(result, kept[0], kept[-1] + 1))
+    words.sort(key=lambda word: word["start"])
+    first = results[0] if results else {}
+    return {
+        "text": " ".join(text for text in texts if text),
+        "task": first.get("task", "transcribe"),
+        "language": first.get("language"),
+        "duration": duration,
+        "words": words,
+    }
+
+
+def transcribe_long_audio(audio_file_path, transcribe_chunk, max_workers=long_audio_workers):
+    duration = probe_duration(audio_file_path)
+    chunks = plan_chunks(duration, detect_silences(audio_file_path))
+    name = os.path.splitext(os.path.basename(audio_file_path))[0]
+
+    def run(index_chunk):
+        index, chunk = index_chunk
+        audio_bytes = extract_chunk(audio_file_path, chunk["start"], chunk["end"])
+        return transcribe_chunk(f"{name}_{index}.mp3", audio_bytes)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="long-audio") as pool:
+        results = list(pool.map(run, enumerate(chunks)))
+    return merge_chunk_transcriptions(chunks, results, duration)
@@ -1,16 +1,56 @@
-from flask import Flask
+from flask import Flask, Response, g, jsonify, request
 from ai_speech_to_text_whisper import ai_speech_to_text_whisper_bp
-# from ai_speech_to_text_gemini import ai_speech_to_text_gemini_bp
+from ai_speech_to_text_gemini import ai_speech_to_text_gemini_bp
 from ai_speech_to_text_gpt4o import ai_speech_to_text_gpt4o_bp
+from batch import batch_bp
+from providers import provider_enabled, warm_up, warmup_providers
+from upstream import upstream_metrics
+from tracing import configure_logging, finish_trace, render_metrics, start_trace
 from dotenv import load_dotenv
 import os
 
+configure_logging()
 app = Flask(__name__)
 
-# register blueprints for each API
-app.register_blueprint(ai_speech_to_text_whisper_bp)
-# app.register_blueprint(ai_speech_to_text_gemini_bp)
-app.register_blueprint(ai_speech_to_text_gpt4o_bp)
+# register blueprints for each enabled provider; clients are built on first use unless warmed up
+if provider_enabled("openai"):
+    app.register_blueprint(ai_speech_to_text_whisper_bp)
+    app.register_blueprint(ai_speech_to_text_gpt4o_bp)
+    app.register_blueprint(batch_bp)
+if provider_enabled("gemini"):
+    # Mounted under /gemini so it does not collide with the Whisper /transcribe route
+    app.register_blueprint(ai_speech_to_text_gemini_bp, url_prefix="/gemini")
+if warmup_providers:
+    warm_up()
+
+@app.route('/upstream/stats', methods=['GET'])
+def upstream_stats():
+    return jsonify(upstream_metrics())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+@app.before_request
+def begin_trace():
+    # Label by route pattern, not the raw path, so ids in URLs do not explode the series
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    g.trace = start_trace(route, request.headers.get("X-Request-Id"))
+
+@app.after_request
+def end_trace(response):
+    trace = g.pop("trace", None)
+    if trace is not None:
+        response.headers["X-Request-Id"] = trace.request_id
+        # Closed once the body is fully sent, so streamed replies are timed to their last byte
+        response.call_on_close(lambda: finish_trace(trace, response.status_code))
+    return response
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    load_dotenv()
+    # "asgi" serves the same routes from asgi_app with async OpenAI/Vertex clients
+    if os.getenv("serving_mode", "sync") == "asgi":
+        from asgi_app import app as asgi_app
+        asgi_app.run()
+    else:
+        app.run(debug=True)
\ No newline at end of file
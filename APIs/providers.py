@@ -0,0 +1,92 @@
+from dotenv import load_dotenv
+import logging
+import os
+import sys
+import threading
+import time
+
+from tracing import collectors, gauge_lines
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Comma-separated providers to serve: "openai" backs Whisper, gpt-4o and tts-1, "gemini" the /gemini routes
+enabled_providers = {name.strip() for name in os.getenv("providers", "openai").split(",") if name.strip()}
+if os.getenv("enable_gemini", "false").lower() == "true":
+    enabled_providers.add("gemini")
+# Build enabled clients at startup instead of on the first request, e.g. before a preforking server forks
+warmup_providers = os.getenv("providers_warmup", "false").lower() == "true"
+
+# Base exception of each SDK, by module; only SDKs that were imported can have raised
+SDK_ERRORS = {"openai": "OpenAIError", "google.api_core.exceptions": "GoogleAPIError"}
+
+
+def provider_enabled(name):
+    return name in enabled_providers
+
+
+class LazyProvider:
+    # Stands in for an SDK client: the SDK is imported and the client built on first attribute access,
+    # so importing a blueprint never pays for a provider it does not call
+    def __init__(self, provider, name, factory):
+        self.provider = provider
+        self.name = name
+        self.init_seconds = None
+        self._factory = factory
+        self._instance = None
+        self._lock = threading.Lock()
+
+    @property
+    def initialized(self):
+        return self._instance is not None
+
+    def get(self):
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    started = time.perf_counter()
+                    instance = self._factory()
+                    self.init_seconds = time.perf_counter() - started
+                    logger.info("Initialized %s in %.0fms", self.name, self.init_seconds * 1000)
+                    self._instance = instance
+        return self._instance
+
+    def __getattr__(self, attribute):
+        return getattr(self.get(), attribute)
+
+
+registry = []
+
+
+def lazy_provider(provider, name, factory):
+    lazy = LazyProvider(provider, name, factory)
+    registry.append(lazy)
+    return lazy
+
+
+def provider_errors():
+    return tuple(getattr(sys.modules[module], name) for module, name in SDK_ERRORS.items() if module in sys.modules)
+
+
+def warm_up():
+    for lazy in registry:
+        if provider_enabled(lazy.provider):
+            lazy.get()
+
+
+def provider_state():
+    return {
+        lazy.name: {"provider": lazy.provider, "enabled": provider_enabled(lazy.provider),
+                    "initialized": lazy.initialized, "init_seconds": lazy.init_seconds}
+        for lazy in registry
+    }
+
+
+def provider_metric_lines():
+    return gauge_lines(
+        "provider_init_seconds", "Time taken to import and build each provider client.",
+        [({"client": lazy.name}, lazy.init_seconds) for lazy in registry if lazy.initialized],
+    )
+
+
+collectors.append(provider_metric_lines)
@@ -0,0 +1,372 @@
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from dotenv import load_dotenv
+
+# The real key must be in place before benchmark defaults it for the fake upstreams
+load_dotenv()
+# Folding old turns into a summary, or answering a repeated turn from a running one, depends on timing
+os.environ.setdefault("context_budget_tokens", "1000000")
+os.environ.setdefault("conversation_coalesce_turns", "false")
+
+# Importing benchmark also switches the caches and on-disk stores off, so every run reaches the upstream
+from benchmark import start_server
+from turn_engine_ab import load_user_turns
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_AUDIO_DIR = os.path.join(HERE, "..", "Sample Audios")
+CONVERSATION_DIR = os.path.join(HERE, "..", "conversations")
+FIXTURE_DIR = os.path.join(HERE, "replay_fixtures")
+# Hop-by-hop and length headers are not replayed; bodies are always sent whole
+DROPPED_HEADERS = {"connection", "content-length", "transfer-encoding", "content-encoding", "keep-alive"}
+
+
+def slug(text):
+    # Keeps case and underscores, so "Invoice Final" and "Invoice_final" get their own files
+    return re.sub(r"[^A-Za-z0-9_.]+", "-", text).strip("-")
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def multipart_fields(content_type, body):
+    # Whisper uploads: the boundary is random, so the request is identified by its fields and file hash
+    message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param("name", header="content-disposition")
+        payload = part.get_payload(decode=True) or b""
+        fields[name] = digest(payload) if part.get_filename() else payload.decode("utf-8", "replace")
+    return fields
+
+
+def request_fingerprint(path, content_type, body):
+    if content_type.startswith("multipart/form-data"):
+        normalized = multipart_fields(content_type, body)
+    else:
+        try:
+            normalized = json.loads(body or b"null")
+        except ValueError:
+            normalized = digest(body)
+    return digest(json.dumps([path, normalized], sort_keys=True).encode("utf-8"))
+
+
+class Scenario:
+    # One fixture file: the upstream calls a sample or conversation makes, and the outputs it produced
+    def __init__(self, name, fixture_dir):
+        self.name = name
+        self.path = os.path.join(fixture_dir, f"{slug(name)}.json")
+        self.calls = {}
+        self.expected = None
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                stored = json.load(f)
+            self.calls = {call["key"]: call for call in stored["calls"]}
+            self.expected = stored.get("expected")
+        self.sequence = {}
+        self.used = 0
+        self.drifted = []
+        self.missing = []
+        self.lock = threading.Lock()
+
+    def call_key(self, path, fingerprint):
+        # Transcriptions and speech depend only on their content and may run in parallel (chunks, TTS
+        # sentences), so they are keyed by it. Chat calls are keyed by their order within the scenario, so a
+        # changed prompt is still answered and reported as drift instead of failing the run
+        if not path.endswith("/chat/completions"):
+            return f"{path}#{fingerprint}"
+        with self.lock:
+            index = self.sequence.get(path, 0)
+            self.sequence[path] = index + 1
+        return f"{path}#{index}"
+
+    def save(self, expected):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        calls = sorted(self.calls.values(), key=lambda call: call["key"])
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"scenario": self.name, "calls": calls, "expected": expected}, f, indent=2, ensure_ascii=False)
+            f.write("\n")
+
+
+def encode_body(content_type, body):
+    # Text bodies are kept verbatim; audio is kept as its length only, which is all a replay needs
+    if content_type.startswith(("application/json", "text/")):
+        return {"body": body.decode("utf-8")}
+    return {"body_bytes": len(body)}
+
+
+def decode_body(call):
+    if "body" in call:
+        return call["body"].encode("utf-8")
+    return b"\xff" * call["body_bytes"]
+
+
+def fixture_handler(server_state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out in separate writes; without this each replayed call waits on a delayed ACK
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_body(self, status, content_type, body):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            content_type = self.headers.get("Content-Type", "")
+            scenario = server_state["scenario"]
+            fingerprint = request_fingerprint(self.path, content_type, body)
+            key = scenario.call_key(self.path, fingerprint)
+            if server_state["record"]:
+                try:
+                    call = self.forward(body)
+                except OSError as e:
+                    message = json.dumps({"error": {"message": f"Recording upstream unreachable: {e}"}})
+                    return self.send_body(502, "application/json", message.encode("utf-8"))
+                call.update(key=key, fingerprint=fingerprint)
+                with scenario.lock:
+                    scenario.calls[key] = call
+            else:
+                call = scenario.calls.get(key)
+                if call is None:
+                    scenario.missing.append(key)
+                    message = json.dumps({"error": {"message": f"No fixture for {key} in {scenario.path}"}})
+                    return self.send_body(404, "application/json", message.encode("utf-8"))
+                if call["fingerprint"] != fingerprint:
+                    scenario.drifted.append(key)
+                time.sleep(call["seconds"] * server_state["latency_scale"])
+            with scenario.lock:
+                scenario.used += 1
+            self.send_body(call["status"], call["content_type"], decode_body(call))
+
+        def forward(self, body):
+            headers = {name: value for name, value in self.headers.items()
+                       if name.lower() not in DROPPED_HEADERS and name.lower() != "host"}
+            outgoing = urllib.request.Request(server_state["upstream"] + self.path, data=body, headers=headers,
+                                              method="POST")
+            started = time.perf_counter()
+            try:
+                with urllib.request.urlopen(outgoing, timeout=300) as response:
+                    status, received, content_type = response.status, response.read(), response.headers.get("Content-Type", "")
+            except urllib.error.HTTPError as e:
+                status, received, content_type = e.code, e.read(), e.headers.get("Content-Type", "")
+            seconds = round(time.perf_counter() - started, 4)
+            return {"path": self.path, "status": status, "content_type": content_type, "seconds": seconds,
+                    **encode_body(content_type, received)}
+
+    return Handler
+
+
+def audio_scenarios():
+    return {f"audio/{os.path.splitext(os.path.basename(path))[0]}": path
+            for path in sorted(glob.glob(os.path.join(SAMPLE_AUDIO_DIR, "*")))}
+
+
+def conversation_scenarios():
+    return {f"conversation/{os.path.splitext(os.path.basename(path))[0]}": load_user_turns(path)
+            for path in sorted(glob.glob(os.path.join(CONVERSATION_DIR, "*.txt")))}
+
+
+def field_values(payload):
+    return [{name: field.get("value") if isinstance(field, dict) else field for name, field in sorted(record.items())}
+            for record in payload.get("data") or []]
+
+
+def check_transcript(payload):
+    failures = []
+    words = payload.get("words") or []
+    if not words:
+        failures.append("transcript has no words")
+    if any(word["end"] < word["start"] for word in words):
+        failures.append("a word ends before it starts")
+    if [word["start"] for word in words] != sorted(word["start"] for word in words):
+        failures.append("words are not in time order")
+    return failures
+
+
+def check_fields(payload, duration):
+    failures = []
+    for record in payload.get("data") or []:
+        for name, field in record.items():
+            spoken = ((field or {}).get("sentence_info") or {}).get("sentence_spoken") if isinstance(field, dict) else None
+            if not isinstance(spoken, dict) or "start_time" not in spoken:
+                continue
+            if not 0 <= spoken["start_time"] <= spoken["end_time"] <= (duration or float("inf")) + 1:
+                failures.append(f"{name}: sentence time {spoken['start_time']}-{spoken['end_time']} is outside the audio")
+    return failures
+
+
+def run_audio(client, path):
+    failures = []
+    transcribed = client.post("/transcribe", json={"audio_file_path": path}, buffered=True)
+    transcript = transcribed.get_json() or {}
+    if transcribed.status_code != 200:
+        return {"transcribe_status": transcribed.status_code}, [f"/transcribe returned {transcribed.status_code}: {transcript}"]
+    failures += check_transcript(transcript)
+    played = client.post("/playback", json={"audio_file_path": path}, buffered=True)
+    fields = played.get_json() or {}
+    if played.status_code != 200:
+        failures.append(f"/playback returned {played.status_code}: {fields}")
+    else:
+        failures += check_fields(fields, transcript.get("duration"))
+    outputs = {
+        "text": transcript.get("text"),
+        "words": len(transcript.get("words") or []),
+        "fields": field_values(fields),
+    }
+    return outputs, failures
+
+
+def run_conversation(client, turns, conversation_store):
+    failures = []
+    conversation_id = f"replay_{uuid.uuid4().hex}"
+    replies = []
+    for index, text in enumerate(turns):
+        response = client.post("/text-assist", json={"conversation_id": conversation_id, "user_input_text": text},
+                               buffered=True)
+        payload = response.get_json() or {}
+        if response.status_code != 200:
+            failures.append(f"turn {index} returned {response.status_code}: {payload}")
+            break
+        if not payload.get("reply_text"):
+            failures.append(f"turn {index} has an empty reply")
+        replies.append({"reply_text": payload.get("reply_text"), "detailed_response": payload.get("detailed_response")})
+    record = conversation_store.load(conversation_id) or {"messages": []}
+    roles = [message["role"] for message in record["messages"]][1:]
+    if roles[-2 * len(replies):] != ["user", "assistant"] * len(replies):
+        failures.append(f"stored messages do not alternate user/assistant: {roles}")
+    return {"replies": replies}, failures
+
+
+def compare_expected(expected, outputs):
+    if expected is None:
+        return ["no expected outputs recorded; run with --record"]
+    return [f"{key} changed: expected {expected.get(key)!r}, got {outputs.get(key)!r}"
+            for key in sorted(set(expected) | set(outputs)) if expected.get(key) != outputs.get(key)]
+
+
+def stage_summary(traces):
+    durations = {}
+    for trace in traces:
+        for span in trace["spans"]:
+            durations.setdefault(span["name"], []).append(span["duration_ms"])
+    summary = {}
+    for name, values in sorted(durations.items()):
+        values.sort()
+        summary[name] = {
+            "count": len(values),
+            "total_ms": round(sum(values), 2),
+            "p50_ms": round(statistics.median(values), 2),
+            "p95_ms": round(values[max(0, int(round(0.95 * len(values))) - 1)], 2),
+        }
+    return summary
+
+
+def compare_stages(previous, current):
+    # Relative change of each stage's median; positive is slower
+    return {name: round(now["p50_ms"] / previous[name]["p50_ms"] - 1, 3)
+            for name, now in current.items() if previous.get(name, {}).get("p50_ms")}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay every sample audio and recorded conversation through the blueprints against recorded upstream responses."
+    )
+    parser.add_argument("--record", action="store_true", help="call the real upstream and (re)write the fixtures")
+    parser.add_argument("--upstream", default="https://api.openai.com", help="upstream to record from")
+    parser.add_argument("--fixtures", default=FIXTURE_DIR)
+    parser.add_argument("--only", default="", help="run scenarios whose name contains this text")
+    parser.add_argument("--latency-scale", type=float, default=0.0,
+                        help="replay each upstream call after its recorded duration times this (0 replays instantly)")
+    parser.add_argument("--strict", action="store_true", help="fail scenarios whose chat requests differ from the recording")
+    parser.add_argument("--update-expected", action="store_true", help="accept the current outputs as the expected ones")
+    parser.add_argument("--output", help="write the report JSON here")
+    parser.add_argument("--compare", help="previous report JSON to diff stage timings against")
+    args = parser.parse_args()
+
+    server_state = {"record": args.record, "upstream": args.upstream.rstrip("/"), "latency_scale": args.latency_scale,
+                    "scenario": None}
+    fixture_server = start_server(ThreadingHTTPServer(("127.0.0.1", 0), fixture_handler(server_state)))
+    # Read by the OpenAI SDK when the shared clients are first built
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{fixture_server.server_port}/v1"
+    if not args.record:
+        os.environ.setdefault("openai_api_key", "replay")
+
+    import main as flask_main
+    import ai_speech_to_text_gpt4o as gpt4o
+    from tracing import trace_listeners
+    traces = []
+    trace_listeners.append(traces.append)
+    client = flask_main.app.test_client()
+
+    scenarios = [(name, run_audio, path) for name, path in audio_scenarios().items()]
+    scenarios += [(name, run_conversation, turns) for name, turns in conversation_scenarios().items()]
+    report = {"mode": "record" if args.record else "replay", "scenarios": {}}
+    for name, run, source in scenarios:
+        if args.only not in name:
+            continue
+        scenario = Scenario(name, args.fixtures)
+        if args.record:
+            scenario.calls = {}
+        server_state["scenario"] = scenario
+        first_trace = len(traces)
+        started = time.perf_counter()
+        if run is run_conversation:
+            outputs, failures = run(client, source, gpt4o.conversations)
+        else:
+            outputs, failures = run(client, source)
+        elapsed = time.perf_counter() - started
+        if args.record or args.update_expected:
+            scenario.save(outputs)
+        else:
+            failures += compare_expected(scenario.expected, outputs)
+        failures += [f"no fixture for {key}" for key in scenario.missing]
+        if args.strict:
+            failures += [f"request differs from the recording: {key}" for key in scenario.drifted]
+        report["scenarios"][name] = {
+            "passed": not failures,
+            "failures": failures,
+            "duration_ms": round(elapsed * 1000, 2),
+            "upstream_calls": scenario.used,
+            "drifted_requests": len(scenario.drifted),
+            "stages": stage_summary(traces[first_trace:]),
+        }
+    report["stages"] = stage_summary(traces)
+    report["passed"] = sum(1 for result in report["scenarios"].values() if result["passed"])
+    report["failed"] = len(report["scenarios"]) - report["passed"]
+    if args.compare:
+        with open(args.compare) as f:
+            report["stage_p50_change"] = compare_stages(json.load(f).get("stages", {}), report["stages"])
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    fixture_server.shutdown()
+    sys.exit(1 if report["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+from dotenv import load_dotenv
+import hashlib
+import os
+import re
+
+from tracing import collectors, gauge_lines
+from transcription_cache import DiskTier, MemoryTier, TieredCache, transcription_cache
+
+load_dotenv()
+
+# Only short texts (follow-up questions, sentences from /stream-text) are worth keeping;
+# full generated emails or invoices rarely repeat
+tts_cache_max_chars = int(os.getenv("tts_cache_max_chars", "300"))
+
+
+def tts_cache_key(text, voice, model):
+    return hashlib.sha256(f"{model}|{voice}|{text}".encode("utf-8")).hexdigest()
+
+
+def normalize_intent_input(text):
+    # Case, punctuation and spacing do not change which task the user is asking for
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def intent_cache_key(text, model):
+    return hashlib.sha256(f"{model}|{normalize_intent_input(text)}".encode("utf-8")).hexdigest()
+
+
+def build_tiers(prefix, memory_entries, directory, disk_bytes, suffix):
+    tiers = [MemoryTier(int(os.getenv(f"{prefix}_memory_entries", str(memory_entries))))]
+    cache_dir = os.getenv(f"{prefix}_dir", directory)
+    if cache_dir:
+        tiers.append(DiskTier(
+            cache_dir,
+            max_bytes=int(os.getenv(f"{prefix}_disk_bytes", str(disk_bytes))),
+            suffix=suffix,
+        ))
+    return tiers
+
+
+tts_cache = TieredCache(build_tiers("tts_cache", 256, ".cache/tts", 128 * 1024 * 1024, ".mp3"))
+intent_cache = TieredCache(
+    build_tiers("intent_cache", 4096, "", 8 * 1024 * 1024, ".txt"),
+    encode=lambda intent: intent.encode("utf-8"),
+    decode=lambda raw: raw.decode("utf-8"),
+)
+
+
+def cacheable_tts_text(text):
+    return len(text) <= tts_cache_max_chars
+
+
+def response_cache_stats():
+    return {"tts": tts_cache.stats(), "intent": intent_cache.stats()}
+
+
+def cache_metric_lines():
+    caches = {"transcription": transcription_cache, "tts": tts_cache, "intent": intent_cache}
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    return gauge_lines(
+        "cache_hits", "Cache hits by cache and tier.",
+        [({"cache": name, "tier": tier}, count) for name, s in stats.items() for tier, count in s["hits"].items()],
+    ) + gauge_lines(
+        "cache_misses", "Cache misses by cache.", [({"cache": name}, s["misses"]) for name, s in stats.items()],
+    ) + gauge_lines(
+        "cache_disk_bytes", "Bytes held by the disk tier.", [({"cache": name}, s["disk_bytes"]) for name, s in stats.items()],
+    )
+
+
+collectors.append(cache_metric_lines)
@@ -0,0 +1,85 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+HEAVY_MODULES = ("openai", "httpx", "httpx2", "vertexai", "google.auth", "tiktoken")
+
+# Runs in a fresh interpreter so nothing is already imported
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+imported = time.perf_counter() - started
+loaded = [name for name in {heavy!r} if name in sys.modules]
+import providers
+init = {{}}
+for lazy in providers.registry:
+    if not providers.provider_enabled(lazy.provider):
+        continue
+    try:
+        lazy.get()
+        init[lazy.name] = lazy.init_seconds
+    except Exception as e:
+        init[lazy.name] = f"{{type(e).__name__}}: {{e}}"
+print(json.dumps({{"import_seconds": imported, "heavy_modules_at_import": loaded, "init_seconds": init}}))
+"""
+
+
+def probe(module, providers):
+    env = dict(os.environ)
+    env.setdefault("openai_api_key", "startup-benchmark")
+    env.setdefault("conversation_log_dir", tempfile.mkdtemp(prefix="startup-benchmark-"))
+    env.setdefault("log_level", "WARNING")
+    env["providers"] = providers
+    env["providers_warmup"] = "false"
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=HERE, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    imports = [run["import_seconds"] * 1000 for run in runs]
+    init = {}
+    for run in runs:
+        for name, value in run["init_seconds"].items():
+            init.setdefault(name, []).append(value)
+    return {
+        "import_ms": {"median": round(statistics.median(imports), 1), "max": round(max(imports), 1)},
+        "heavy_modules_at_import": runs[-1]["heavy_modules_at_import"],
+        "first_use_init_ms": {
+            name: round(statistics.median(values) * 1000, 1) if all(isinstance(v, float) for v in values) else values[-1]
+            for name, values in init.items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure cold-start import time and first-use provider init.")
+    parser.add_argument("--modules", default="main", help="comma-separated app modules, e.g. main,asgi_app")
+    parser.add_argument("--providers", default="openai;openai,gemini", help="semicolon-separated provider configs")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", help="write results JSON here")
+    args = parser.parse_args()
+
+    results = {"runs": args.runs, "startup": {}}
+    for module in args.modules.split(","):
+        for providers in args.providers.split(";"):
+            runs = [probe(module, providers) for _ in range(args.runs)]
+            results["startup"][f"{module} [{providers}]"] = summarize(runs)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
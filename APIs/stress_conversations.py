@@ -0,0 +1,163 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+import argparse
+import asyncio
+import http.client
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+
+# Folding old turns into a summary would drop messages the consistency check looks for
+os.environ.setdefault("context_budget_tokens", "1000000")
+
+from benchmark import FakeUpstreamConfig, fake_openai_handler, parse_latency, start_server
+
+ROUTES = ("/text-assist", "/stream-text")
+
+
+def turn_plan(route, conversations, turns, duplicates):
+    # Every turn of every conversation, shuffled so turns of one conversation race each other.
+    # /text-assist turns are also sent `duplicates` times back to back to exercise coalescing
+    prefix = f"stress_{route.strip('/')}_{uuid.uuid4().hex[:8]}"
+    expected = {f"{prefix}_{c}": [f"conversation {c} answer {t}" for t in range(turns)] for c in range(conversations)}
+    copies = duplicates if route == "/text-assist" else 1
+    turns = [(conversation_id, text) for conversation_id, texts in expected.items() for text in texts]
+    random.shuffle(turns)
+    bodies = [
+        {"conversation_id": conversation_id, "user_input_text": text}
+        for conversation_id, text in turns for _ in range(copies)
+    ]
+    return expected, bodies, copies
+
+
+def check_conversation(store, conversation_id, texts, copies):
+    record = store.load(conversation_id)
+    if record is None:
+        return ["missing"]
+    problems = []
+    roles = [message["role"] for message in record["messages"]]
+    if roles[:1] != ["system"] or roles[1:] != ["user", "assistant"] * ((len(roles) - 1) // 2):
+        problems.append(f"messages out of turn order: {roles}")
+    users = [message["content"] for message in record["messages"] if message["role"] == "user"]
+    # A copy that arrives after the first has finished is a turn of its own; coalesced copies add nothing
+    if set(users) != set(texts) or any(users.count(text) > copies for text in texts):
+        problems.append(f"user messages {len(users)} do not match turns sent {len(texts)} x up to {copies}")
+    if record.get("logged_messages") != len(record["messages"]):
+        problems.append(f"logged_messages {record.get('logged_messages')} != {len(record['messages'])} messages")
+    return problems
+
+
+def summarize(store, expected, copies, statuses, elapsed, coalesced):
+    problems = {}
+    for conversation_id, texts in expected.items():
+        found = check_conversation(store, conversation_id, texts, copies)
+        if found:
+            problems[conversation_id] = found
+    return {
+        "requests": len(statuses),
+        "errors": sum(1 for status in statuses if status >= 400),
+        "seconds": round(elapsed, 2),
+        "coalesced": coalesced,
+        "conversations": len(expected),
+        "inconsistent": len(problems),
+        "problems": dict(list(problems.items())[:5]),
+    }
+
+
+def post(port, route, body):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    conn.request("POST", route, body=json.dumps(body), headers={"Content-Type": "application/json"})
+    response = conn.getresponse()
+    text = response.read()
+    conn.close()
+    # A streamed reply reports failures in-band
+    return 500 if b"[ERROR]" in text else response.status
+
+
+def run_flask(routes, args):
+    from conversation_store import coalesced_turns
+    import main
+    import ai_speech_to_text_gpt4o as gpt4o
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = start_server(make_server("127.0.0.1", 0, main.app, threaded=True))
+    results = {}
+    for route in routes:
+        expected, bodies, copies = turn_plan(route, args.conversations, args.turns, args.duplicates)
+        before = coalesced_turns.coalesced
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            statuses = list(pool.map(lambda body: post(server.server_port, route, body), bodies))
+        elapsed = time.perf_counter() - started
+        results[route] = summarize(gpt4o.conversations, expected, copies, statuses, elapsed, coalesced_turns.coalesced - before)
+    server.shutdown()
+    return results
+
+
+async def run_quart_routes(routes, args):
+    from conversation_store import coalesced_turns
+    import asgi_app
+    import ai_speech_to_text_gpt4o as gpt4o
+    client = asgi_app.app.test_client()
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def send(route, body):
+        async with limit:
+            response = await client.post(route, json=body)
+            text = await response.get_data()
+            return 500 if b"[ERROR]" in text else response.status_code
+
+    results = {}
+    for route in routes:
+        expected, bodies, copies = turn_plan(route, args.conversations, args.turns, args.duplicates)
+        before = coalesced_turns.coalesced
+        started = time.perf_counter()
+        statuses = await asyncio.gather(*(send(route, body) for body in bodies))
+        elapsed = time.perf_counter() - started
+        results[route] = summarize(gpt4o.conversations, expected, copies, statuses, elapsed, coalesced_turns.coalesced - before)
+    return results
+
+
+def run_quart(routes, args):
+    # One event loop for every route: the shared async client's connections belong to it
+    return asyncio.run(run_quart_routes(routes, args))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fire concurrent turns at a few conversations and check every stored conversation stays consistent."
+    )
+    parser.add_argument("--servers", default="flask,quart")
+    parser.add_argument("--routes", default=",".join(ROUTES))
+    parser.add_argument("--backend", default="memory", choices=("memory", "sqlite"))
+    parser.add_argument("--conversations", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=10, help="distinct turns per conversation")
+    parser.add_argument("--duplicates", type=int, default=3, help="copies of each /text-assist turn sent at once")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", default="chat=0.02,token=0.001,speech=0.005")
+    args = parser.parse_args()
+
+    os.environ["conversation_store_backend"] = args.backend
+    os.environ["conversation_store_path"] = os.path.join(tempfile.mkdtemp(prefix="stress-conversations-"), "conversations.db")
+    config = FakeUpstreamConfig(parse_latency(args.latency), tokens=20)
+    upstream = start_server(ThreadingHTTPServer(("127.0.0.1", 0), fake_openai_handler(config)))
+    # Read by the OpenAI SDK when the shared clients are first built
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{upstream.server_port}/v1"
+
+    runners = {"flask": run_flask, "quart": run_quart}
+    results = {"backend": args.backend, "servers": {}}
+    for server in args.servers.split(","):
+        results["servers"][server] = runners[server](args.routes.split(","), args)
+    upstream.shutdown()
+    print(json.dumps(results, indent=2))
+    failed = any(run["inconsistent"] or run["errors"] for runs in results["servers"].values() for run in runs.values())
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+from dotenv import load_dotenv
+import json
+import logging
+import os
+
+from tracing import Counter, metrics
+from upstream import call_upstream, call_upstream_async, upstream_limit
+
+load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Extra attempts when a reply does not match its schema, on top of the first call
+structured_output_retries = int(os.getenv("structured_output_retries", "1"))
+
+parse_failures = Counter("structured_output_parse_failures_total", "Model replies that did not match their schema.")
+parse_retries = Counter("structured_output_retries_total", "Calls repeated because the reply did not match its schema.")
+metrics.extend([parse_failures, parse_retries])
+
+
+class StructuredOutputError(ValueError):
+    pass
+
+
+def _type_check(expected, accept):
+    def check(value, path):
+        if not accept(value):
+            raise StructuredOutputError(f"{path}: expected {expected}, got {type(value).__name__}")
+        return value
+    return check
+
+
+def _integer(value, path):
+    # Models sometimes send 2.0 or "2" for an integer; anything else is an error
+    if isinstance(value, bool):
+        raise StructuredOutputError(f"{path}: expected integer, got boolean")
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    raise StructuredOutputError(f"{path}: expected integer, got {value!r}")
+
+
+def _number(value, path):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    raise StructuredOutputError(f"{path}: expected number, got {value!r}")
+
+
+SCALARS = {
+    "string": _type_check("string", lambda value: isinstance(value, str)),
+    "boolean": _type_check("boolean", lambda value: isinstance(value, bool)),
+    "integer": _integer,
+    "number": _number,
+}
+
+
+def compile_schema(schema):
+    # Turns the JSON schema subset used for function parameters (object, array, scalars, enum, required)
+    # into nested checkers once, so each reply is validated without walking the schema again.
+    # A checker returns the cleaned value: unknown keys dropped, integer-like numbers coerced
+    kind = schema.get("type")
+    if kind == "object":
+        properties = {name: compile_schema(child) for name, child in schema.get("properties", {}).items()}
+        required = tuple(schema.get("required", ()))
+
+        def check_object(value, path):
+            if not isinstance(value, dict):
+                raise StructuredOutputError(f"{path}: expected object, got {type(value).__name__}")
+            for name in required:
+                if value.get(name) is None:
+                    raise StructuredOutputError(f"{path}.{name}: required")
+            # A null optional field is the same as a missing one
+            return {name: check(value[name], f"{path}.{name}")
+                    for name, check in properties.items() if value.get(name) is not None}
+        return check_object
+    if kind == "array":
+        check_item = compile_schema(schema.get("items", {}))
+
+        def check_array(value, path):
+            if not isinstance(value, list):
+                raise StructuredOutputError(f"{path}: expected array, got {type(value).__name__}")
+            return [check_item(item, f"{path}[{index}]") for index, item in enumerate(value)]
+        return check_array
+    check = SCALARS.get(kind, lambda value, path: value)
+    if "enum" not in schema:
+        return check
+    allowed = set(schema["enum"])
+
+    def check_enum(value, path):
+        value = check(value, path)
+        if value not in allowed:
+            raise StructuredOutputError(f"{path}: {value!r} is not one of {sorted(allowed)}")
+        return value
+    return check_enum
+
+
+class OutputSchema:
+    # A function definition ({"name", "description", "parameters"}) the model is made to answer with.
+    # "function" mode forces the function call; "json_object" mode is for prompts that already describe
+    # the JSON and only need the reply validated
+    def __init__(self, function, mode="function"):
+        self.function = function
+        self.name = function["name"]
+        self.mode = mode
+        self._check = compile_schema(function["parameters"])
+
+    def request(self):
+        if self.mode == "json_object":
+            return {"response_format": {"type": "json_object"}}
+        return {"functions": [self.function], "function_call": {"name": self.name}}
+
+    def parse_text(self, text):
+        if text is None:
+            raise StructuredOutputError(f"{self.name}: empty reply")
+        try:
+            value = json.loads(text)
+        except (TypeError, ValueError) as e:
+            raise StructuredOutputError(f"{self.name}: reply is not JSON: {e}")
+        return self._check(value, self.name)
+
+    def parse(self, completion):
+        message = completion.choices[0].message
+        function_call = getattr(message, "function_call", None)
+        # Without a function call the arguments may still have been written as the message text
+        return self.parse_text(function_call.arguments if function_call is not None else message.content)
+
+
+def _failed(schema, error, attempt):
+    parse_failures.inc(schema=schema.name)
+    if attempt < structured_output_retries:
+        parse_retries.inc(schema=schema.name)
+        logger.warning("Structured output failed, retrying: %s", error)
+
+
+def structured_call(schema, upstream, create, **kwargs):
+    # Calls the model until the reply matches the schema or the retries run out
+    for attempt in range(structured_output_retries + 1):
+        completion = call_upstream(upstream, create, **kwargs, **schema.request())
+        try:
+            return schema.parse(completion)
+        except StructuredOutputError as e:
+            _failed(schema, e, attempt)
+            error = e
+    raise error
+
+
+async def structured_call_async(schema, upstream, create, **kwargs):
+    for attempt in range(structured_output_retries + 1):
+        async with upstream_limit(upstream):
+            completion = await call_upstream_async(upstream, create, **kwargs, **schema.request())
+        try:
+            return schema.parse(completion)
+        except StructuredOutputError as e:
+            _failed(schema, e, attempt)
+            error = e
+    raise error
@@ -0,0 +1,284 @@
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger("slow_requests")
+
+# Requests slower than this are candidates for the slow-request log; the sample rate keeps it cheap
+slow_request_ms = float(os.getenv("slow_request_ms", "2000"))
+slow_request_sample_rate = float(os.getenv("slow_request_sample_rate", "0"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        trace = current_trace.get()
+        if trace is not None:
+            entry["request_id"] = trace.request_id
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        return f"{line} {json.dumps(fields, default=str)}" if fields else line
+
+
+def configure_logging():
+    # log_level gates everything; debug dumps of completions and transcriptions only show at DEBUG
+    handler = logging.StreamHandler()
+    if os.getenv("log_format", "text") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(os.getenv("log_level", "INFO").upper())
+
+
+def escape_label(value):
+    # Backslash, double quote and newline are the characters the text exposition format escapes in label values
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric:
+    def __init__(self, name, help_text, kind):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        escaped = (f'{key}="{escape_label(value)}"' for key, value in sorted(labels.items()))
+        return "{" + ",".join(escaped) + "}"
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(Metric):
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text, "counter")
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [f"{self.name}{self._labels(dict(key))} {value}" for key, value in values.items()]
+
+
+class Histogram(Metric):
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, "histogram")
+        self.buckets = buckets
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._series.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._series[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            series = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in series.items():
+            labels = dict(key)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{self._labels({**labels, 'le': bound})} {bucket_count}")
+            lines.append(f"{self.name}_bucket{self._labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{self.name}_count{self._labels(labels)} {count}")
+        return lines
+
+
+request_seconds = Histogram("http_request_duration_seconds", "Request latency by route and status.")
+stage_seconds = Histogram("stage_duration_seconds", "Time spent in each traced stage.")
+upstream_seconds = Histogram("upstream_call_duration_seconds", "Upstream call latency, retries included.")
+upstream_calls = Counter("upstream_calls_total", "Upstream calls by outcome.")
+upstream_tokens = Counter("upstream_tokens_total", "Tokens reported by upstream usage blocks.")
+upstream_bytes = Counter("upstream_bytes_total", "Audio bytes sent to and received from upstreams.")
+metrics = [request_seconds, stage_seconds, upstream_seconds, upstream_calls, upstream_tokens, upstream_bytes]
+# Callables returning extra exposition lines (cache and breaker gauges) at scrape time
+collectors = []
+# Callables given every finished request's trace dict, e.g. a replay run collecting stage timings
+trace_listeners = []
+
+
+def render_metrics():
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for collect in collectors:
+        try:
+            lines.extend(collect())
+        except Exception:
+            logger.exception("Metrics collector failed")
+    return "\n".join(lines) + "\n"
+
+
+def gauge_lines(name, help_text, samples):
+    # samples: [(labels dict, value)]
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"] + [
+        f"{name}{Metric._labels(labels)} {value}" for labels, value in samples
+    ]
+
+
+class Trace:
+    def __init__(self, route, request_id=None):
+        self.request_id = request_id or uuid.uuid4().hex
+        self.route = route
+        self.started = time.perf_counter()
+        self.spans = []
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def to_dict(self, status=None):
+        return {
+            "request_id": self.request_id,
+            "route": self.route,
+            "status": status,
+            "duration_ms": round(self.elapsed_ms(), 2),
+            "spans": self.spans,
+        }
+
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def start_trace(route, request_id=None):
+    trace = Trace(route, request_id)
+    current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace, status):
+    # Streamed responses finish after the handler returned, possibly in another context,
+    # so the trace is passed in rather than read from current_trace
+    duration_ms = trace.elapsed_ms()
+    request_seconds.observe(duration_ms / 1000, route=trace.route, status=status)
+    if duration_ms >= slow_request_ms and random.random() < slow_request_sample_rate:
+        slow_logger.warning("slow request %s %.0fms", trace.route, duration_ms,
+                            extra={"fields": {"trace": trace.to_dict(status)}})
+    for listener in trace_listeners:
+        try:
+            listener(trace.to_dict(status))
+        except Exception:
+            logger.exception("Trace listener failed")
+
+
+@contextmanager
+def span(name, **attributes):
+    # Times a stage into stage_duration_seconds and, inside a request, into its trace
+    trace = current_trace.get()
+    parent = _current_span.get()
+    token = _current_span.set(name)
+    started = time.perf_counter()
+    record = {"name": name, "parent": parent, "attributes": attributes}
+    try:
+        yield record["attributes"]
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        duration = time.perf_counter() - started
+        stage_seconds.observe(duration, stage=name)
+        if trace is not None:
+            record["start_ms"] = round((started - trace.started) * 1000, 2)
+            record["duration_ms"] = round(duration * 1000, 2)
+            trace.spans.append(record)
+
+
+def traced(name):
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def in_current_context(fn):
+    # Carry the request's trace into executor threads
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def payload_bytes(kwargs):
+    audio = kwargs.get("file")
+    if isinstance(audio, tuple):
+        audio = audio[1]
+    if isinstance(audio, (bytes, bytearray)):
+        return len(audio)
+    if hasattr(audio, "seek") and hasattr(audio, "tell"):
+        position = audio.tell()
+        size = audio.seek(0, os.SEEK_END)
+        audio.seek(position)
+        return size
+    return 0
+
+
+def record_upstream_call(upstream, operation, kwargs, result, error, duration, attributes):
+    outcome = "ok" if error is None else type(error).__name__
+    upstream_calls.inc(upstream=upstream, operation=operation, outcome=outcome)
+    upstream_seconds.observe(duration, upstream=upstream, operation=operation)
+    sent = payload_bytes(kwargs)
+    if sent:
+        upstream_bytes.inc(sent, upstream=upstream, direction="sent")
+        attributes["bytes_sent"] = sent
+    received = getattr(result, "content", None)
+    if isinstance(received, bytes):
+        upstream_bytes.inc(len(received), upstream=upstream, direction="received")
+        attributes["bytes_received"] = len(received)
+    usage = getattr(result, "usage", None) or getattr(result, "usage_metadata", None)
+    for kind, field in (("prompt", "prompt_tokens"), ("completion", "completion_tokens"),
+                        ("prompt", "prompt_token_count"), ("completion", "candidates_token_count")):
+        count = getattr(usage, field, None)
+        if isinstance(count, int):
+            upstream_tokens.inc(count, upstream=upstream, model=kwargs.get("model", "unknown"), kind=kind)
+            attributes[f"{kind}_tokens"] = count
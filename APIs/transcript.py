@@ -0,0 +1,119 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import json
+import struct
+import sys
+
+MAGIC = b"TRS1"
+HEADER = struct.Struct("<4sI")
+METADATA_FIELDS = ("text", "task", "language", "duration")
+
+
+def _little_endian(column):
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class Transcript:
+    # Word timestamps stored as columns: words in a list, starts and ends in float64 arrays,
+    # ordered by start time so time lookups are binary searches instead of scans over word dicts
+    def __init__(self, words, starts, ends, text="", task="transcribe", language=None, duration=None,
+                 transcript_id=None):
+        # Columns must already be ordered by start time
+        self.words = words
+        self.starts = starts
+        self.ends = ends
+        self.text = text
+        self.task = task
+        self.language = language
+        self.duration = duration
+        self.transcript_id = transcript_id
+        self._reach = None
+
+    @classmethod
+    def from_transcription_data(cls, transcription_data, transcript_id=None):
+        words = sorted(transcription_data.get("words") or [], key=lambda word: word["start"])
+        return cls(
+            [word["word"] for word in words],
+            array("d", (word["start"] for word in words)),
+            array("d", (word["end"] for word in words)),
+            transcript_id=transcript_id, **{field: transcription_data.get(field) for field in METADATA_FIELDS},
+        )
+
+    def to_transcription_data(self):
+        transcription_data = {field: getattr(self, field) for field in METADATA_FIELDS}
+        transcription_data["words"] = [self.word(index) for index in range(len(self))]
+        return transcription_data
+
+    def __len__(self):
+        return len(self.words)
+
+    def word(self, index):
+        return {"word": self.words[index], "start": self.starts[index], "end": self.ends[index]}
+
+    def _reach_column(self):
+        # Running maximum of end times: non-decreasing even when words overlap, so it can be bisected
+        if self._reach is None:
+            reach = array("d")
+            furthest = float("-inf")
+            for end in self.ends:
+                furthest = max(furthest, end)
+                reach.append(furthest)
+            self._reach = reach
+        return self._reach
+
+    def index_at(self, t):
+        # The word being spoken at t, or None in a pause
+        index = bisect_right(self.starts, t) - 1
+        while index >= 0 and self._reach_column()[index] >= t:
+            if self.ends[index] >= t:
+                return index
+            index -= 1
+        return None
+
+    def indices_between(self, t1, t2):
+        # Words overlapping [t1, t2]: everything before `first` ended before t1, everything from `last` starts after t2
+        first = bisect_left(self._reach_column(), t1)
+        last = bisect_right(self.starts, t2)
+        return [index for index in range(first, last) if self.ends[index] >= t1]
+
+    def words_between(self, t1, t2):
+        return [self.word(index) for index in self.indices_between(t1, t2)]
+
+    def to_bytes(self):
+        # MAGIC | metadata JSON length | metadata JSON | starts | ends | word lengths | words (UTF-8)
+        words_text = "".join(self.words)
+        metadata = {field: getattr(self, field) for field in METADATA_FIELDS}
+        metadata["count"] = len(self)
+        header = json.dumps(metadata).encode("utf-8")
+        return b"".join((
+            HEADER.pack(MAGIC, len(header)), header,
+            _little_endian(self.starts).tobytes(), _little_endian(self.ends).tobytes(),
+            _little_endian(array("I", map(len, self.words))).tobytes(), words_text.encode("utf-8"),
+        ))
+
+    @classmethod
+    def from_bytes(cls, raw, transcript_id=None):
+        magic, header_length = HEADER.unpack_from(raw)
+        if magic != MAGIC:
+            raise ValueError("Not a serialized transcript.")
+        offset = HEADER.size + header_length
+        metadata = json.loads(raw[HEADER.size:offset])
+        count = metadata.pop("count")
+        columns = []
+        for typecode in ("d", "d", "I"):
+            column = array(typecode)
+            size = column.itemsize * count
+            column.frombytes(raw[offset:offset + size])
+            columns.append(_little_endian(column))
+            offset += size
+        starts, ends, lengths = columns
+        words_text = raw[offset:].decode("utf-8")
+        words = []
+        position = 0
+        for length in lengths:
+            words.append(words_text[position:position + length])
+            position += length
+        return cls(words, starts, ends, transcript_id=transcript_id, **metadata)
@@ -0,0 +1,196 @@
+from collections import OrderedDict
+from dotenv import load_dotenv
+import hashlib
+import os
+import re
+import threading
+
+from transcript import Transcript
+
+load_dotenv()
+
+CACHE_KEY = re.compile(r"[0-9a-f]{64}")
+
+
+def finish_cache_key(digest, model, granularities=()):
+    # Key on the audio content plus every option that changes the transcription
+    digest.update(f"|{model}|{','.join(sorted(granularities))}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def is_cache_key(key):
+    # Keys double as transcript and recording ids in URLs, and name files on disk
+    return bool(CACHE_KEY.fullmatch(key or ""))
+
+
+def audio_cache_key(audio_bytes, model, granularities=()):
+    return finish_cache_key(hashlib.sha256(audio_bytes), model, granularities)
+
+
+def audio_file_cache_key(audio_file_path, model, granularities=()):
+    # Same key as audio_cache_key, hashed in blocks so large recordings are never fully loaded
+    digest = hashlib.sha256()
+    with open(audio_file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return finish_cache_key(digest, model, granularities)
+
+
+class MemoryTier:
+    def __init__(self, max_entries=128):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskTier:
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, suffix=".bin"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+        except FileNotFoundError:
+            return None
+        # Touch the file so eviction sees it as recently used; another worker may have evicted it since
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(value)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.directory):
+                if not name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total += stat.st_size
+            # Drop least recently used files until the tier fits its budget
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def size_bytes(self):
+        return sum(
+            os.path.getsize(os.path.join(self.directory, name))
+            for name in os.listdir(self.directory)
+            if name.endswith(self.suffix)
+        )
+
+
+class TieredCache:
+    # Byte tiers ordered fastest first; values are encoded once and shared by every tier
+    def __init__(self, tiers, encode=None, decode=None):
+        self.tiers = tiers
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda raw: raw)
+        self.hits = {type(tier).__name__: 0 for tier in tiers}
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        for index, tier in enumerate(self.tiers):
+            raw = tier.get(key)
+            if raw is None:
+                continue
+            with self._lock:
+                self.hits[type(tier).__name__] += 1
+            # Promote into the faster tiers we skipped
+            for faster in self.tiers[:index]:
+                faster.put(key, raw)
+            return self.decode(raw)
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        raw = self.encode(value)
+        for tier in self.tiers:
+            tier.put(key, raw)
+
+    def stats(self):
+        with self._lock:
+            hits = dict(self.hits)
+            misses = self.misses
+        lookups = sum(hits.values()) + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": (sum(hits.values()) / lookups) if lookups else 0.0,
+            "memory_entries": sum(len(t) for t in self.tiers if isinstance(t, MemoryTier)),
+            "disk_bytes": sum(t.size_bytes() for t in self.tiers if isinstance(t, DiskTier)),
+        }
+
+
+class TranscriptionCache(TieredCache):
+    # Transcripts are kept in their binary columnar form, which is about half the size of the
+    # JSON and several times faster to load; the cache key doubles as the transcript id
+    def __init__(self, tiers):
+        super().__init__(tiers, encode=Transcript.to_bytes, decode=Transcript.from_bytes)
+
+    def get(self, key):
+        transcript = super().get(key)
+        if transcript is not None:
+            transcript.transcript_id = key
+        return transcript
+
+
+def build_transcription_cache():
+    tiers = [MemoryTier(int(os.getenv("transcription_cache_memory_entries", "128")))]
+    cache_dir = os.getenv("transcription_cache_dir", ".cache/transcriptions")
+    if cache_dir:
+        tiers.append(DiskTier(
+            cache_dir,
+            max_bytes=int(os.getenv("transcription_cache_disk_bytes", str(256 * 1024 * 1024))),
+            suffix=".transcript",
+        ))
+    return TranscriptionCache(tiers)
+
+
+transcription_cache = build_transcription_cache()
@@ -0,0 +1,87 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import asyncio
+import os
+import re
+
+from tracing import in_current_context
+
+load_dotenv()
+
+# A sentence ends at ., ! or ? (plus any closing quotes/brackets) followed by whitespace, or at a blank line
+SENTENCE_BOUNDARY = re.compile(r"[.!?][\"')\]]*\s+|\n\s*\n")
+
+tts_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("tts_workers", "4")), thread_name_prefix="tts"
+)
+
+
+class SentenceSplitter:
+    def __init__(self, min_chars=int(os.getenv("tts_min_sentence_chars", "20"))):
+        # Very short fragments ("Sure.") are merged into the next sentence so
+        # we don't pay a synthesis round-trip for a single word
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text
+        sentences = []
+        start = 0
+        for match in SENTENCE_BOUNDARY.finditer(self.buffer):
+            candidate = self.buffer[start:match.end()].strip()
+            if len(candidate) >= self.min_chars:
+                sentences.append(candidate)
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self):
+        tail = self.buffer.strip()
+        self.buffer = ""
+        return [tail] if tail else []
+
+
+class TTSPipeline:
+    def __init__(self, synthesize, executor=tts_executor):
+        self.synthesize = synthesize
+        self.executor = executor
+        self.pending = deque()
+
+    def submit(self, sentence):
+        # Run in the request's context so each synthesis shows up as a span in its trace
+        self.pending.append(self.executor.submit(in_current_context(self.synthesize), sentence))
+
+    def ready(self):
+        # Emit finished segments in order without blocking on later ones
+        while self.pending and self.pending[0].done():
+            yield self.pending.popleft().result()
+
+    def drain(self):
+        while self.pending:
+            yield self.pending.popleft().result()
+
+    def cancel(self):
+        while self.pending:
+            self.pending.popleft().cancel()
+
+
+class AsyncTTSPipeline:
+    def __init__(self, synthesize):
+        self.synthesize = synthesize
+        self.pending = deque()
+
+    def submit(self, sentence):
+        self.pending.append(asyncio.ensure_future(self.synthesize(sentence)))
+
+    def ready(self):
+        while self.pending and self.pending[0].done():
+            yield self.pending.popleft().result()
+
+    async def drain(self):
+        while self.pending:
+            yield await self.pending.popleft()
+
+    def cancel(self):
+        while self.pending:
+            self.pending.popleft().cancel()
@@ -0,0 +1,57 @@
+import argparse
+import glob
+import json
+import os
+import statistics
+import time
+
+# Every turn must reach the model to be timed, even one repeating the previous message
+os.environ.setdefault("conversation_coalesce_turns", "false")
+
+import ai_speech_to_text_gpt4o as gpt4o
+
+TURN_SEPARATOR = "--- END OF TURN ---"
+
+
+def load_user_turns(path):
+    # Each logged turn repeats the whole history, so the last block holds every user message
+    with open(path, encoding="utf-8") as f:
+        blocks = [b for b in f.read().split(TURN_SEPARATOR) if b.strip()]
+    if not blocks:
+        return []
+    return [line[len("USER: "):].strip() for line in blocks[-1].splitlines() if line.startswith("USER: ")]
+
+
+def run_engine(engine, conversations):
+    latencies = []
+    for name, turns in conversations.items():
+        conversation_id = f"ab_{engine}_{name}"
+        gpt4o.conversations.delete(conversation_id)
+        for text in turns:
+            started = time.perf_counter()
+            gpt4o.process_user_input(conversation_id, text, "en", engine)
+            latencies.append((time.perf_counter() - started) * 1000)
+    latencies.sort()
+    return {
+        "turns": len(latencies),
+        "mean_ms": round(statistics.mean(latencies), 1) if latencies else None,
+        "p50_ms": round(latencies[len(latencies) // 2], 1) if latencies else None,
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 1) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare turn latency of the single-pass and multi-call engines.")
+    parser.add_argument("paths", nargs="*", help="conversation logs (default: ../conversations/*.txt)")
+    parser.add_argument("--engines", default="multi_call,single_pass")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    paths = args.paths or sorted(glob.glob(os.path.join(here, "..", "conversations", "*.txt")))
+    conversations = {os.path.splitext(os.path.basename(p))[0]: load_user_turns(p) for p in paths}
+    results = {engine: run_engine(engine, conversations) for engine in args.engines.split(",")}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
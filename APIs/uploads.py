@@ -0,0 +1,248 @@
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+import hashlib
+import os
+import shutil
+import tempfile
+
+from transcription_cache import finish_cache_key
+
+load_dotenv()
+
+# Whole request body; long recordings are chunked server-side, so this can exceed Whisper's 25 MB
+upload_max_bytes = int(os.getenv("upload_max_bytes", str(200 * 1024 * 1024)))
+# Uploads up to this size stay in memory, larger ones spill to a temporary file
+upload_memory_bytes = int(os.getenv("upload_memory_bytes", str(4 * 1024 * 1024)))
+UPLOAD_FIELD = "file"
+# Every part other than the audio file is buffered in memory, so together they are capped
+FORM_FIELDS_MAX_BYTES = 64 * 1024
+SNIFF_BYTES = 12
+
+# (extension, mime type, test on the first bytes)
+AUDIO_FORMATS = (
+    ("wav", "audio/wav", lambda head: head[:4] == b"RIFF" and head[8:12] == b"WAVE"),
+    ("flac", "audio/flac", lambda head: head[:4] == b"fLaC"),
+    ("ogg", "audio/ogg", lambda head: head[:4] == b"OggS"),
+    ("webm", "audio/webm", lambda head: head[:4] == b"\x1a\x45\xdf\xa3"),
+    ("m4a", "audio/mp4", lambda head: head[4:8] == b"ftyp"),
+    ("mp3", "audio/mpeg", lambda head: head[:3] == b"ID3" or (head[0] == 0xFF and head[1] & 0xE0 == 0xE0)),
+)
+
+
+class UploadError(Exception):
+    status = 400
+
+
+class UploadTooLarge(UploadError):
+    status = 413
+
+
+class UnsupportedAudio(UploadError):
+    status = 415
+
+
+def as_upload_error(error):
+    if isinstance(error, UploadError):
+        return error
+    if isinstance(error, RequestEntityTooLarge):
+        return UploadTooLarge("Form fields are too large.")
+    return UploadError(f"Malformed upload: {error}")
+
+
+def sniff_audio_format(head):
+    if len(head) < SNIFF_BYTES:
+        return None
+    for extension, mime_type, matches in AUDIO_FORMATS:
+        if matches(head):
+            return extension, mime_type
+    return None
+
+
+class AudioUpload:
+    # Spools an uploaded recording with bounded memory, hashing it on the way in so
+    # the transcription cache key is ready without a second pass over the audio
+    def __init__(self, filename=None, max_bytes=upload_max_bytes, memory_bytes=upload_memory_bytes):
+        self.filename = os.path.basename(filename or "") or "upload"
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.extension = None
+        self.mime_type = None
+        self.file = tempfile.SpooledTemporaryFile(max_size=memory_bytes)
+        self._digest = hashlib.sha256()
+        self._head = b""
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {self.max_bytes} bytes.")
+        if self.extension is None:
+            # Validate as soon as the header bytes arrive, before the rest is read
+            self._head += chunk[:SNIFF_BYTES]
+            if len(self._head) >= SNIFF_BYTES:
+                self._detect()
+        self._digest.update(chunk)
+        self.file.write(chunk)
+
+    def _detect(self):
+        detected = sniff_audio_format(self._head)
+        if detected is None:
+            raise UnsupportedAudio("Upload is not a supported audio format.")
+        self.extension, self.mime_type = detected
+
+    def finish(self):
+        if not self.size:
+            raise UploadError("Upload is empty.")
+        if self.extension is None:
+            self._detect()
+        self.file.seek(0)
+        return self
+
+    @property
+    def upload_name(self):
+        # Whisper infers the container from the extension, so name the file after what was sniffed
+        return f"{os.path.splitext(self.filename)[0]}.{self.extension}"
+
+    def cache_key(self, model, granularities=()):
+        return finish_cache_key(self._digest.copy(), model, granularities)
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    @contextmanager
+    def local_path(self):
+        # ffmpeg needs a real path; the upload is copied once into a named temporary file
+        with tempfile.NamedTemporaryFile(suffix=f".{self.extension}") as f:
+            self.file.seek(0)
+            shutil.copyfileobj(self.file, f, 1024 * 1024)
+            f.flush()
+            yield f.name
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class UploadParser:
+    # Feeds a multipart/form-data or raw audio body chunk by chunk; form fields come
+    # back as a dict, the "file" part (or the raw body) as an AudioUpload
+    def __init__(self, content_type, filename=None, content_length=None):
+        if content_length is not None and content_length > upload_max_bytes:
+            raise UploadTooLarge(f"Upload exceeds {upload_max_bytes} bytes.")
+        mimetype, options = parse_options_header(content_type or "")
+        self.fields = {}
+        self.upload = None
+        self.decoder = None
+        self._current = None
+        self._field_bytes = 0
+        if mimetype == "multipart/form-data":
+            if not options.get("boundary"):
+                raise UploadError("Missing multipart boundary.")
+            # werkzeug's own limit counts every raw chunk, audio included, so fields are capped in _drain instead
+            self.decoder = MultipartDecoder(options["boundary"].encode("latin-1"), max_form_memory_size=None)
+        elif mimetype.startswith("audio/") or mimetype == "application/octet-stream":
+            self.upload = AudioUpload(filename)
+        else:
+            raise UnsupportedAudio(f"Unsupported content type: {mimetype or 'none'}.")
+
+    def feed(self, chunk):
+        try:
+            if self.decoder is None:
+                self.upload.write(chunk)
+                return
+            self.decoder.receive_data(chunk)
+            self._drain()
+        except (UploadError, RequestEntityTooLarge, ValueError) as e:
+            self.close()
+            raise as_upload_error(e)
+
+    def _drain(self):
+        while True:
+            event = self.decoder.next_event()
+            if isinstance(event, NeedData) or isinstance(event, Epilogue):
+                return
+            if isinstance(event, File) and event.name == UPLOAD_FIELD:
+                if self.upload is not None:
+                    raise UploadError("Only one audio file can be uploaded per request.")
+                self.upload = AudioUpload(event.filename)
+                self._current = (UPLOAD_FIELD, None)
+            elif isinstance(event, (Field, File)):
+                self._current = (event.name, [])
+            elif isinstance(event, Data):
+                name, parts = self._current
+                if parts is None:
+                    self.upload.write(event.data)
+                else:
+                    self._field_bytes += len(event.data)
+                    if self._field_bytes > FORM_FIELDS_MAX_BYTES:
+                        raise UploadTooLarge("Form fields are too large.")
+                    parts.append(event.data)
+                    if not event.more_data:
+                        self.fields[name] = b"".join(parts).decode("utf-8", "replace")
+
+    def finish(self):
+        try:
+            if self.decoder is not None:
+                self.decoder.receive_data(None)
+                self._drain()
+            if self.upload is None:
+                raise UploadError(f"Missing '{UPLOAD_FIELD}' part.")
+            return self.fields, self.upload.finish()
+        except (UploadError, RequestEntityTooLarge, ValueError) as e:
+            self.close()
+            raise as_upload_error(e)
+
+    def close(self):
+        if self.upload is not None:
+            self.upload.close()
+
+
+def is_json_request(request):
+    return not request.mimetype or request.mimetype == "application/json"
+
+
+def _parser(request):
+    return UploadParser(
+        request.content_type,
+        filename=request.args.get("filename") or request.headers.get("X-Filename"),
+        content_length=request.content_length,
+    )
+
+
+def read_audio_request(request, chunk_size=64 * 1024):
+    # JSON bodies keep the original {"audio_file_path": ...} contract and return no upload;
+    # query-string parameters apply to raw audio bodies, form fields to multipart ones
+    if is_json_request(request):
+        return request.get_json(), None
+    parser = _parser(request)
+    for chunk in iter(lambda: request.stream.read(chunk_size), b""):
+        parser.feed(chunk)
+    fields, upload = parser.finish()
+    return {**request.args.to_dict(), **fields}, upload
+
+
+async def read_audio_request_async(request):
+    if is_json_request(request):
+        return await request.get_json(), None
+    parser = _parser(request)
+    async for chunk in request.body:
+        parser.feed(chunk)
+    fields, upload = parser.finish()
+    return {**request.args.to_dict(), **fields}, upload
+
+
+def flag(value):
+    # Form and query values arrive as strings; JSON bodies already carry booleans
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes")
+    return value
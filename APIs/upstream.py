@@ -0,0 +1,325 @@
+from dotenv import load_dotenv
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+
+from providers import lazy_provider, provider_errors, provider_state
+from tracing import collectors, gauge_lines, record_upstream_call, span
+
+load_dotenv()
+
+upstream_concurrency = {
+    "openai": int(os.getenv("openai_max_concurrency", "16")),
+    "vertex": int(os.getenv("vertex_max_concurrency", "8")),
+}
+_semaphores = {}
+
+def upstream_limit(name):
+    # One semaphore per upstream caps in-flight calls across every async request
+    if name not in _semaphores:
+        _semaphores[name] = asyncio.Semaphore(upstream_concurrency[name])
+    return _semaphores[name]
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+max_attempts = int(os.getenv("upstream_max_attempts", "3"))
+retry_base_seconds = float(os.getenv("upstream_retry_base_seconds", "0.5"))
+retry_max_seconds = float(os.getenv("upstream_retry_max_seconds", "8"))
+
+# Per-call timeouts by kind of request; classification prompts should fail fast,
+# transcriptions of long uploads need minutes
+call_timeouts = {
+    "classify": float(os.getenv("openai_timeout_classify", "15")),
+    "chat": float(os.getenv("openai_timeout_chat", "60")),
+    "speech": float(os.getenv("openai_timeout_speech", "60")),
+    "transcription": float(os.getenv("openai_timeout_transcription", "300")),
+}
+connect_timeout = float(os.getenv("openai_connect_timeout", "5"))
+pool_limits = {
+    "max_connections": int(os.getenv("openai_max_connections", "64")),
+    "max_keepalive_connections": int(os.getenv("openai_max_keepalive_connections", "32")),
+    "keepalive_expiry": float(os.getenv("openai_keepalive_expiry", "30")),
+}
+
+
+def _httpx():
+    try:
+        import httpx
+    except ImportError:
+        # Newer openai releases ship on the httpx2 fork
+        import httpx2 as httpx
+    return httpx
+
+
+def upstream_timeout(kind):
+    return _httpx().Timeout(call_timeouts[kind], connect=connect_timeout)
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+def upstream_errors():
+    # Evaluated when an except clause matches, so catching SDK errors does not import the SDK
+    return (UpstreamUnavailable,) + provider_errors()
+
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failed calls, sheds calls for
+    # `reset_seconds`, then lets a single trial call through (half-open)
+    def __init__(self, name, failure_threshold=5, reset_seconds=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.counts = {"calls": 0, "failures": 0, "retries": 0, "short_circuited": 0, "opened": 0}
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            # True for the trial call of a half-open breaker
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self.state = "half_open"
+                self.counts["calls"] += 1
+                return True
+            if self.state != "closed":
+                self.counts["short_circuited"] += 1
+                retry_in = max(0.0, self.reset_seconds - (time.monotonic() - self.opened_at))
+                raise UpstreamUnavailable(f"{self.name} is unavailable, retry in {retry_in:.0f}s")
+            self.counts["calls"] += 1
+            return False
+
+    def record_retry(self):
+        with self._lock:
+            self.counts["retries"] += 1
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.counts["failures"] += 1
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.counts["opened"] += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def end_trial(self):
+        # A trial that ended without a verdict, e.g. cancelled with the request, reopens
+        # the breaker, so the next call after reset_seconds gets a trial of its own
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.consecutive_failures, **self.counts}
+
+
+breakers = {
+    name: CircuitBreaker(
+        name,
+        failure_threshold=int(os.getenv("upstream_breaker_failures", "5")),
+        reset_seconds=float(os.getenv("upstream_breaker_reset_seconds", "30")),
+    )
+    for name in upstream_concurrency
+}
+
+
+def error_status(error):
+    # openai errors carry status_code, google.api_core errors carry an HTTP code
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error):
+    openai = sys.modules.get("openai")
+    if openai is not None and isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return error_status(error) in RETRYABLE_STATUS
+
+
+def is_upstream_failure(error):
+    # 429s are throttling, not degradation, so they are retried but never trip the breaker
+    return is_retryable(error) and error_status(error) != 429
+
+
+def retry_delay(error, attempt):
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None and hasattr(response, "headers") else None
+    try:
+        if retry_after:
+            return min(retry_max_seconds, float(retry_after))
+    except ValueError:
+        pass
+    # Full jitter keeps retries from many requests from arriving together
+    return random.uniform(0, min(retry_max_seconds, retry_base_seconds * 2 ** attempt))
+
+
+def _finish_attempt(breaker, error, attempt):
+    # Returns the backoff before the next attempt, or None when the error should propagate
+    if not is_retryable(error):
+        breaker.record_success()
+        return None
+    if attempt == max_attempts - 1:
+        # A trial still throttled after every attempt has not shown the upstream recovered
+        if is_upstream_failure(error) or breaker.state == "half_open":
+            breaker.record_failure()
+        return None
+    breaker.record_retry()
+    return retry_delay(error, attempt)
+
+
+def operation_name(fn):
+    # client.chat.completions.create -> "completions", model.generate_content -> "generativemodel"
+    owner = getattr(fn, "__self__", None)
+    return type(owner).__name__.lower() if owner is not None else fn.__name__
+
+
+def _call_with_retries(breaker, attributes, fn, *args, **kwargs):
+    trial = breaker.before_call()
+    try:
+        for attempt in range(max_attempts):
+            attributes["attempts"] = attempt + 1
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = _finish_attempt(breaker, e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+    finally:
+        if trial:
+            breaker.end_trial()
+
+
+async def _call_with_retries_async(breaker, attributes, fn, *args, **kwargs):
+    trial = breaker.before_call()
+    try:
+        for attempt in range(max_attempts):
+            attributes["attempts"] = attempt + 1
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = _finish_attempt(breaker, e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            breaker.record_success()
+            return result
+    finally:
+        if trial:
+            breaker.end_trial()
+
+
+def call_upstream(name, fn, *args, **kwargs):
+    operation = operation_name(fn)
+    with span(f"{name}.{operation}") as attributes:
+        started = time.perf_counter()
+        result = error = None
+        try:
+            result = _call_with_retries(breakers[name], attributes, fn, *args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            record_upstream_call(name, operation, kwargs, result, error, time.perf_counter() - started, attributes)
+
+
+async def call_upstream_async(name, fn, *args, **kwargs):
+    operation = operation_name(fn)
+    with span(f"{name}.{operation}") as attributes:
+        started = time.perf_counter()
+        result = error = None
+        try:
+            result = await _call_with_retries_async(breakers[name], attributes, fn, *args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            record_upstream_call(name, operation, kwargs, result, error, time.perf_counter() - started, attributes)
+
+
+def _http_options():
+    httpx = _httpx()
+    return {
+        "limits": httpx.Limits(**pool_limits),
+        "timeout": httpx.Timeout(call_timeouts["chat"], connect=connect_timeout),
+    }
+
+
+def _openai_client():
+    from openai import DefaultHttpxClient, OpenAI
+    return OpenAI(
+        api_key=os.getenv("openai_api_key"), max_retries=0, http_client=DefaultHttpxClient(**_http_options())
+    )
+
+
+def _async_openai_client():
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    return AsyncOpenAI(
+        api_key=os.getenv("openai_api_key"), max_retries=0, http_client=DefaultAsyncHttpxClient(**_http_options())
+    )
+
+
+# One pooled client per flavour, shared by every blueprint and built on first use;
+# retries are done by call_upstream
+openai_client = lazy_provider("openai", "openai", _openai_client)
+async_openai_client = lazy_provider("openai", "openai_async", _async_openai_client)
+
+
+def pool_state(provider):
+    if not provider.initialized:
+        return {}
+    # Best effort: the connection list lives on the transport's private httpcore pool
+    pool = getattr(getattr(getattr(provider.get(), "_client", None), "_transport", None), "_pool", None)
+    connections = getattr(pool, "connections", None)
+    if connections is None:
+        return {}
+    idle = sum(1 for connection in connections if connection.is_idle())
+    return {"open_connections": len(connections), "idle_connections": idle}
+
+
+def upstream_metrics():
+    return {
+        "providers": provider_state(),
+        "breakers": {name: breaker.snapshot() for name, breaker in breakers.items()},
+        "pool": {
+            "limits": pool_limits,
+            "sync": pool_state(openai_client),
+            "async": pool_state(async_openai_client),
+        },
+        "in_flight": {
+            name: upstream_concurrency[name] - semaphore._value for name, semaphore in _semaphores.items()
+        },
+    }
+
+
+def breaker_metric_lines():
+    states = {"closed": 0, "half_open": 1, "open": 2}
+    snapshots = {name: breaker.snapshot() for name, breaker in breakers.items()}
+    return gauge_lines(
+        "upstream_breaker_state", "Circuit breaker state (0 closed, 1 half open, 2 open).",
+        [({"upstream": name}, states[snapshot["state"]]) for name, snapshot in snapshots.items()],
+    ) + gauge_lines(
+        "upstream_short_circuited", "Calls rejected while the breaker was open.",
+        [({"upstream": name}, snapshot["short_circuited"]) for name, snapshot in snapshots.items()],
+    )
+
+
+collectors.append(breaker_metric_lines)